@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+import zmq
+try:
+    from gevent import monkey
+    if monkey.is_module_patched("threading"):
+        # Running inside a gevent worker: a blocking recv would stall every greenlet
+        import zmq.green as zmq
+except ImportError:
+    pass
+import argparse
+import base64
+import datetime
+import json
+import secrets
+import threading
+import time
+
+DEFAULT_COLLECTOR_ADDRESS = "ipc:///tmp/wsmonitor_collector.sock"
+COLLECTOR_ENV_VAR = "WSMONITOR_COLLECTOR"
+
+# Subscriber methods the web workers may call, all of them only read state except
+# add_resource_request
+EXPOSED_METHODS = ("get_ws_names",
+                   "get_recap_snapshot",
+                   "get_stats_recap",
+                   "get_stats_recap_table",
+                   "get_stats_recap_dictlist",
+                   "get_activity_png",
+                   "get_activity_text",
+                   "get_host_timing",
+                   "get_history_users",
+                   "get_history",
+                   "get_metric_history",
+                   "get_user_names",
+                   "get_user_activity_png",
+                   "get_total_usage_minutes",
+                   "get_total_usage_ratio",
+                   "get_total_usage_ratio_parts",
+                   "get_ingest_counters",
+                   "get_startup_timings",
+                   "get_persistence_counters",
+                   "get_metrics_text",
+                   "add_resource_request",
+                   "get_resource_requests")
+
+
+class CollectorUnavailable(Exception):
+    pass
+
+
+def _encode_arg(v):
+    if isinstance(v, datetime.date):
+        return {"__date__" : v.isoformat()}
+    return v
+
+def _decode_arg(v):
+    if isinstance(v, dict) and "__date__" in v:
+        return datetime.date.fromisoformat(v["__date__"])
+    return v
+
+def _encode_reply_value(v):
+    """json.dumps hook for the values JSON has no type for, tagged so the client can rebuild them."""
+    if isinstance(v, (bytes, bytearray)):
+        return {"__bytes__" : base64.b64encode(v).decode("ascii")}
+    if isinstance(v, datetime.datetime):
+        return {"__datetime__" : v.isoformat()}
+    if isinstance(v, datetime.date):
+        return {"__date__" : v.isoformat()}
+    if isinstance(v, (set, frozenset)):
+        return list(v)
+    if hasattr(v, "dtype") and hasattr(v, "tobytes"): # numpy, not imported here
+        if v.ndim == 0:
+            return v.item()
+        return {"__ndarray__" : base64.b64encode(v.tobytes()).decode("ascii"),
+                "dtype" : v.dtype.str,
+                "shape" : list(v.shape)}
+    from ws_monitor.subscriber import RecapSnapshot
+    if isinstance(v, RecapSnapshot):
+        return {"__recap_snapshot__" : vars(v)}
+    raise TypeError(f"cannot send a {type(v).__name__} to the web workers")
+
+def _decode_reply_value(d : dict):
+    """json.loads object hook undoing _encode_reply_value."""
+    if len(d) == 1:
+        if "__bytes__" in d:
+            return base64.b64decode(d["__bytes__"])
+        if "__datetime__" in d:
+            return datetime.datetime.fromisoformat(d["__datetime__"])
+        if "__date__" in d:
+            return datetime.date.fromisoformat(d["__date__"])
+        if "__recap_snapshot__" in d:
+            from ws_monitor.subscriber import RecapSnapshot
+            return RecapSnapshot(**d["__recap_snapshot__"])
+    if "__ndarray__" in d:
+        import numpy as np
+        return np.frombuffer(base64.b64decode(d["__ndarray__"]), dtype=d["dtype"]).reshape(d["shape"]).copy()
+    return d
+
+
+class CollectorServer:
+    """Serves the state of a Subscriber to the web workers over a local socket.
+
+    Requests are JSON ([method, args, kwargs]) so that whoever can reach the socket can only
+    call EXPOSED_METHODS. Replies are JSON too ([ok, result, boot id]), with bytes, arrays
+    and RecapSnapshots tagged, so a process bound on the socket path in place of the
+    collector cannot run code in the web workers. Tuples arrive as lists.
+    The Subscriber caches its snapshots and renders, so requests are cheap and a
+    few worker threads are enough.
+    """
+    def __init__(self, subscriber, address : str = DEFAULT_COLLECTOR_ADDRESS, workers : int = 4):
+        self._subscriber = subscriber
+        self._address = address
+        self.boot_id = secrets.token_hex(8)
+        self.requests_count = 0
+        self.errors_count = 0
+        self._ctx = zmq.Context.instance()
+        self._backend_address = f"inproc://collector-{id(self)}"
+        self._frontend = self._ctx.socket(zmq.ROUTER)
+        self._frontend.bind(address)
+        self._backend = self._ctx.socket(zmq.DEALER)
+        self._backend.bind(self._backend_address)
+        for i in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+        threading.Thread(target=zmq.proxy, args=(self._frontend, self._backend), daemon=True).start()
+        print(f"Collector serving on {address}")
+
+    def _handle(self, request : bytes):
+        method, args, kwargs = json.loads(request)
+        if method == "get_boot_id":
+            return self.boot_id
+        if method not in EXPOSED_METHODS:
+            raise ValueError(f"method {method} is not exposed")
+        return getattr(self._subscriber, method)(*[_decode_arg(v) for v in args],
+                                                 **{k:_decode_arg(v) for k,v in kwargs.items()})
+
+    def _worker(self):
+        s = self._ctx.socket(zmq.REP)
+        s.connect(self._backend_address)
+        while True:
+            request = s.recv()
+            self.requests_count += 1
+            try:
+                reply = json.dumps([True, self._handle(request), self.boot_id], default=_encode_reply_value)
+            except Exception as e:
+                self.errors_count += 1
+                print(f"collector: failed to handle request {request[:100]}: {type(e)}: {e}")
+                reply = json.dumps([False, f"{type(e).__name__}: {e}", self.boot_id])
+            s.send(reply.encode("utf8"))
+
+
+class CollectorClient:
+    """Stands in for a Subscriber in processes that read the state of a collector daemon.
+
+    Sockets are pooled so that concurrent requests (threads or greenlets) each use
+    their own REQ socket. A socket whose call did not complete (timeout, error, bad
+    reply, interrupt) is discarded, as a REQ socket cannot send again before
+    receiving the reply. boot_id is the one of the last
+    reply, so it changes as soon as the collector restarts.
+    """
+    def __init__(self, address : str = DEFAULT_COLLECTOR_ADDRESS, timeout_sec : float = 5.0):
+        self._address = address
+        self._timeout_ms = int(timeout_sec*1000)
+        self._ctx = zmq.Context.instance()
+        self._pool : list = []
+        self._pool_lock = threading.Lock()
+        self.boot_id : str | None = None
+
+    def _get_socket(self):
+        with self._pool_lock:
+            if len(self._pool) > 0:
+                return self._pool.pop()
+        s = self._ctx.socket(zmq.REQ)
+        s.setsockopt(zmq.RCVTIMEO, self._timeout_ms)
+        s.setsockopt(zmq.SNDTIMEO, self._timeout_ms)
+        s.setsockopt(zmq.LINGER, 0)
+        s.connect(self._address)
+        return s
+
+    def call(self, method : str, *args, **kwargs):
+        s = self._get_socket()
+        completed = False
+        try:
+            s.send(json.dumps([method,
+                               [_encode_arg(v) for v in args],
+                               {k:_encode_arg(v) for k,v in kwargs.items()}]).encode("utf8"))
+            ok, result, boot_id = json.loads(s.recv(), object_hook=_decode_reply_value)
+            completed = True
+        except zmq.Again:
+            raise CollectorUnavailable(f"no reply from collector at {self._address} to {method}")
+        finally:
+            if not completed:
+                s.close() # stuck between send and recv, or in an unknown state
+        with self._pool_lock:
+            self._pool.append(s)
+        self.boot_id = boot_id
+        if not ok:
+            raise RuntimeError(f"collector failed on {method}: {result}")
+        return result
+
+    def get_boot_id(self) -> str:
+        return self.call("get_boot_id")
+
+    def wait_boot_id(self, retry_sec : float = 2.0) -> str:
+        while True:
+            try:
+                return self.get_boot_id()
+            except CollectorUnavailable as e:
+                print(f"Waiting for collector: {e}")
+                time.sleep(retry_sec)
+
+    def __getattr__(self, name):
+        if name not in EXPOSED_METHODS:
+            raise AttributeError(name)
+        def method(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return method
+
+
+def main() -> None:
+    # imported here so that web workers importing CollectorClient don't load the whole subscriber
+    from ws_monitor.subscriber import Subscriber
+    from ws_monitor.web_config import get_web_config_path, load_web_config, build_user_alias_lookup
+    from ws_monitor.sharding import DEFAULT_FANOUT_ADDRESS, HostShard, run_forwarder
+    from ws_monitor.persistence import close_on_sigterm
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--server", default="tcp://*:9452", type=str, help="Address of the aggregator server.")
+    ap.add_argument("--data-folder", default="./data", type=str, help="Folder containing server data.")
+    ap.add_argument("--listen", default=DEFAULT_COLLECTOR_ADDRESS, type=str, help="Address the web workers connect to.")
+    ap.add_argument("--workers", default=4, type=int, help="Threads serving the web workers.")
+    ap.add_argument("--shard", default=None, type=str, help="Only ingest the hosts of shard <index>/<count>, e.g. 0/4.")
+    ap.add_argument("--shard-map", default=None, type=str, help="YAML mapping hostnames to shard indices, other hosts are hashed.")
+    ap.add_argument("--connect", action="store_true", help="Connect to --server (a forwarder) instead of binding it.")
+    ap.add_argument("--forwarder", action="store_true", help="Only forward the publishers on --server to the shards on --fanout.")
+    ap.add_argument("--fanout", default=DEFAULT_FANOUT_ADDRESS, type=str, help="Address the forwarder publishes to.")
+    args = vars(ap.parse_args())
+
+    if args["forwarder"]:
+        run_forwarder(args["server"], args["fanout"])
+        return
+
+    web_config = load_web_config(get_web_config_path())
+    shard = HostShard.parse(args["shard"], args["shard_map"]) if args["shard"] else None
+    sub = Subscriber(args["server"], args["data_folder"],
+                     user_alias_lookup=build_user_alias_lookup(web_config.get("user_aliases", {})),
+                     shard=shard,
+                     connect=args["connect"])
+    close_on_sigterm(sub.close)
+    server = CollectorServer(sub, address=args["listen"], workers=args["workers"])
+    try:
+        while True:
+            time.sleep(60)
+            print(f"collector: {server.requests_count} requests served, {server.errors_count} errors")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
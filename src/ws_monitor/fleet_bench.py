@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+import psutil
+import zmq
+from ws_monitor.subscriber import Subscriber
+from ws_monitor.wire_format import WireEncoder
+
+SYSTEM_STATE_TOPIC = b'system_stats'
+
+class SimulatedHost:
+    """Produces publisher.py-shaped messages for one fake workstation."""
+    def __init__(self, hostname : str, gpus : int, users : int, churn : float, rng : random.Random):
+        self.hostname = hostname
+        self._gpus = gpus
+        self._users = [f"user{i:03d}" for i in range(users)]
+        self._churn = churn
+        self._rng = rng
+        self._active = set(rng.sample(self._users, min(len(self._users), 2)))
+        self._disk = {"stats" : {"disk_total_size" : 2*10**12,
+                                 "disk_used_size" : 10**12,
+                                 "disk_free_size" : 10**12,
+                                 "disk_usage_ratio" : 0.5}}
+
+    def state(self) -> dict:
+        rng = self._rng
+        if rng.random() < self._churn and len(self._users) > 0:
+            user = rng.choice(self._users)
+            self._active ^= {user} # someone starts or stops using the machine
+        gpu = {}
+        for i in range(self._gpus):
+            owners = [u for u in self._active if (int(u[4:])+i) % 2 == 0]
+            gpu[str(i)] = {"name" : "NVIDIA RTX A6000",
+                           "memory_size_bytes" : 51527024640,
+                           "stats" : {"gpu_proc_utilization_ratio" : rng.choice((0, 0, 35, 99)) if owners else 0,
+                                      "gpu_mem_util" : 0,
+                                      "gpu_mem_fill_ratio" : 0.4*len(owners)},
+                           "memratio_by_user" : {u : 0.4 for u in owners}}
+        return {"hostname" : self.hostname,
+                "ip" : "10.0.0.1",
+                "gpu" : gpu,
+                "cpu" : {"cpu_utilization_ratio" : round(rng.random(), 2),
+                         "cpu_mem_fill_ratio" : 0.5,
+                         "memratio_by_user" : {"root" : 0.01, **{u : 0.05 for u in self._active}}},
+                "disk" : self._disk}
+
+
+def publisher_process(address : str, first_host : int, hosts : int, args : dict, sent_counter, stop_event):
+    """Publishes for hosts simulated hosts, each at args["rate"] messages per second."""
+    rng = random.Random(first_host)
+    ctx = zmq.Context()
+    s = ctx.socket(zmq.PUB)
+    s.setsockopt(zmq.SNDHWM, 100000)
+    s.connect(address)
+    time.sleep(0.5) # let the connection establish, PUB drops messages until then
+    session_id = int(time.time()*1000)
+    period = 1.0/args["rate"]
+    sims = [SimulatedHost(f"{args['host_prefix']}{first_host+i:05d}", args["gpus"], args["users"], args["churn"], rng)
+            for i in range(hosts)]
+    encoders = [WireEncoder(session_id) if args["wire_format"] == "binary" else None for _ in sims]
+    seq_nums = [0]*hosts
+    start = time.monotonic()
+    schedule = [(start+period*i/hosts, i) for i in range(hosts)] # spread the hosts over the period
+    heapq.heapify(schedule)
+    sent = 0
+    while not stop_event.is_set():
+        t, i = heapq.heappop(schedule)
+        delay = t-time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        data = sims[i].state()
+        data["bench_sent_at_us"] = time.time_ns()//1000 # an integer, floats travel as float32
+        if encoders[i] is not None:
+            s.send_multipart([SYSTEM_STATE_TOPIC] + encoders[i].encode(seq_nums[i], data))
+        else:
+            data["session_id"] = session_id
+            data["seq_num"] = seq_nums[i]
+            s.send_multipart([SYSTEM_STATE_TOPIC, json.dumps(data).encode("utf8")])
+        seq_nums[i] += 1
+        sent += 1
+        if sent % 100 == 0:
+            with sent_counter.get_lock():
+                sent_counter.value += 100
+        heapq.heappush(schedule, (t+period, i))
+    with sent_counter.get_lock():
+        sent_counter.value += sent % 100
+    s.close(linger=1000)
+
+
+class BenchSubscriber(Subscriber):
+    """Subscriber recording the time from send to the end of processing of each message."""
+    def __init__(self, *args, **kwargs):
+        self.latencies : list[float] = []
+        self.recording = False
+        super().__init__(*args, **kwargs)
+
+    def _process_message(self, hostname : str, data : dict):
+        super()._process_message(hostname, data)
+        if self.recording:
+            self.latencies.append(time.time()-data["bench_sent_at_us"]/1e6)
+
+
+def processed_count(counters : dict) -> tuple[int, int]:
+    hosts = counters["hosts"].values()
+    return sum(h.get("received", 0) for h in hosts), sum(h.get("processed", 0) for h in hosts)
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Simulates a fleet of publishers against a local Subscriber and reports ingest throughput.")
+    ap.add_argument("--hosts", default=100, type=int, help="Number of simulated workstations.")
+    ap.add_argument("--gpus", default=4, type=int, help="GPUs per workstation.")
+    ap.add_argument("--users", default=20, type=int, help="Users that may appear on each workstation.")
+    ap.add_argument("--rate", default=1.0, type=float, help="Messages per second per workstation.")
+    ap.add_argument("--churn", default=0.05, type=float, help="Probability that a user starts or stops at each message.")
+    ap.add_argument("--duration", default=20.0, type=float, help="Measured seconds, after the warmup.")
+    ap.add_argument("--warmup", default=5.0, type=float, help="Seconds before measuring, hosts get created meanwhile.")
+    ap.add_argument("--processes", default=2, type=int, help="Publisher processes.")
+    ap.add_argument("--wire-format", default="binary", choices=["binary", "json"])
+    ap.add_argument("--address", default="ipc:///tmp/wsmon_fleet_bench.sock", type=str, help="ipc:// or tcp://127.0.0.1:<port> endpoint.")
+    ap.add_argument("--data-folder", default=None, type=str, help="Subscriber data folder, a temporary one by default.")
+    ap.add_argument("--host-prefix", default="simws", type=str)
+    ap.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    args = vars(ap.parse_args())
+
+    data_folder = args["data_folder"] or tempfile.mkdtemp(prefix="wsmon_bench_")
+    proc = psutil.Process()
+    rss_start = proc.memory_info().rss
+    sub = BenchSubscriber(args["address"], data_folder)
+    time.sleep(0.5)
+
+    stop_event = multiprocessing.Event()
+    sent_counter = multiprocessing.Value("q", 0)
+    processes = []
+    per_process = [len(r) for r in np.array_split(np.arange(args["hosts"]), args["processes"])]
+    first_host = 0
+    for hosts in per_process:
+        p = multiprocessing.Process(target=publisher_process,
+                                    args=(args["address"], first_host, hosts, args, sent_counter, stop_event),
+                                    daemon=True)
+        p.start()
+        processes.append(p)
+        first_host += hosts
+
+    time.sleep(args["warmup"])
+    rss_warm = proc.memory_info().rss
+    received_0, processed_0 = processed_count(sub.get_ingest_counters())
+    sent_0 = sent_counter.value
+    cpu_0 = proc.cpu_times()
+    sub.recording = True
+    t0 = time.monotonic()
+    time.sleep(args["duration"])
+    sub.recording = False
+    elapsed = time.monotonic()-t0
+    cpu_1 = proc.cpu_times()
+    sent_1 = sent_counter.value
+    counters = sub.get_ingest_counters()
+    received_1, processed_1 = processed_count(counters)
+    rss_end = proc.memory_info().rss
+
+    stop_event.set()
+    for p in processes:
+        p.join(timeout=5)
+    time.sleep(0.5)
+    counters = sub.get_ingest_counters()
+
+    latencies = np.array(sub.latencies)
+    hosts = counters["hosts"].values()
+    results = {"hosts" : args["hosts"],
+               "offered_msgs_per_sec" : (sent_1-sent_0)/elapsed,
+               "received_msgs_per_sec" : (received_1-received_0)/elapsed,
+               "processed_msgs_per_sec" : (processed_1-processed_0)/elapsed,
+               "subscriber_cpu_ratio" : ((cpu_1.user+cpu_1.system)-(cpu_0.user+cpu_0.system))/elapsed,
+               "latency_ms" : {f"p{q}" : float(np.percentile(latencies, q))*1000 if len(latencies) > 0 else None
+                               for q in (50, 90, 99, 100)},
+               "sent" : sent_counter.value,
+               "received" : sum(h.get("received", 0) for h in hosts),
+               "lost_in_transport" : sent_counter.value-sum(h.get("received", 0) for h in hosts),
+               "coalesced" : sum(h.get("coalesced", 0) for h in hosts),
+               "dropped" : sum(h.get("dropped", 0) for h in hosts),
+               "dropped_deltas" : sum(h.get("dropped_deltas", 0) for h in hosts),
+               "ignored_old" : sum(h.get("ignored_old", 0) for h in hosts),
+               "rss_mb" : {"start" : rss_start/2**20, "after_warmup" : rss_warm/2**20, "end" : rss_end/2**20},
+               "rss_growth_mb_per_min" : (rss_end-rss_warm)/2**20/elapsed*60}
+    if args["json"]:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{args['hosts']} hosts x {args['rate']} msg/s ({args['wire_format']}), {elapsed:.1f}s measured:")
+        print(f"  offered   {results['offered_msgs_per_sec']:10.1f} msg/s")
+        print(f"  received  {results['received_msgs_per_sec']:10.1f} msg/s")
+        print(f"  processed {results['processed_msgs_per_sec']:10.1f} msg/s, subscriber cpu {results['subscriber_cpu_ratio']*100:.0f}%")
+        print(f"  latency   " + "  ".join(f"{k} {v:.1f}ms" for k,v in results["latency_ms"].items() if v is not None))
+        print(f"  lost in transport {results['lost_in_transport']}, coalesced {results['coalesced']}, dropped {results['dropped']},"
+              f" dropped deltas {results['dropped_deltas']}, ignored old {results['ignored_old']}")
+        print(f"  rss {results['rss_mb']['start']:.0f} -> {results['rss_mb']['after_warmup']:.0f} -> {results['rss_mb']['end']:.0f} MB"
+              f" ({results['rss_growth_mb_per_min']:+.1f} MB/min after warmup)")
+    sub.close() # its threads would keep writing to the data folder
+    if args["data_folder"] is None:
+        shutil.rmtree(data_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
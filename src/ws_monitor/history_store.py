@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+
+import collections
+import datetime
+import os
+import threading
+from typing import Callable
+import yaml
+import numpy as np
+
+HISTORY_LAYOUT_VERSION = 3
+CHUNK_MINUTES = 60*24*30
+
+def epoch_minute(t : float) -> int:
+    return int(t // 60)
+
+class HistoryChunk:
+    """One chunk of a ChunkedHistoryStore.
+
+    columns holds the fixed per-minute columns. The activity of each user is a separate
+    bit-packed file, created only once the user is active in the chunk, so the size
+    grows with the users that were actually seen and not with the number of known users.
+    """
+    def __init__(self, store : "ChunkedHistoryStore", chunk_id : int, raw : np.memmap):
+        self._store = store
+        self.chunk_id = chunk_id
+        self.raw = raw
+        self.columns : dict[str, np.ndarray] = {}
+        for name, dtype in store.COLUMNS:
+            offset = store._column_offsets[name]
+            self.columns[name] = raw[offset:offset+store.chunk_minutes*np.dtype(dtype).itemsize].view(dtype)
+        self.users : dict[int, np.memmap] = {}
+        prefix = f"chunk_{chunk_id:08d}_user_"
+        for f in os.listdir(store.folder):
+            if f.startswith(prefix) and f.endswith(".bits"):
+                user_idx = int(f[len(prefix):-len(".bits")])
+                self.users[user_idx] = self._map_user(user_idx)
+
+    def _map_user(self, user_idx : int) -> np.memmap:
+        path = self._store._user_bits_path(self.chunk_id, user_idx)
+        size = (self._store.chunk_minutes+7)//8
+        if not os.path.isfile(path):
+            with open(path, "wb") as f:
+                f.truncate(size)
+        return np.memmap(path, dtype=np.uint8, mode="r+", shape=(size,))
+
+    def set_user(self, user_idx : int, pos : int, active : bool):
+        bits = self.users.get(user_idx)
+        if bits is None:
+            if not active:
+                return
+            bits = self._map_user(user_idx)
+            self.users[user_idx] = bits
+        if active:
+            bits[pos >> 3] |= 0x80 >> (pos & 7)
+        else:
+            bits[pos >> 3] &= ~(0x80 >> (pos & 7)) & 0xFF
+
+    def set_user_positions(self, user_idx : int, positions : np.ndarray):
+        """Mark user_idx active at all the given positions."""
+        if len(positions) == 0:
+            return
+        bits = self.users.get(user_idx)
+        if bits is None:
+            bits = self._map_user(user_idx)
+            self.users[user_idx] = bits
+        unpacked = np.unpackbits(bits)[:self._store.chunk_minutes]
+        unpacked[positions] = 1
+        bits[:] = np.packbits(unpacked)
+
+    def user_active(self, user_idx : int, start : int, end : int) -> np.ndarray:
+        bits = self.users.get(user_idx)
+        if bits is None:
+            return np.zeros(end-start, dtype=np.uint8)
+        first_byte = start >> 3
+        unpacked = np.unpackbits(bits[first_byte:(end+7) >> 3])
+        return unpacked[start-first_byte*8:end-first_byte*8]
+
+
+class ChunkedHistoryStore:
+    """Per-minute history of one workstation, split in memory-mapped chunks.
+
+    Minutes are identified by their epoch minute (int(timestamp//60)). Chunk c covers
+    minutes [c*chunk_minutes, (c+1)*chunk_minutes) and is a fixed-layout file holding
+    all the columns one after the other, plus one bit-packed file per user active in
+    it. Writing a minute only dirties the pages holding it and the kernel takes care
+    of writing them back. Chunks are mapped on first access and unmapped in LRU order,
+    so memory stays bounded however long the history grows.
+    """
+    COLUMNS = (("activity", np.bool_),
+               ("monitored", np.bool_))
+
+    def __init__(self, folder : str,
+                       chunk_minutes : int = CHUNK_MINUTES,
+                       max_mapped_chunks : int = 8):
+        self.folder = folder
+        self.chunk_minutes = chunk_minutes
+        self._max_mapped_chunks = max_mapped_chunks
+        self._column_offsets : dict[str, int] = {}
+        offset = 0
+        for name, dtype in self.COLUMNS:
+            self._column_offsets[name] = offset
+            offset += chunk_minutes*np.dtype(dtype).itemsize
+        self._chunk_size = offset
+        self._chunks : collections.OrderedDict[int, HistoryChunk] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(folder, exist_ok=True)
+        self._layout_file = os.path.join(folder, "layout.yaml")
+        self._users_file = os.path.join(folder, "users.yaml")
+        self.is_new = not os.path.isfile(self._layout_file)
+        if self.is_new:
+            self._write_yaml(self._layout_file, self._layout())
+        else:
+            with open(self._layout_file) as f:
+                layout = yaml.safe_load(f)
+            if layout.get("version") == 1:
+                self._migrate_v1(layout)
+            elif layout.get("version") == 2:
+                self._migrate_v2(layout)
+            elif layout != self._layout():
+                raise ValueError(f"Unsupported history layout in {self.folder}: {layout}")
+
+    def _layout(self) -> dict:
+        return {"version" : HISTORY_LAYOUT_VERSION,
+                "chunk_minutes" : self.chunk_minutes,
+                "columns" : {name : np.dtype(dtype).str for name, dtype in self.COLUMNS},
+                "user_columns" : "packed_bits"}
+
+    @staticmethod
+    def _write_yaml(filepath : str, content):
+        with open(filepath+".tmp", "w") as f:
+            yaml.dump(content, f)
+        os.replace(filepath+".tmp", filepath)
+
+    def _chunk_path(self, chunk_id : int) -> str:
+        return os.path.join(self.folder, f"chunk_{chunk_id:08d}.bin")
+
+    def _user_bits_path(self, chunk_id : int, user_idx : int) -> str:
+        return os.path.join(self.folder, f"chunk_{chunk_id:08d}_user_{user_idx:05d}.bits")
+
+    def chunk_ids(self) -> list[int]:
+        return sorted(int(f[len("chunk_"):-len(".bin")]) for f in os.listdir(self.folder)
+                      if f.startswith("chunk_") and f.endswith(".bin"))
+
+    def get_chunk(self, chunk_id : int, create : bool = False) -> HistoryChunk | None:
+        with self._lock:
+            if chunk_id in self._chunks:
+                self._chunks.move_to_end(chunk_id)
+                return self._chunks[chunk_id]
+            path = self._chunk_path(chunk_id)
+            if not os.path.isfile(path):
+                if not create:
+                    return None
+                with open(path, "wb") as f:
+                    f.truncate(self._chunk_size) # sparse, zero-filled
+            raw = np.memmap(path, dtype=np.uint8, mode="r+", shape=(self._chunk_size,))
+            chunk = HistoryChunk(self, chunk_id, raw)
+            self._chunks[chunk_id] = chunk
+            while len(self._chunks) > self._max_mapped_chunks:
+                # Views handed out to readers keep their map alive until they are dropped
+                self._chunks.popitem(last=False)
+            return chunk
+
+    def write(self, minute : int, active_users : list[int] = [], **values):
+        chunk_id, pos = divmod(minute, self.chunk_minutes)
+        chunk = self.get_chunk(chunk_id, create=True)
+        for name, value in values.items():
+            chunk.columns[name][pos] = value
+        active_users = set(active_users)
+        for user_idx in active_users.union(chunk.users.keys()):
+            chunk.set_user(user_idx, pos, user_idx in active_users)
+
+    def iter_chunks(self, start_minute : int, end_minute : int):
+        """Yield (chunk_id, chunk, chunk_start, chunk_end, out_start) for the chunks overlapping [start_minute, end_minute).
+
+        chunk is None for chunks that were never written, chunk_start/chunk_end are positions in
+        the chunk and out_start is the offset of chunk_start from start_minute.
+        """
+        minute = start_minute
+        while minute < end_minute:
+            chunk_id, pos = divmod(minute, self.chunk_minutes)
+            count = min(self.chunk_minutes-pos, end_minute-minute)
+            yield chunk_id, self.get_chunk(chunk_id), pos, pos+count, minute-start_minute
+            minute += count
+
+    def read(self, column : str, start_minute : int, end_minute : int) -> np.ndarray:
+        """Values of column for the minutes in [start_minute, end_minute), zero where nothing was recorded."""
+        dtype = dict(self.COLUMNS)[column]
+        out = np.zeros(max(end_minute-start_minute, 0), dtype=dtype)
+        for _, chunk, chunk_start, chunk_end, out_start in self.iter_chunks(start_minute, end_minute):
+            if chunk is not None:
+                out[out_start:out_start+chunk_end-chunk_start] = chunk.columns[column][chunk_start:chunk_end]
+        return out
+
+    def read_users(self, user_idxs : list[int], start_minute : int, end_minute : int) -> np.ndarray:
+        """Activity of each of user_idxs in [start_minute, end_minute), as a (len(user_idxs), minutes) bool array."""
+        out = np.zeros((len(user_idxs), max(end_minute-start_minute, 0)), dtype=bool)
+        for _, chunk, chunk_start, chunk_end, out_start in self.iter_chunks(start_minute, end_minute):
+            if chunk is None:
+                continue
+            rows = [i for i, user_idx in enumerate(user_idxs) if user_idx in chunk.users]
+            if len(rows) == 0:
+                continue
+            # unpack all the users of the chunk in one call
+            first_byte = chunk_start >> 3
+            packed = np.stack([chunk.users[user_idxs[i]][first_byte:(chunk_end+7) >> 3] for i in rows])
+            unpacked = np.unpackbits(packed, axis=1)[:, chunk_start-first_byte*8:chunk_end-first_byte*8]
+            out[rows, out_start:out_start+chunk_end-chunk_start] = unpacked
+        return out
+
+    def _import_minutes(self, minutes : np.ndarray, columns : dict[str, np.ndarray]):
+        """Write the given minutes, columns["users"] holds 16 bit user masks as used by older versions."""
+        chunk_ids = minutes // self.chunk_minutes
+        for chunk_id in np.unique(chunk_ids):
+            in_chunk = chunk_ids == chunk_id
+            positions = minutes[in_chunk] - chunk_id*self.chunk_minutes
+            chunk = self.get_chunk(int(chunk_id), create=True)
+            for name, _ in self.COLUMNS:
+                chunk.columns[name][positions] = columns[name][in_chunk]
+            masks = columns["users"][in_chunk]
+            for user_idx in range(16):
+                chunk.set_user_positions(user_idx, positions[np.right_shift(masks, user_idx) & 1 != 0])
+        self.flush()
+
+    def import_minute_of_year(self, columns : dict[str, np.ndarray], reference_time : float):
+        """Import arrays indexed by minute of the (local) year, as written by older versions.
+
+        Minutes up to reference_time belong to its year, the ones after it were not yet
+        overwritten and still hold the previous year.
+        """
+        ref = datetime.datetime.fromtimestamp(reference_time)
+        year_start = epoch_minute(datetime.datetime(ref.year, 1, 1).timestamp())
+        prev_year_start = epoch_minute(datetime.datetime(ref.year-1, 1, 1).timestamp())
+        ref_idx = epoch_minute(reference_time)-year_start
+        idx = np.arange(len(columns["monitored"]))
+        in_ref_year = idx <= ref_idx
+        minutes = np.where(in_ref_year, year_start+idx, prev_year_start+idx)
+        # the previous year may be shorter than the array, drop what would spill into the next one
+        selected = np.logical_and(np.logical_or(in_ref_year, minutes < year_start),
+                                  columns["monitored"] != 0)
+        self._import_minutes(minutes[selected], {name : column[selected] for name, column in columns.items()})
+
+    def _migrate_v1(self, layout : dict):
+        """Convert the single-year layout of version 1 into chunks."""
+        columns = {}
+        reference_time = 0.0
+        for name in ("activity", "monitored", "users"):
+            path = os.path.join(self.folder, name+".bin")
+            columns[name] = np.fromfile(path, dtype=layout["columns"][name])
+            reference_time = max(reference_time, os.path.getmtime(path))
+        self.import_minute_of_year(columns, reference_time)
+        self._write_yaml(self._layout_file, self._layout())
+        for name in ("activity", "monitored", "users"):
+            os.remove(os.path.join(self.folder, name+".bin"))
+        print(f"history: converted {self.folder} to chunked layout")
+
+    def _migrate_v2(self, layout : dict):
+        """Split the 16 bit user masks of version 2 chunks into per-user bit files."""
+        n = layout["chunk_minutes"]
+        if n != self.chunk_minutes:
+            raise ValueError(f"Unsupported history layout in {self.folder}: {layout}")
+        for chunk_id in self.chunk_ids():
+            path = self._chunk_path(chunk_id)
+            data = np.fromfile(path, dtype=np.uint8)
+            with open(path+".tmp", "wb") as f:
+                f.write(data[:2*n].tobytes()) # activity and monitored are unchanged
+            os.replace(path+".tmp", path)
+            masks = data[2*n:4*n].view(layout["columns"]["users"])
+            chunk = self.get_chunk(chunk_id)
+            for user_idx in range(16):
+                positions = np.flatnonzero(np.right_shift(masks, user_idx) & 1)
+                chunk.set_user_positions(user_idx, positions)
+        self.flush()
+        self._write_yaml(self._layout_file, self._layout())
+        print(f"history: converted {self.folder} to per-user bit columns")
+
+    def load_users(self) -> dict[str,int]:
+        try:
+            with open(self._users_file) as f:
+                return yaml.safe_load(f) or {}
+        except FileNotFoundError:
+            return {}
+
+    def save_users(self, users : dict[str,int]):
+        self._write_yaml(self._users_file, dict(users))
+
+    def flush(self):
+        with self._lock:
+            maps = []
+            for chunk in self._chunks.values():
+                maps.append(chunk.raw)
+                maps.extend(chunk.users.values())
+        for raw in maps:
+            raw.flush()
+
+
+class CumulativeCounts:
+    """Prefix sums over boolean series derived from the chunks of a ChunkedHistoryStore.
+
+    For each (chunk, series) the running count cum[i] of set minutes in [0, i) is kept
+    in an LRU cache, next to a table of chunk totals. Counting any [start, end) range
+    then costs two lookups per partially covered chunk and one per fully covered chunk,
+    so a year costs about as much as an hour. Hourly/daily rollups are differences of
+    the sums at the bucket edges. Writes adjust the cached sums instead of dropping them.
+    """
+    def __init__(self, store : ChunkedHistoryStore,
+                       series_values : Callable[[HistoryChunk, str, int, int], np.ndarray],
+                       max_cached_sums : int = 32):
+        self._store = store
+        self._series_values = series_values # (chunk, series, start, end) -> 0/1 values for positions [start, end)
+        self._max_cached_sums = max_cached_sums
+        self._sums : collections.OrderedDict[tuple[int,str], np.ndarray] = collections.OrderedDict()
+        self._totals : dict[tuple[int,str], int] = {}
+        self._lock = threading.RLock()
+
+    def _cumsum(self, chunk_id : int, chunk : HistoryChunk, series : str) -> np.ndarray:
+        key = (chunk_id, series)
+        cum = self._sums.get(key)
+        if cum is not None:
+            self._sums.move_to_end(key)
+            return cum
+        n = self._store.chunk_minutes
+        cum = np.zeros(n+1, dtype=np.uint16 if n < 2**16 else np.uint32)
+        np.cumsum(self._series_values(chunk, series, 0, n), dtype=cum.dtype, out=cum[1:])
+        self._sums[key] = cum
+        self._totals[key] = int(cum[-1])
+        while len(self._sums) > self._max_cached_sums:
+            self._sums.popitem(last=False)
+        return cum
+
+    def _total(self, chunk_id : int, chunk : HistoryChunk, series : str) -> int:
+        total = self._totals.get((chunk_id, series))
+        if total is None:
+            total = int(self._cumsum(chunk_id, chunk, series)[-1])
+        return total
+
+    def on_write(self, minute : int):
+        """Must be called after each write to the store, to keep the cached sums exact."""
+        chunk_id, pos = divmod(minute, self._store.chunk_minutes)
+        with self._lock:
+            chunk = self._store.get_chunk(chunk_id)
+            for (cid, series), cum in self._sums.items():
+                if cid != chunk_id:
+                    continue
+                delta = int(self._series_values(chunk, series, pos, pos+1)[0]) - int(cum[pos+1]-cum[pos])
+                if delta > 0:
+                    cum[pos+1:] += delta
+                elif delta < 0:
+                    cum[pos+1:] -= -delta
+                self._totals[(cid, series)] += delta
+            stale = [k for k in self._totals if k[0] == chunk_id and k not in self._sums]
+            for key in stale:
+                del self._totals[key]
+
+    def count(self, series : str, start_minute : int, end_minute : int) -> int:
+        """Number of set minutes of series in [start_minute, end_minute)."""
+        total = 0
+        n = self._store.chunk_minutes
+        with self._lock:
+            for chunk_id, chunk, chunk_start, chunk_end, _ in self._store.iter_chunks(start_minute, end_minute):
+                if chunk is None:
+                    continue
+                if chunk_start == 0 and chunk_end == n:
+                    total += self._total(chunk_id, chunk, series)
+                else:
+                    cum = self._cumsum(chunk_id, chunk, series)
+                    total += int(cum[chunk_end]) - int(cum[chunk_start])
+        return total
+
+    def bucket_counts(self, series : str, start_minute : int, end_minute : int, step_minutes : int) -> np.ndarray:
+        """Counts of series over consecutive buckets of step_minutes, the last one may be shorter."""
+        edges = np.append(np.arange(start_minute, end_minute, step_minutes), end_minute)
+        cum_at_edges = np.zeros(len(edges), dtype=np.int64)
+        running = 0
+        n = self._store.chunk_minutes
+        with self._lock:
+            for chunk_id, chunk, chunk_start, chunk_end, _ in self._store.iter_chunks(start_minute, end_minute):
+                chunk_first = chunk_id*n
+                lo = np.searchsorted(edges, chunk_first+chunk_start, side="left")
+                hi = np.searchsorted(edges, chunk_first+chunk_end, side="right")
+                if chunk is None:
+                    cum_at_edges[lo:hi] = running
+                    continue
+                positions = edges[lo:hi]-chunk_first
+                if chunk_start == 0 and chunk_end == n and np.all((positions == 0) | (positions == n)):
+                    total = self._total(chunk_id, chunk, series)
+                    cum_at_edges[lo:hi] = running + np.where(positions == n, total, 0)
+                    running += total
+                else:
+                    cum = self._cumsum(chunk_id, chunk, series)
+                    cum_at_edges[lo:hi] = running + cum[positions].astype(np.int64) - int(cum[chunk_start])
+                    running += int(cum[chunk_end]) - int(cum[chunk_start])
+        return np.diff(cum_at_edges)
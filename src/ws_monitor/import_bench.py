@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+from ws_monitor.collector import COLLECTOR_ENV_VAR, CollectorServer
+from ws_monitor.rendering import PNG_ENCODER_ENV_VAR
+from ws_monitor.subscriber import Subscriber
+
+# Run in a fresh interpreter: imports the web app (as a worker does, reading from a
+# collector), then renders one activity image, reporting time and resident memory.
+CHILD_CODE = """
+import json, os, sys, time
+import psutil
+proc = psutil.Process()
+rss_0 = proc.memory_info().rss
+t0 = time.perf_counter()
+{preload}
+import ws_monitor.web_page
+import_sec = time.perf_counter()-t0
+rss_import = proc.memory_info().rss
+import numpy as np
+from ws_monitor.subscriber import WEEK_PALETTE, IDX_SEPARATOR, WEEK_IMAGE_ROW_HEIGHT
+from ws_monitor.rendering import render_day_rows_png
+day_rows = np.repeat(np.arange(7*72) % 3, 20).reshape(7, 1440).astype(np.uint8)
+t0 = time.perf_counter()
+render_day_rows_png(day_rows, WEEK_IMAGE_ROW_HEIGHT, IDX_SEPARATOR, WEEK_PALETTE)
+render_sec = time.perf_counter()-t0
+print(json.dumps({{"import_sec" : import_sec,
+                  "import_rss" : rss_import-rss_0,
+                  "first_png_sec" : render_sec,
+                  "first_png_rss" : proc.memory_info().rss-rss_0}}))
+sys.stdout.flush()
+os._exit(0)
+"""
+
+# (name, preloaded modules, PNG encoder)
+VARIANTS = (("web_page, zlib encoder", "", "zlib"),
+            ("web_page, cv2 encoder", "", "cv2"),
+            ("import cv2 + web_page (before)", "import cv2", "cv2"))
+
+def measure(preload : str, encoder : str, collector_address : str, workdir : str) -> dict:
+    env = {**os.environ,
+           COLLECTOR_ENV_VAR : collector_address,
+           PNG_ENCODER_ENV_VAR : encoder}
+    result = subprocess.run([sys.executable, "-c", CHILD_CODE.format(preload=preload)],
+                            env=env, cwd=workdir, capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        raise RuntimeError(f"measurement failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Measures the import time and resident memory of the web app, with and without OpenCV.")
+    ap.add_argument("--repeat", default=5, type=int, help="Fresh interpreters per variant, medians are reported.")
+    ap.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    args = vars(ap.parse_args())
+
+    workdir = tempfile.mkdtemp(prefix="wsmon_import_bench_")
+    address = f"ipc://{workdir}/collector.sock"
+    sub = Subscriber(f"ipc://{workdir}/publishers.sock", os.path.join(workdir, "data"))
+    CollectorServer(sub, address=address)
+
+    results = {}
+    for name, preload, encoder in VARIANTS:
+        try:
+            runs = [measure(preload, encoder, address, workdir) for _ in range(args["repeat"])]
+        except RuntimeError as e:
+            print(f"{name}: {e}")
+            continue
+        results[name] = {key : float(np.median([r[key] for r in runs])) for key in runs[0]}
+
+    if args["json"]:
+        print(json.dumps(results))
+    else:
+        print(f"{'variant':32} {'import':>10} {'RSS':>10} {'first png':>10} {'RSS':>10}")
+        for name, r in results.items():
+            print(f"{name:32} {r['import_sec']*1000:8.0f}ms {r['import_rss']/2**20:8.1f}MB"
+                  f" {r['first_png_sec']*1000:8.1f}ms {r['first_png_rss']/2**20:8.1f}MB")
+    sys.stdout.flush()
+    os._exit(0) # the subscriber threads do not stop
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+class HostIngestCounters:
+    def __init__(self):
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.processed = 0
+        self.missed = 0 # seq_num gaps, i.e. messages lost before reaching the receive stage
+        self.session_id = None
+        self.seq_num = None
+
+    def note_sequence(self, session_id, seq_num):
+        if session_id is None or seq_num is None:
+            return
+        if session_id == self.session_id and self.seq_num is not None and seq_num > self.seq_num+1:
+            self.missed += seq_num-self.seq_num-1
+        if session_id != self.session_id or self.seq_num is None or seq_num > self.seq_num:
+            self.session_id = session_id
+            self.seq_num = seq_num
+
+    def as_dict(self) -> dict:
+        return {"received" : self.received,
+                "coalesced" : self.coalesced,
+                "dropped" : self.dropped,
+                "processed" : self.processed,
+                "missed" : self.missed}
+
+
+class CoalescingIngestQueue:
+    """Hands decoded messages from the receive stage to the processing stage.
+
+    Only the latest pending message of each host is kept: a message arriving while the
+    previous one of the same host is still pending replaces it and counts as coalesced.
+    Within a publisher session the pending message is merged into the new one instead,
+    as publishers leave out the entries that did not change since their last message.
+    The queue is bounded by max_hosts, messages from further hosts are dropped. The
+    receive stage never waits on the processing stage, so a slow disk only makes the
+    processing stage skip intermediate states instead of backing up the socket.
+    """
+    def __init__(self, max_hosts : int = 1024):
+        self._max_hosts = max_hosts
+        self._cond = threading.Condition()
+        self._pending : dict[str, object] = {}
+        self._pending_sessions : dict[str, int | None] = {}
+        self._closed = False
+        self._counters : dict[str, HostIngestCounters] = {}
+        self.batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_batch_sec = 0.0
+        self.max_batch_sec = 0.0
+
+    def _host_counters(self, host : str) -> HostIngestCounters:
+        # must be called holding self._cond
+        counters = self._counters.get(host)
+        if counters is None:
+            counters = HostIngestCounters()
+            self._counters[host] = counters
+        return counters
+
+    def put(self, host : str, item, session_id : int | None = None, seq_num : int | None = None) -> bool:
+        """Queue item as the latest message of host, returns False if it was dropped."""
+        with self._cond:
+            counters = self._host_counters(host)
+            counters.received += 1
+            counters.note_sequence(session_id, seq_num)
+            if host in self._pending:
+                counters.coalesced += 1
+                pending = self._pending[host]
+                if session_id is not None and self._pending_sessions[host] == session_id and \
+                        isinstance(pending, dict) and isinstance(item, dict):
+                    item = {**pending, **item}
+            elif len(self._pending) >= self._max_hosts:
+                counters.dropped += 1
+                return False
+            self._pending[host] = item
+            self._pending_sessions[host] = session_id
+            self._cond.notify()
+            return True
+
+    def drain(self, timeout : float | None = None) -> list[tuple[str, object]]:
+        """Wait for pending messages and take all of them, oldest host first."""
+        with self._cond:
+            if len(self._pending) == 0 and not self._closed:
+                self._cond.wait(timeout=timeout)
+            batch = list(self._pending.items())
+            self._pending = {}
+            self._pending_sessions = {}
+            for host, _ in batch:
+                self._counters[host].processed += 1
+            return batch
+
+    def close(self):
+        """Make process_forever return once the pending messages are processed."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def process_forever(self, handler, timeout : float = 1.0):
+        """Processing stage loop, calls handler(host, item) for each drained message."""
+        while True:
+            batch = self.drain(timeout=timeout)
+            if len(batch) == 0:
+                if self._closed:
+                    return
+                continue
+            t0 = time.monotonic()
+            for host, item in batch:
+                try:
+                    handler(host, item)
+                except Exception as e:
+                    print(f"ingest: failed to process message from {host}: {type(e)}: {e}")
+            duration = time.monotonic()-t0
+            self.batches += 1
+            self.last_batch_size = len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.last_batch_sec = duration
+            self.max_batch_sec = max(self.max_batch_sec, duration)
+
+    def last_seq_num(self, host : str) -> int | None:
+        counters = self._counters.get(host)
+        return None if counters is None else counters.seq_num
+
+    def get_counters(self) -> dict:
+        with self._cond:
+            hosts = {host : c.as_dict() for host, c in self._counters.items()}
+            pending = len(self._pending)
+        return {"pending_hosts" : pending,
+                "batches" : self.batches,
+                "last_batch_size" : self.last_batch_size,
+                "max_batch_size" : self.max_batch_size,
+                "last_batch_sec" : self.last_batch_sec,
+                "max_batch_sec" : self.max_batch_sec,
+                "hosts" : hosts}
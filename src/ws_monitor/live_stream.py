@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import collections
+import json
+import threading
+
+_MISSING = object()
+
+class LiveHub:
+    """Fan-out of server-sent events to any number of streaming clients.
+
+    Producers publish keyed values, and a value is broadcast only when it differs
+    from the last one published under the same key. All clients wait on the same
+    condition, so an idle viewer costs a blocked waiter and nothing else. Under a
+    gevent worker the condition is cooperative and viewers do not hold OS threads.
+    """
+    def __init__(self, backlog_len : int = 1024, keepalive_sec : float = 15.0):
+        self._cond = threading.Condition()
+        self._events : collections.deque[tuple[int,str,str]] = collections.deque(maxlen=backlog_len)
+        self._latest : dict[str, tuple[int,str,str]] = {} # last event for each key, replayed to new clients
+        self._last_payload : dict[str, object] = {}
+        self._last_id = 0
+        self._keepalive_sec = keepalive_sec
+        self.clients_count = 0
+
+    def publish(self, key : str, event : str, payload, compare_value = _MISSING) -> bool:
+        """Broadcast payload, unless it equals the last one published under key.
+
+        If compare_value is given it is used for the change check instead of the payload,
+        so that fields like timestamps can be sent along without causing a push.
+        """
+        if compare_value is _MISSING:
+            compare_value = payload
+        with self._cond:
+            if self._last_payload.get(key, _MISSING) == compare_value:
+                return False
+            self._last_payload[key] = compare_value
+            self._last_id += 1
+            entry = (self._last_id, event, json.dumps(payload))
+            self._events.append(entry)
+            self._latest[key] = entry
+            self._cond.notify_all()
+            return True
+
+    def retract(self, key : str, event : str, payload) -> bool:
+        """Broadcast payload and forget key, so new clients do not get its last value."""
+        with self._cond:
+            if key not in self._last_payload:
+                return False
+            del self._last_payload[key]
+            self._latest.pop(key, None)
+            self._last_id += 1
+            self._events.append((self._last_id, event, json.dumps(payload)))
+            self._cond.notify_all()
+            return True
+
+    @staticmethod
+    def _format_event(entry : tuple[int,str,str]) -> str:
+        event_id, event, data = entry
+        return f"id: {event_id}\nevent: {event}\ndata: {data}\n\n"
+
+    def _events_after(self, cursor : int) -> list[tuple[int,str,str]]:
+        # must be called holding self._cond
+        if len(self._events) == 0 or self._events[0][0] > cursor+1:
+            # the client fell behind the backlog, resend the current state
+            return sorted(self._latest.values())
+        return [e for e in self._events if e[0] > cursor]
+
+    def stream(self, hello_payload : dict):
+        """Generator producing the text/event-stream body for one client."""
+        with self._cond:
+            self.clients_count += 1
+            pending = sorted(self._latest.values())
+            cursor = self._last_id
+        try:
+            yield self._format_event((cursor, "hello", json.dumps(hello_payload)))
+            while True:
+                for entry in pending:
+                    yield self._format_event(entry)
+                with self._cond:
+                    if self._last_id == cursor:
+                        self._cond.wait(timeout=self._keepalive_sec)
+                    pending = self._events_after(cursor) if self._last_id != cursor else None
+                    cursor = self._last_id
+                if pending is None:
+                    pending = []
+                    yield ": keepalive\n\n"
+        finally:
+            with self._cond:
+                self.clients_count -= 1
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import numpy as np
+
+METRICS = ("active", "cpu", "ram", "gpu", "vram", "disk")
+# (name, seconds per row, rows kept): an hour at 1s, a month at 1min, three years at 15min
+TIERS = (("1s", 1, 3600),
+         ("1m", 60, 31*24*60),
+         ("15m", 15*60, 3*366*24*4))
+MAX_RANGE_SEC = max(step*slots for _, step, slots in TIERS) # what the coarsest tier keeps
+NO_SAMPLE = 255
+QUANT_MAX = 254
+
+def quantise(ratio : float | None) -> int:
+    if ratio is None or ratio != ratio:
+        return NO_SAMPLE
+    return int(round(min(max(ratio, 0.0), 1.0)*QUANT_MAX))
+
+def quantise_array(ratios : np.ndarray) -> np.ndarray:
+    quantised = np.rint(np.clip(ratios, 0.0, 1.0)*QUANT_MAX)
+    return np.where(np.isnan(ratios), NO_SAMPLE, quantised).astype(np.uint8)
+
+def dequantise(values : np.ndarray) -> np.ndarray:
+    out = values.astype(np.float32)/QUANT_MAX
+    out[values == NO_SAMPLE] = np.nan
+    return out
+
+def utilization_ratios(data : dict, active : bool) -> dict[str, float | None]:
+    """The values of METRICS in a publisher message, None where the message lacks them."""
+    ratios : dict[str, float | None] = {"active" : 1.0 if active else 0.0}
+    cpu = data.get("cpu") or {}
+    ratios["cpu"] = cpu.get("cpu_utilization_ratio")
+    ratios["ram"] = cpu.get("cpu_mem_fill_ratio")
+    gpu_stats = [g.get("stats") or {} for g in (data.get("gpu") or {}).values()]
+    for metric, key, scale in (("gpu", "gpu_proc_utilization_ratio", 0.01), ("vram", "gpu_mem_fill_ratio", 1.0)):
+        values = [s[key] for s in gpu_stats if s.get(key) is not None]
+        ratios[metric] = sum(values)/len(values)*scale if len(values) > 0 else None
+    disk = (data.get("disk") or {}).get("stats") or {}
+    ratios["disk"] = disk.get("disk_usage_ratio")
+    return ratios
+
+
+class MetricTier:
+    """Ring of quantised rows, one every step_sec, in a memory-mapped file.
+
+    The first 8 bytes hold the index (time//step_sec) of the last written row. Rows
+    skipped between two writes are cleared, so a row holds either a value for its own
+    step or NO_SAMPLE.
+    """
+    def __init__(self, path : str, step_sec : int, slots : int, n_metrics : int):
+        self.step_sec = step_sec
+        self.slots = slots
+        size = 8+slots*n_metrics
+        new = not os.path.isfile(path) or os.path.getsize(path) != size
+        if new:
+            with open(path, "wb") as f:
+                f.truncate(size)
+        self._raw = np.memmap(path, dtype=np.uint8, mode="r+", shape=(size,))
+        # plain views, indexing a memmap costs several times more
+        self._last = np.asarray(self._raw[:8]).view(np.int64)
+        self.values = np.asarray(self._raw[8:]).reshape(slots, n_metrics)
+        if new:
+            self.values[:] = NO_SAMPLE
+            self._last[0] = -1
+
+    @property
+    def last_index(self) -> int:
+        return int(self._last[0])
+
+    def write(self, index : int, row : np.ndarray):
+        last = self.last_index
+        if index < last-self.slots+1:
+            return
+        if index > last:
+            if last < 0 or index-last >= self.slots:
+                self.values[:] = NO_SAMPLE
+            elif index-last > 1:
+                self.values[np.arange(last+1, index) % self.slots] = NO_SAMPLE
+            self._last[0] = index
+        self.values[index % self.slots] = row
+
+    def read(self, start_index : int, end_index : int) -> np.ndarray:
+        """Rows for [start_index, end_index), NO_SAMPLE outside of what is kept."""
+        out = np.full((max(end_index-start_index, 0), self.values.shape[1]), NO_SAMPLE, dtype=np.uint8)
+        last = self.last_index
+        lo = max(start_index, last-self.slots+1)
+        hi = min(end_index, last+1)
+        if lo < hi:
+            out[lo-start_index:hi-start_index] = self.values[np.arange(lo, hi) % self.slots]
+        return out
+
+
+class MetricHistory:
+    """Utilisation history of one host at the resolutions of TIERS.
+
+    Every sample goes to the 1s tier as is. Coarser tiers hold the mean of the samples
+    of each row, rewritten at each sample so the current row is always up to date.
+    Files are preallocated, a host costs about 0.9 MB of disk and at most as much of
+    page cache however long it runs.
+    """
+    def __init__(self, folder : str):
+        os.makedirs(folder, exist_ok=True)
+        self._tiers = [MetricTier(os.path.join(folder, f"metrics_v1_{name}.bin"), step, slots, len(METRICS))
+                       for name, step, slots in TIERS]
+        self._sums = [None]*len(TIERS) # per tier: (row index, sums, counts) of the current row
+        self._lock = threading.Lock()
+
+    def record(self, t : float, ratios : dict[str, float | None]):
+        values = np.array([np.nan if ratios.get(m) is None else ratios[m] for m in METRICS], dtype=np.float64)
+        valid = np.logical_not(np.isnan(values))
+        with self._lock:
+            for i, tier in enumerate(self._tiers):
+                index = int(t//tier.step_sec)
+                if i == 0:
+                    tier.write(index, quantise_array(values))
+                    continue
+                current = self._sums[i]
+                if current is None or current[0] != index:
+                    # resume a row written before a restart as if it was one sample
+                    existing = tier.read(index, index+1)[0]
+                    has_value = existing != NO_SAMPLE
+                    current = (index, np.where(has_value, existing/QUANT_MAX, 0.0), has_value.astype(np.float64))
+                    self._sums[i] = current
+                _, sums, counts = current
+                np.add(sums, values, out=sums, where=valid)
+                counts += valid
+                tier.write(index, quantise_array(sums/np.where(counts > 0, counts, np.nan)))
+
+    def read(self, start_t : float, end_t : float, max_points : int = 600) -> dict:
+        """Series for [start_t, end_t) from the finest tier whose span holds the range.
+
+        The range is cut to the span of the coarsest tier, so what is read never exceeds
+        the rows of a tier whenever the host last reported. Longer ranges are averaged
+        down to at most max_points points, missing samples are NaN.
+        """
+        range_sec = min(max(end_t-start_t, 0.0), MAX_RANGE_SEC)
+        start_t = end_t-range_sec
+        with self._lock:
+            tier = next((t for t in self._tiers if t.slots*t.step_sec >= range_sec), self._tiers[-1])
+            start_index = max(int(start_t//tier.step_sec), int(end_t//tier.step_sec)+1-tier.slots)
+            end_index = max(int(end_t//tier.step_sec)+1, start_index)
+            rows = tier.read(start_index, end_index)
+        values = dequantise(rows)
+        group = max(1, -(-len(values)//max_points))
+        if group > 1:
+            pad = (-len(values)) % group
+            values = np.concatenate([values, np.full((pad, len(METRICS)), np.nan, dtype=np.float32)])
+            values = values.reshape(-1, group, len(METRICS))
+            counts = np.sum(np.logical_not(np.isnan(values)), axis=1)
+            sums = np.nansum(values, axis=1)
+            values = np.divide(sums, counts, out=np.full(sums.shape, np.nan, dtype=np.float32), where=counts > 0)
+        return {"start" : start_index*tier.step_sec,
+                "step_sec" : tier.step_sec*group,
+                "series" : {m : values[:,i] for i, m in enumerate(METRICS)}}
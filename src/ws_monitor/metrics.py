@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+import bisect
+import math
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(labelnames : tuple, labelvalues : tuple, extra : str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in zip(labelnames, labelvalues)]
+    if extra:
+        parts.append(extra)
+    return "{"+",".join(parts)+"}" if len(parts) > 0 else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value : float) -> str:
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class Counter:
+    def __init__(self, name : str, help : str, labelnames : tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values : dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount : float = 1, labels : tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}" for labels, v in values]
+
+
+class Histogram:
+    """Cumulative histogram, observing costs a bisect and a short critical section."""
+    def __init__(self, name : str, help : str, labelnames : tuple = (), buckets : tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._buckets = tuple(sorted(buckets))
+        self._series : dict[tuple, list] = {} # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value : float, labels : tuple = ()):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = [0]*(len(self._buckets)+3)
+                self._series[labels] = series
+            series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, labels : tuple = ()) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            series = [(labels, list(s)) for labels, s in self._series.items()]
+        lines = []
+        for labels, s in series:
+            cumulative = 0
+            for bound, n in zip(self._buckets+(float("inf"),), s):
+                cumulative += n
+                le = "+Inf" if math.isinf(bound) else repr(bound)
+                le_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(s[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {s[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram : Histogram, labels : tuple):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter()-self._t0, self._labels)
+        return False
+
+
+class MetricsRegistry:
+    """Metrics rendered in the Prometheus text exposition format.
+
+    Values updated on hot paths are Counters and Histograms. Values that already exist
+    elsewhere (queue counters, cache hits, ...) are pulled at render time by collector
+    functions returning (name, type, help, [(labels dict, value), ...]) tuples.
+    """
+    def __init__(self, const_labels : dict | None = None):
+        self._metrics : list = []
+        self._collectors : list = []
+        self._const_labels = const_labels or {}
+
+    def counter(self, name : str, help : str, labelnames : tuple = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name : str, help : str, labelnames : tuple = (), buckets : tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, fn):
+        self._collectors.append(fn)
+
+    def _with_const_labels(self, line : str) -> str:
+        if not self._const_labels:
+            return line
+        const = ",".join(f'{k}="{_escape(v)}"' for k, v in self._const_labels.items())
+        name_end = line.find("{")
+        if name_end == -1 or name_end > line.find(" "):
+            name, rest = line.split(" ", 1)
+            return f"{name}{{{const}}} {rest}"
+        return f"{line[:name_end+1]}{const},{line[name_end+1:]}"
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            kind = "counter" if isinstance(metric, Counter) else "histogram"
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            lines.extend(self._with_const_labels(l) for l in metric.render())
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                print(f"metrics: collector {collector} failed: {type(e)}: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    names = tuple(labels.keys())
+                    lines.append(self._with_const_labels(f"{name}{_format_labels(names, tuple(labels.values()))} {_format_value(value)}"))
+        return "\n".join(lines)+"\n"
+
+
+def merge_expositions(texts : list[str]) -> str:
+    """Merge expositions of several registries, e.g. one per collector shard.
+
+    Families with the same name are printed once with the samples of every text, as
+    the format requires. Samples must already differ by label, see const_labels.
+    """
+    families : dict[str, list[str]] = {} # name -> HELP and TYPE lines, then samples
+    for text in texts:
+        current = None
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                name = line.split(" ", 3)[2]
+                if name not in families:
+                    families[name] = []
+                current = families[name]
+                if not any(l.startswith(line[:7]+name+" ") for l in current):
+                    current.append(line)
+            elif line and current is not None:
+                current.append(line)
+    lines = []
+    for family in families.values():
+        # HELP and TYPE first, they may have been appended after samples of an earlier text
+        lines.extend(sorted((l for l in family if l.startswith("# ")), key=lambda l: l[2:6] != "HELP"))
+        lines.extend(l for l in family if not l.startswith("# "))
+    return "\n".join(lines)+"\n"
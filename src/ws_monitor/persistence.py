@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import atexit
+import os
+import signal
+import threading
+import time
+from typing import Callable
+
+def close_on_sigterm(close : Callable[[], None]):
+    """Call close() when the process gets SIGTERM, then act as the previous handler did.
+
+    SIGTERM is how systemd, gunicorn and wsmon_run_flask_restarting.sh stop the server,
+    and it skips atexit handlers. Only works from the main thread.
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+    def handler(signum, frame):
+        close()
+        if callable(previous):
+            previous(signum, frame) # e.g. gunicorn's graceful shutdown
+        elif previous != signal.SIG_IGN:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+    try:
+        signal.signal(signal.SIGTERM, handler)
+    except ValueError as e:
+        print(f"persistence: cannot flush on SIGTERM: {e}")
+
+
+class WriteBehindStore:
+    """Coalesces small state files and writes them from a background thread.
+
+    Callers mark a file as dirty together with a serializer, the serializer is
+    only invoked at flush time, so any number of updates between two flushes
+    cost a single write. At most flush_period_sec of updates are lost on a crash.
+    """
+    def __init__(self, flush_period_sec : float = 5.0):
+        self._flush_period_sec = flush_period_sec
+        self._dirty_lock = threading.RLock() # reentrant for close() from a signal handler
+        self._flush_lock = threading.Lock()
+        self._flushing_thread = None # holder of _flush_lock
+        self._dirty : dict[str, Callable[[], str | bytes]] = {}
+        self._stop_event = threading.Event()
+
+        self.flush_count = 0
+        self.files_written = 0
+        self.bytes_written = 0
+        self.write_errors = 0
+        self.last_flush_sec = 0.0
+        self.max_flush_sec = 0.0
+        self.total_flush_sec = 0.0
+
+        self._worker = threading.Thread(target=self._flush_worker, daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def mark_dirty(self, filepath : str, serializer : Callable[[], str | bytes]):
+        with self._dirty_lock:
+            self._dirty[filepath] = serializer
+
+    def _write(self, filepath : str, content : str | bytes):
+        if isinstance(content, str):
+            content = content.encode("utf8")
+        tmpfile = filepath+".tmp"
+        with open(tmpfile, "wb") as f:
+            f.write(content)
+        os.replace(tmpfile, filepath)
+        self.files_written += 1
+        self.bytes_written += len(content)
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        # must be called holding self._flush_lock
+        self._flushing_thread = threading.get_ident()
+        try:
+            with self._dirty_lock:
+                dirty = self._dirty
+                self._dirty = {}
+            if len(dirty) == 0:
+                return
+            t0 = time.monotonic()
+            for filepath, serializer in dirty.items():
+                try:
+                    self._write(filepath, serializer())
+                except Exception as e:
+                    self.write_errors += 1
+                    print(f"persistence: failed to write {filepath}: {type(e)}: {e}")
+                    with self._dirty_lock:
+                        self._dirty.setdefault(filepath, serializer) # retry at next flush
+            duration = time.monotonic()-t0
+            self.flush_count += 1
+            self.last_flush_sec = duration
+            self.max_flush_sec = max(self.max_flush_sec, duration)
+            self.total_flush_sec += duration
+        finally:
+            self._flushing_thread = None
+
+    def _flush_worker(self):
+        while not self._stop_event.wait(self._flush_period_sec):
+            self.flush()
+        self.flush() # the last one, for what close() could not write itself
+
+    def close(self, timeout_sec : float = 10.0):
+        """Write the dirty files and stop the flush thread.
+
+        Runs from signal handlers, which may interrupt this very thread inside flush(), so
+        it never blocks on the flush lock: if a flush is in progress the flush thread does
+        the last one, waited for at most timeout_sec, unless the flush in progress is ours.
+        May run twice, from SIGTERM then atexit, the second time finds nothing to write.
+        """
+        self._stop_event.set()
+        if self._flush_lock.acquire(blocking=False):
+            try:
+                self._flush_locked()
+            finally:
+                self._flush_lock.release()
+        elif self._flushing_thread != threading.get_ident() and threading.current_thread() is not self._worker:
+            self._worker.join(timeout_sec)
+
+    def get_counters(self) -> dict:
+        with self._dirty_lock:
+            dirty_files = len(self._dirty)
+        return {"flush_count" : self.flush_count,
+                "files_written" : self.files_written,
+                "bytes_written" : self.bytes_written,
+                "write_errors" : self.write_errors,
+                "dirty_files" : dirty_files,
+                "last_flush_sec" : self.last_flush_sec,
+                "max_flush_sec" : self.max_flush_sec,
+                "total_flush_sec" : self.total_flush_sec}
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import os
+import pwd
+
+class ProcMemoryCollector:
+    """Per-user memory usage aggregated straight from /proc.
+
+    Each refresh of a process costs one stat() of its /proc entry, for the uid (which
+    changes with pid reuse or a setuid after fork), and one read of /proc/<pid>/statm.
+    Processes below small_rss_bytes hardly move the totals, so they are only refreshed
+    every small_refresh_ticks calls; large processes are refreshed every call. With use_pss the proportional set size is
+    read from smaps_rollup instead, which is more accurate for shared memory but costlier.
+    """
+    def __init__(self, proc_root : str = "/proc",
+                       small_rss_bytes : int = 64*1024*1024,
+                       small_refresh_ticks : int = 10,
+                       use_pss : bool = False):
+        self._proc_root = proc_root
+        self._small_rss_bytes = small_rss_bytes
+        self._small_refresh_ticks = small_refresh_ticks
+        self._use_pss = use_pss
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        self.total_memory = self._page_size*os.sysconf("SC_PHYS_PAGES")
+        self._procs : dict[int, list] = {} # pid -> [uid, mem_bytes, tick of last read]
+        self._usernames : dict[int, str] = {}
+        self._tick = 0
+        self.reads_last_tick = 0
+
+    def _username(self, uid : int) -> str:
+        name = self._usernames.get(uid)
+        if name is None:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = str(uid)
+            self._usernames[uid] = name
+        return name
+
+    def _read_memory(self, pid_dir : str) -> int:
+        if self._use_pss:
+            with open(pid_dir+"/smaps_rollup", "rb") as f:
+                for line in f:
+                    if line.startswith(b"Pss:"):
+                        return int(line.split()[1])*1024
+            return 0
+        with open(pid_dir+"/statm", "rb") as f:
+            return int(f.read().split()[1])*self._page_size
+
+    def get_memory_bytes_by_user(self) -> dict[str, int]:
+        self._tick += 1
+        reads = 0
+        seen = set()
+        with os.scandir(self._proc_root) as it:
+            for entry in it:
+                if not entry.name.isdigit():
+                    continue
+                pid = int(entry.name)
+                seen.add(pid)
+                cached = self._procs.get(pid)
+                if cached is not None and cached[1] < self._small_rss_bytes and self._tick-cached[2] < self._small_refresh_ticks:
+                    continue
+                try:
+                    uid = entry.stat().st_uid
+                    mem = self._read_memory(entry.path)
+                except (OSError, IndexError, ValueError):
+                    # process exited meanwhile, or not readable
+                    self._procs.pop(pid, None)
+                    continue
+                reads += 1
+                self._procs[pid] = [uid, mem, self._tick]
+        for pid in [pid for pid in self._procs if pid not in seen]:
+            del self._procs[pid]
+        self.reads_last_tick = reads
+
+        memory_by_uid : dict[int, int] = {}
+        for uid, mem, _ in self._procs.values():
+            memory_by_uid[uid] = memory_by_uid.get(uid, 0) + mem
+        return {self._username(uid) : mem for uid, mem in memory_by_uid.items() if mem > 0}
+
+    def get_memory_ratio_by_user(self) -> dict[str, float]:
+        return {user : used/self.total_memory for user, used in self.get_memory_bytes_by_user().items()}
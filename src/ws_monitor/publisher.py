@@ -2,6 +2,7 @@
 
 import time
 import argparse
+import collections
 import zmq
 import json
 import pynvml
@@ -9,7 +10,10 @@ import socket
 import psutil
 import subprocess
 import shutil
+import os
 from pprint import pprint
+from ws_monitor.proc_memory import ProcMemoryCollector
+from ws_monitor.wire_format import WireEncoder
 
 pynvml.nvmlInit()
 def get_gpus_infos():
@@ -68,10 +72,45 @@ def get_memory_usage_by_user_psutil():
     user_memory_percentage = {user: used / total_memory for user, used in user_memory.items()}
     return user_memory_percentage
 
+class RollingTimings:
+    """Durations of the last window_size samples.
+
+    The summary is in integer microseconds, which go through the binary wire format unchanged.
+    """
+    def __init__(self, window_size : int = 60):
+        self._durations = collections.deque(maxlen=window_size)
+
+    def add(self, duration_sec : float):
+        self._durations.append(duration_sec)
+
+    def summary(self) -> dict:
+        if len(self._durations) == 0:
+            return {"samples" : 0}
+        durations = sorted(self._durations)
+        n = len(durations)
+        return {"samples" : n,
+                "last_us" : int(self._durations[-1]*1e6),
+                "p50_us" : int(durations[n//2]*1e6),
+                "p95_us" : int(durations[min(int(n*0.95), n-1)]*1e6),
+                "max_us" : int(durations[-1]*1e6)}
+
+_proc_memory_collector = ProcMemoryCollector() if os.path.isdir("/proc/self") else None
+memory_walk_timings = RollingTimings() # the process walk is the bulk of the cpu collector
+
+def get_memory_usage_by_user():
+    t0 = time.monotonic()
+    if _proc_memory_collector is None:
+        ratios = get_memory_usage_by_user_psutil()
+    else:
+        ratios = _proc_memory_collector.get_memory_ratio_by_user()
+    memory_walk_timings.add(time.monotonic()-t0)
+    return ratios
+
 def get_cpu_infos():
+    virtual_memory = psutil.virtual_memory()
     return {    "cpu_utilization_ratio" : psutil.cpu_percent()/100,
-                "cpu_mem_fill_ratio" : psutil.virtual_memory().used / psutil.virtual_memory().total,
-                "memratio_by_user" : get_memory_usage_by_user_psutil()}
+                "cpu_mem_fill_ratio" : virtual_memory.used / virtual_memory.total,
+                "memratio_by_user" : get_memory_usage_by_user()}
 
 def get_disk_info():
     total, used, free = shutil.disk_usage("/")
@@ -96,10 +135,132 @@ def get_ip(target_host: str = "10.254.254.254"):
 
 
 
+class Collector:
+    """One entry of the published message, sampled on its own schedule.
+
+    The value is re-sampled every interval_sec. If heartbeat_sec is None it is sent in
+    every message, otherwise only when it changed or when heartbeat_sec passed since
+    it was last sent; the subscriber keeps the last value it received. A sample taking
+    longer than budget_sec doubles the interval (up to max_interval_sec, and to at least
+    min_backoff_sec so that collectors sampled at every tick back off too), which then
+    recovers towards its configured value as samples get cheap again.
+    """
+    def __init__(self, key : str, fn, interval_sec : float,
+                       heartbeat_sec : float | None = None,
+                       budget_sec : float = 0.5,
+                       max_interval_sec : float = 60.0,
+                       min_backoff_sec : float = 1.0):
+        self.key = key
+        self.fn = fn
+        self.base_interval_sec = interval_sec
+        self.interval_sec = interval_sec
+        self.heartbeat_sec = heartbeat_sec
+        self.budget_sec = budget_sec
+        self.max_interval_sec = max(max_interval_sec, interval_sec)
+        self.min_backoff_sec = min_backoff_sec
+        self.value = None
+        self.last_duration_sec = 0.0
+        self.over_budget_count = 0
+        self.timings = RollingTimings()
+        self._last_sample = float("-inf")
+        self._last_sent = float("-inf")
+        self._changed_since_sent = True
+
+    def sample_if_due(self, now : float) -> bool:
+        """Sample if the interval elapsed, return True if the value changed."""
+        if now - self._last_sample < self.interval_sec:
+            return False
+        t0 = time.monotonic()
+        value = self.fn()
+        self.last_duration_sec = time.monotonic()-t0
+        self.timings.add(self.last_duration_sec)
+        self._last_sample = now
+        if self.last_duration_sec > self.budget_sec:
+            self.over_budget_count += 1
+            self.interval_sec = min(max(self.interval_sec*2, self.min_backoff_sec), self.max_interval_sec)
+        else:
+            recovered = self.interval_sec*0.9
+            # below the backoff floor the interval is back to normal, 0.0 for the per-tick ones
+            self.interval_sec = self.base_interval_sec if recovered < self.min_backoff_sec else max(recovered, self.base_interval_sec)
+        changed = value != self.value
+        self.value = value
+        self._changed_since_sent |= changed
+        return changed
+
+    def pop_if_to_send(self, now : float) -> bool:
+        if self.heartbeat_sec is not None and not self._changed_since_sent and now - self._last_sent < self.heartbeat_sec:
+            return False
+        self._last_sent = now
+        self._changed_since_sent = False
+        return True
+
+
+class AdaptivePeriod:
+    """Publish period that backs off when ticks are expensive and tightens when activity changes."""
+    def __init__(self, base_sec : float = 1.0, min_sec : float = 0.5, max_sec : float = 5.0,
+                       load_ratio : float = 0.5):
+        self.base_sec = base_sec
+        self.min_sec = min(min_sec, base_sec)
+        self.max_sec = max(max_sec, base_sec)
+        self._load_ratio = load_ratio # fraction of the period the collectors may use
+        self.period_sec = base_sec
+
+    def update(self, tick_duration_sec : float, activity_changed : bool) -> float:
+        if tick_duration_sec > self.period_sec*self._load_ratio:
+            self.period_sec = min(self.period_sec*1.5, self.max_sec)
+        elif activity_changed:
+            self.period_sec = max(self.period_sec*0.5, self.min_sec)
+        else:
+            # relax towards the base period
+            self.period_sec += (self.base_sec-self.period_sec)*0.1
+        return self.period_sec
+
+
+def utilization_signature(cpu_infos : dict | None, gpu_infos : dict | None) -> list[float]:
+    signature = []
+    if cpu_infos is not None:
+        signature.append(cpu_infos["cpu_utilization_ratio"])
+    if gpu_infos is not None:
+        signature.extend(gpu["stats"]["gpu_proc_utilization_ratio"]/100 for gpu in gpu_infos.values())
+    return signature
+
+def utilization_changed(previous : list[float], current : list[float], threshold : float = 0.2) -> bool:
+    if len(previous) != len(current):
+        return True
+    return any(abs(p-c) > threshold for p,c in zip(previous, current))
+
+def timing_summary(collectors : list[Collector], tick_timings : RollingTimings, period_sec : float) -> dict:
+    """What monitoring costs on this host, published under the "timing" key."""
+    per_collector = {}
+    for c in collectors:
+        summary = c.timings.summary()
+        summary["interval_ms"] = int(c.interval_sec*1000)
+        summary["over_budget"] = c.over_budget_count
+        per_collector[c.key] = summary
+    per_collector["cpu_memory_walk"] = memory_walk_timings.summary()
+    return {"period_ms" : int(period_sec*1000),
+            "tick" : tick_timings.summary(),
+            "collectors" : per_collector}
+
+def make_collectors(min_backoff_sec : float = 1.0) -> list[Collector]:
+    """min_backoff_sec: first interval of gpu and cpu, sampled at every tick, once they go over budget."""
+    return [Collector("hostname", socket.gethostname, interval_sec=60.0), # always sent, the subscriber needs it
+            Collector("ip", get_ip, interval_sec=30.0, heartbeat_sec=60.0),
+            Collector("gpu", get_gpus_infos, interval_sec=0.0, min_backoff_sec=min_backoff_sec),
+            Collector("cpu", get_cpu_infos, interval_sec=0.0, min_backoff_sec=min_backoff_sec),
+            Collector("disk", get_disk_info, interval_sec=30.0, heartbeat_sec=60.0)]
+
+
 def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("--server", default=None, type=str, help="Address of the aggregator server.")
     ap.add_argument("--config", default=None, type=str, help="Config file to loadConfig file to load")
+    ap.add_argument("--pub-period-sec", default=None, type=float, help="Base publish period.")
+    ap.add_argument("--min-pub-period-sec", default=None, type=float, help="Shortest publish period, used while utilization changes.")
+    ap.add_argument("--max-pub-period-sec", default=None, type=float, help="Longest publish period, used when collecting is expensive.")
+    ap.add_argument("--wire-format", default=None, choices=["binary", "json"], help="Message encoding, use json for servers predating the binary format.")
+    ap.add_argument("--keyframe-interval", default=None, type=int, help="Messages between two full binary frames.")
+    ap.add_argument("--timing-period-sec", default=None, type=float, help="How often the collector timing summary is refreshed.")
     args = vars(ap.parse_args())
 
     if args["config"] is not None:
@@ -110,12 +271,20 @@ def main() -> None:
             args = conf
     if args["server"] is None:
         args["server"] = "tcp://127.0.0.1:9452"
+    for key, default in (("pub_period_sec", 1.0), ("min_pub_period_sec", 0.5), ("max_pub_period_sec", 5.0),
+                         ("wire_format", "binary"), ("keyframe_interval", 30),
+                         ("timing_period_sec", 10.0)):
+        if args.get(key) is None:
+            args[key] = default
 
     pprint(f"Publisher config:")
     pprint(args)
 
     system_state_topic = b'system_stats'
-    pub_period_sec = 1.0
+    period = AdaptivePeriod(base_sec=args["pub_period_sec"],
+                            min_sec=args["min_pub_period_sec"],
+                            max_sec=args["max_pub_period_sec"])
+    collectors = make_collectors(min_backoff_sec=args["pub_period_sec"])
     ctx = zmq.Context()
     s = ctx.socket(zmq.PUB)
     s.connect(args["server"])
@@ -126,6 +295,11 @@ def main() -> None:
 
     session_id = int(time.time()*1000) # millisecond time
     seq_num = 0
+    encoder = WireEncoder(session_id, keyframe_interval=args["keyframe_interval"]) if args["wire_format"] == "binary" else None
+    last_utilization = []
+    tick_timings = RollingTimings()
+    timing = None
+    last_timing_update = float("-inf")
 
     while True:
         try:
@@ -133,21 +307,40 @@ def main() -> None:
             data = {}
             data["session_id"] = session_id
             data["seq_num"] = seq_num
-            data["hostname"] = socket.gethostname()
-            data["ip"] = get_ip()
-            data["gpu"] = get_gpus_infos()
-            data["cpu"] = get_cpu_infos()
-            data["disk"] = get_disk_info()
-
-            msg = json.dumps(data)
-            s.send_multipart([system_state_topic, msg.encode("utf8")])
+            durations = {}
+            for collector in collectors:
+                tc = time.monotonic()
+                collector.sample_if_due(t0)
+                durations[collector.key] = time.monotonic()-tc
+                # binary deltas already leave out unchanged values
+                if encoder is not None or collector.pop_if_to_send(t0):
+                    data[collector.key] = collector.value
+            # refreshed only now and then, so that it doesn't make every delta larger
+            timing_due = t0 - last_timing_update >= args["timing_period_sec"]
+            if timing_due:
+                timing = timing_summary(collectors, tick_timings, period.period_sec)
+                last_timing_update = t0
+            if timing is not None and (encoder is not None or timing_due):
+                data["timing"] = timing
+            values = {c.key : c.value for c in collectors}
+            utilization = utilization_signature(values["cpu"], values["gpu"])
+            activity_changed = utilization_changed(last_utilization, utilization)
+            last_utilization = utilization
+
+            if encoder is not None:
+                s.send_multipart([system_state_topic] + encoder.encode(seq_num, data))
+            else:
+                s.send_multipart([system_state_topic, json.dumps(data).encode("utf8")])
             # short wait so we don't hog the cpu
             tf = time.monotonic()
+            tick_timings.add(tf-t0)
+            pub_period_sec = period.update(tf-t0, activity_changed)
             sleep_duration = pub_period_sec-(tf-t0)
             if sleep_duration > 0:
                 time.sleep(sleep_duration)
             else:
-                print(f"Warning: publisher is too slow, took {tf-t0:.3f}s)")
+                slowest = max(durations, key=durations.get)
+                print(f"Warning: publisher is too slow, took {tf-t0:.3f}s (slowest collector: {slowest}, {durations[slowest]:.3f}s)")
             seq_num += 1
         except KeyboardInterrupt:
             print(f"Received SIGINT")
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import collections
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+
+def _png_chunk(chunk_type : bytes, data : bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type+data))
+
+def png_bit_depth(colors : int) -> int:
+    """Smallest PNG bit depth indexing the given number of palette colors."""
+    for depth in (1, 2, 4):
+        if colors <= 1 << depth:
+            return depth
+    return 8
+
+def pack_row(row : bytes, depth : int) -> bytes:
+    """Pack a row of palette indices (one byte each) to depth bits per pixel, most significant first."""
+    if depth == 8:
+        return row
+    per_byte = 8//depth
+    values = np.frombuffer(row, dtype=np.uint8)
+    values = np.concatenate([values, np.zeros((-len(values)) % per_byte, dtype=np.uint8)]).reshape(-1, per_byte)
+    shifts = np.arange(8-depth, -1, -depth, dtype=np.uint8)
+    return np.bitwise_or.reduce(values << shifts, axis=1).astype(np.uint8).tobytes()
+
+def encode_indexed_png(rows : list[bytes], width : int, palette_rgb : np.ndarray, compression_level : int = 6) -> bytes:
+    """Encode a palette PNG from its rows of palette indices, one bytes object per row.
+
+    Rows are passed as bytes so that repeated rows can share the same object and the
+    full-size image never needs to be materialised as an array. Each distinct row object
+    is packed once, at the smallest bit depth of the palette, and a row repeating the
+    previous one is written with the Up filter, i.e. as zeros that compress to nothing.
+    """
+    palette = np.asarray(palette_rgb, dtype=np.uint8)
+    depth = png_bit_depth(len(palette))
+    header = struct.pack(">IIBBBBB", width, len(rows), depth, 3, 0, 0, 0) # indexed color
+    repeated = b"\x02"+bytes(-(-width*depth//8)) # filter type 2 (Up), no differences
+    packed : dict[int, bytes] = {}
+    filtered = []
+    previous = None
+    for row in rows:
+        if row is previous:
+            filtered.append(repeated)
+            continue
+        data = packed.get(id(row))
+        if data is None:
+            data = b"\x00"+pack_row(row, depth) # filter type 0 (None)
+            packed[id(row)] = data
+        filtered.append(data)
+        previous = row
+    return (b"\x89PNG\r\n\x1a\n"
+            + _png_chunk(b"IHDR", header)
+            + _png_chunk(b"PLTE", palette.tobytes())
+            + _png_chunk(b"IDAT", zlib.compress(b"".join(filtered), compression_level))
+            + _png_chunk(b"IEND", b""))
+
+def encode_indexed_png_cv2(rows : list[bytes], width : int, palette_rgb : np.ndarray, compression_level : int = 6) -> bytes:
+    """Same image as encode_indexed_png, as an RGB PNG encoded by OpenCV (imported at the first call)."""
+    import cv2
+    indices = np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(len(rows), width)
+    image = np.asarray(palette_rgb, dtype=np.uint8)[:, ::-1][indices] # OpenCV wants BGR
+    ok, encoded = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, min(compression_level, 9)])
+    if not ok:
+        raise RuntimeError("cv2.imencode failed")
+    return encoded.tobytes()
+
+# Encoders of palette images, selected with WSMONITOR_PNG_ENCODER. Encoders take
+# (rows, width, palette_rgb, compression_level) and return the PNG file as bytes.
+PNG_ENCODER_ENV_VAR = "WSMONITOR_PNG_ENCODER"
+PNG_ENCODERS = {"zlib" : encode_indexed_png,
+                "cv2" : encode_indexed_png_cv2}
+_png_encoder = encode_indexed_png
+
+def set_png_encoder(name : str):
+    global _png_encoder
+    if name not in PNG_ENCODERS:
+        raise ValueError(f"Unknown PNG encoder '{name}', available: {', '.join(PNG_ENCODERS)}")
+    _png_encoder = PNG_ENCODERS[name]
+
+set_png_encoder(os.environ.get(PNG_ENCODER_ENV_VAR, "zlib"))
+
+def expand_day_rows(day_rows : np.ndarray, row_height : int, separator_index : int) -> list[bytes]:
+    """Rows of an image showing each row of day_rows as a band of row_height pixels, framed by separator lines."""
+    separator = bytes([separator_index])*day_rows.shape[1]
+    rows = []
+    for day_row in day_rows:
+        row = day_row.astype(np.uint8).tobytes()
+        rows.append(separator)
+        rows.extend([row]*(row_height-2))
+        rows.append(separator)
+    return rows
+
+def render_day_rows_png(day_rows : np.ndarray, row_height : int, separator_index : int, palette_bgr : np.ndarray) -> bytes:
+    return _png_encoder(expand_day_rows(day_rows, row_height, separator_index),
+                        width = day_rows.shape[1],
+                        palette_rgb = np.asarray(palette_bgr)[:, ::-1])
+
+
+class RenderCache:
+    """Bounded LRU cache of encoded images.
+
+    Keys must include whatever identifies the data the image was built from (e.g. a
+    data generation), so entries never need to be invalidated, only evicted.
+    """
+    def __init__(self, max_entries : int = 256):
+        self._max_entries = max_entries
+        self._entries : collections.OrderedDict[tuple, bytes] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key : tuple) -> bytes | None:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return data
+
+    def put(self, key : tuple, data : bytes):
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_render(self, key : tuple, render) -> bytes:
+        data = self.get(key)
+        if data is None:
+            data = render() # outside of the lock, concurrent misses on the same key just render twice
+            self.put(key, data)
+        return data
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+import threading
+import time
+import zlib
+import numpy as np
+import yaml
+import zmq
+from ws_monitor.collector import CollectorClient, CollectorUnavailable
+from ws_monitor.metrics import merge_expositions
+
+DEFAULT_FANOUT_ADDRESS = "ipc:///tmp/wsmonitor_fanout.sock"
+
+def shard_of(hostname : str, count : int, assignment : dict[str, int] | None = None) -> int:
+    if assignment and hostname in assignment:
+        return assignment[hostname] % count
+    # crc32 rather than hash(), which changes from one process to the next
+    return zlib.crc32(hostname.encode("utf8")) % count
+
+def load_shard_map(path : str) -> dict[str, int]:
+    """Static assignment of hosts to shards, a YAML mapping of hostname to shard index."""
+    with open(path) as f:
+        return {str(k) : int(v) for k, v in (yaml.safe_load(f) or {}).items()}
+
+
+class HostShard:
+    """The hosts a collector shard owns: those the shard map assigns to it and, for the
+    hosts not in the map, those whose hostname hashes to it.
+
+    The history of a host stays in <data folder>/<hostname>, so with shards sharing the
+    data folder a host moved to another shard (different count or map, applied by
+    restarting all shards) keeps its history.
+    """
+    def __init__(self, index : int, count : int, assignment : dict[str, int] | None = None):
+        if not 0 <= index < count:
+            raise ValueError(f"shard index {index} out of range for {count} shards")
+        self.index = index
+        self.count = count
+        self._assignment = assignment or {}
+
+    @classmethod
+    def parse(cls, spec : str, map_path : str | None = None) -> "HostShard":
+        """From "<index>/<count>", e.g. "0/4"."""
+        index, count = (int(v) for v in spec.split("/"))
+        return cls(index, count, load_shard_map(map_path) if map_path else None)
+
+    def owns(self, hostname : str) -> bool:
+        return shard_of(hostname, self.count, self._assignment) == self.index
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+
+def run_forwarder(frontend : str, backend : str):
+    """Receive the publishers on frontend and pass every message to the shards connected to backend."""
+    ctx = zmq.Context.instance()
+    xsub = ctx.socket(zmq.XSUB)
+    xsub.setsockopt(zmq.RCVHWM, 100000)
+    xsub.bind(frontend)
+    xpub = ctx.socket(zmq.XPUB)
+    xpub.setsockopt(zmq.SNDHWM, 100000)
+    xpub.bind(backend)
+    print(f"Forwarding {frontend} to the shards on {backend}")
+    zmq.proxy(xsub, xpub)
+
+
+class ShardedCollectorClient:
+    """Stands in for a Subscriber by merging the collector shards listed in WSMONITOR_COLLECTOR.
+
+    Per-host calls go to the shard that reported the host, fleet-wide ones go to every
+    shard and are merged. A shard that does not answer is left out of fleet-wide results
+    rather than failing the page.
+    """
+    def __init__(self, addresses : list[str], timeout_sec : float = 5.0,
+                       snapshot_period_sec : float = 1.0, hosts_period_sec : float = 5.0):
+        self._shards = [CollectorClient(address, timeout_sec) for address in addresses]
+        self._snapshot_period_sec = snapshot_period_sec
+        self._hosts_period_sec = hosts_period_sec
+        self._host_shards : dict[str, CollectorClient] = {}
+        self._hosts_updated = float("-inf")
+        self._snapshot = None
+        self._snapshot_built_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def _all(self, method : str, *args, **kwargs) -> list:
+        results = []
+        for shard in self._shards:
+            try:
+                results.append(shard.call(method, *args, **kwargs))
+            except CollectorUnavailable as e:
+                print(f"sharding: leaving a shard out: {e}")
+        return results
+
+    @property
+    def boot_id(self) -> str | None:
+        boot_ids = [shard.boot_id for shard in self._shards]
+        return None if None in boot_ids else "-".join(boot_ids)
+
+    def get_boot_id(self) -> str:
+        return "-".join(shard.get_boot_id() for shard in self._shards)
+
+    def wait_boot_id(self, retry_sec : float = 2.0) -> str:
+        return "-".join(shard.wait_boot_id(retry_sec) for shard in self._shards)
+
+    def _refresh_hosts(self):
+        host_shards = {}
+        for shard in self._shards:
+            try:
+                host_shards.update({name : shard for name in shard.get_ws_names()})
+            except CollectorUnavailable as e:
+                print(f"sharding: leaving a shard out: {e}")
+        self._host_shards = host_shards
+        self._hosts_updated = time.monotonic()
+
+    def _shard_for(self, ws_name : str) -> CollectorClient | None:
+        shard = self._host_shards.get(ws_name)
+        if shard is None and time.monotonic() - self._hosts_updated > 0.5:
+            self._refresh_hosts() # maybe a new host
+            shard = self._host_shards.get(ws_name)
+        return shard
+
+    def _per_host(self, method : str, ws_name : str, *args, **kwargs):
+        shard = self._shard_for(ws_name)
+        if shard is None:
+            return None
+        return shard.call(method, ws_name, *args, **kwargs)
+
+    def get_ws_names(self) -> list[str]:
+        if time.monotonic() - self._hosts_updated > self._hosts_period_sec:
+            self._refresh_hosts()
+        return list(self._host_shards.keys())
+
+    def get_stats_recap_dictlist(self) -> list[dict]:
+        rows = [row for rows in self._all("get_stats_recap_dictlist") for row in rows]
+        return sorted(rows, key=lambda row: str(row["hostname"]))
+
+    def get_recap_snapshot(self):
+        from ws_monitor.subscriber import RecapSnapshot, recap_content_key, render_recap_text
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and time.monotonic() - self._snapshot_built_at < self._snapshot_period_sec:
+                return snapshot
+            shard_snapshots = self._all("get_recap_snapshot")
+            rows = sorted((row for s in shard_snapshots for row in s.rows), key=lambda row: str(row["hostname"]))
+            text = render_recap_text(rows)
+            content_key = recap_content_key(rows)
+            # our own generation: the shards' ones restart from zero when a shard restarts
+            generation = 0 if snapshot is None else snapshot.generation + (content_key != snapshot.content_key)
+            self._snapshot = RecapSnapshot(generation=generation, built_at=time.monotonic(), text=text, rows=rows,
+                                           wall_time=max((s.wall_time for s in shard_snapshots), default=time.time()),
+                                           content_key=content_key)
+            self._snapshot_built_at = time.monotonic()
+            return self._snapshot
+
+    def get_stats_recap(self) -> str:
+        return self.get_recap_snapshot().text
+
+    def get_stats_recap_table(self) -> str:
+        from ws_monitor.subscriber import format_recap_table
+        return format_recap_table(self.get_stats_recap_dictlist())
+
+    def get_activity_png(self, ws_name, date = None):
+        return self._per_host("get_activity_png", ws_name, date=date)
+
+    def get_activity_text(self, ws_name):
+        return self._per_host("get_activity_text", ws_name)
+
+    def get_host_timing(self, ws_name):
+        return self._per_host("get_host_timing", ws_name)
+
+    def get_metric_history(self, ws_name, range_sec, max_points = 600):
+        return self._per_host("get_metric_history", ws_name, range_sec, max_points=max_points)
+
+    def get_user_names(self, ws_name):
+        return self._per_host("get_user_names", ws_name)
+
+    def get_user_activity_png(self, ws_name, username):
+        return self._per_host("get_user_activity_png", ws_name, username)
+
+    def get_total_usage_minutes(self, since_seconds_ago) -> dict[str, int]:
+        total : dict[str, int] = {}
+        for usage in self._all("get_total_usage_minutes", since_seconds_ago):
+            for user, minutes in usage.items():
+                total[user] = total.get(user, 0) + minutes
+        return total
+
+    def get_total_usage_ratio_parts(self, since_seconds_ago) -> tuple[float, int]:
+        parts = self._all("get_total_usage_ratio_parts", since_seconds_ago)
+        return sum(p[0] for p in parts), sum(p[1] for p in parts)
+
+    def get_total_usage_ratio(self, since_seconds_ago) -> float:
+        ratio_sum, ratio_count = self.get_total_usage_ratio_parts(since_seconds_ago)
+        return ratio_sum / ratio_count if ratio_count > 0 else float("nan")
+
+    def get_history_users(self, host = None):
+        if host is not None:
+            shard = self._shard_for(host)
+            return None if shard is None else shard.get_history_users(host)
+        return sorted(set(u for users in self._all("get_history_users") for u in users))
+
+    def get_history(self, start_minute, end_minute, step_minutes, host = None, users = []):
+        if host is not None:
+            shard = self._shard_for(host)
+            return None if shard is None else shard.get_history(start_minute, end_minute, step_minutes, host=host, users=users)
+        out = np.zeros((len(range(start_minute, end_minute, step_minutes)), 2+len(users)), dtype=np.int64)
+        for values in self._all("get_history", start_minute, end_minute, step_minutes, users=users):
+            out += values
+        return out
+
+    def get_ingest_counters(self) -> dict:
+        merged = {"pending_hosts" : 0, "batches" : 0, "last_batch_size" : 0, "max_batch_size" : 0,
+                  "last_batch_sec" : 0.0, "max_batch_sec" : 0.0, "foreign_messages" : 0, "hosts" : {}}
+        for counters in self._all("get_ingest_counters"):
+            for key, value in counters.items():
+                if key == "hosts":
+                    merged["hosts"].update(value)
+                elif key.startswith("last_") or key.startswith("max_"):
+                    merged[key] = max(merged.get(key, 0), value)
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def get_startup_timings(self) -> dict:
+        # shards start in parallel, the slowest one is the startup time
+        merged = {"restored_hosts" : 0, "restore_sec" : 0.0, "history_load_sec" : 0.0}
+        for timings in self._all("get_startup_timings"):
+            merged["restored_hosts"] += timings["restored_hosts"]
+            merged["restore_sec"] = max(merged["restore_sec"], timings["restore_sec"])
+            if timings["history_load_sec"] is None or merged["history_load_sec"] is None:
+                merged["history_load_sec"] = None # still loading
+            else:
+                merged["history_load_sec"] = max(merged["history_load_sec"], timings["history_load_sec"])
+        return merged
+
+    def get_persistence_counters(self) -> dict:
+        merged : dict = {}
+        for counters in self._all("get_persistence_counters"):
+            for key, value in counters.items():
+                if key.startswith("last_") or key.startswith("max_"):
+                    merged[key] = max(merged.get(key, 0), value)
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def get_metrics_text(self) -> str:
+        return merge_expositions(self._all("get_metrics_text"))
+
+    # resource requests are lab-wide, the first shard keeps them
+    def add_resource_request(self, user : str) -> str:
+        return self._shards[0].add_resource_request(user)
+
+    def get_resource_requests(self) -> list[dict]:
+        return self._shards[0].get_resource_requests()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import threading
+
+def _apply(counts : dict, items : tuple, sign : int):
+    for key, n in items:
+        value = counts.get(key, 0) + sign*n
+        if value != 0:
+            counts[key] = value
+        else:
+            counts.pop(key, None)
+
+
+class SlidingWindowCounts:
+    """Per-key counts over the last minutes, for a few fixed window lengths.
+
+    Contributions are added for an epoch minute. The minute enters the windows when
+    advance() moves their end (exclusive) past it and leaves each window as many minutes
+    later as the window is long. Both only touch the keys of that minute, so reading a
+    window costs the same whatever its length. Past minutes are kept in a ring of
+    interned ((key, n), ...) tuples, which repeat from one minute to the next.
+    """
+    def __init__(self, window_minutes : tuple[int, ...], end_minute : int, max_interned : int = 4096):
+        self.window_minutes = tuple(sorted(window_minutes))
+        self._ring_size = self.window_minutes[-1]+1
+        self._ring : list[tuple] = [()]*self._ring_size
+        self._pending : dict[int, dict] = {} # minutes not in the windows yet
+        self._counts : dict[int, dict] = {w : {} for w in self.window_minutes}
+        self._end = end_minute
+        self._interned : dict[tuple, tuple] = {}
+        self._max_interned = max_interned
+        self._lock = threading.RLock()
+        self.generation = 0 # incremented when a minute already inside the windows changes
+
+    def _intern(self, items : tuple) -> tuple:
+        interned = self._interned.get(items)
+        if interned is None:
+            if len(self._interned) >= self._max_interned:
+                self._interned = {}
+            self._interned[items] = items
+            interned = items
+        return interned
+
+    def add(self, minute : int, contributions : dict):
+        """Add contributions ({key : n}) to minute, which may already be inside the windows."""
+        with self._lock:
+            if minute >= self._end:
+                pending = self._pending.setdefault(minute, {})
+                for key, n in contributions.items():
+                    pending[key] = pending.get(key, 0) + n
+                return
+            if minute < self._end - self.window_minutes[-1]:
+                return # already out of every window
+            slot = minute % self._ring_size
+            merged = dict(self._ring[slot])
+            for key, n in contributions.items():
+                merged[key] = merged.get(key, 0) + n
+            self._ring[slot] = self._intern(tuple(sorted(merged.items())))
+            items = tuple(contributions.items())
+            for w in self.window_minutes:
+                if minute >= self._end - w:
+                    _apply(self._counts[w], items, +1)
+            self.generation += 1
+
+    def advance(self, end_minute : int):
+        """Move the end of the windows to end_minute, if it is later than the current one."""
+        with self._lock:
+            if end_minute <= self._end:
+                return
+            if end_minute - self._end > self._ring_size:
+                # everything recorded left the windows, only the last ring_size minutes matter
+                self._ring = [()]*self._ring_size
+                self._counts = {w : {} for w in self.window_minutes}
+                self._end = end_minute - self._ring_size
+                self._pending = {m : c for m, c in self._pending.items() if m >= self._end}
+            for minute in range(self._end, end_minute):
+                pending = self._pending.pop(minute, None)
+                entering = self._intern(tuple(sorted(pending.items()))) if pending else ()
+                # the slot held minute-ring_size, which already left the longest window
+                self._ring[minute % self._ring_size] = entering
+                for w in self.window_minutes:
+                    _apply(self._counts[w], entering, +1)
+                    _apply(self._counts[w], self._ring[(minute-w) % self._ring_size], -1)
+            self._end = end_minute
+
+    def counts(self, window_minutes : int, end_minute : int | None = None) -> dict:
+        """Counts over [end_minute-window_minutes, end_minute), advancing the windows first."""
+        with self._lock:
+            if end_minute is not None:
+                self.advance(end_minute)
+            return dict(self._counts[window_minutes])
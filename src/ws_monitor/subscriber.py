@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 
 import zmq
+try:
+    from gevent import monkey
+    if monkey.is_module_patched("threading"):
+        # Running inside a gevent worker: a blocking recv would stall every greenlet
+        import zmq.green as zmq
+except ImportError:
+    pass
 import argparse
 import threading
 import json
@@ -10,6 +17,14 @@ import os
 import numpy as np
 import datetime
 import pickle
+from ws_monitor.persistence import WriteBehindStore
+from ws_monitor.history_store import ChunkedHistoryStore, CumulativeCounts, HistoryChunk, epoch_minute
+from ws_monitor.rendering import RenderCache, render_day_rows_png
+from ws_monitor.sliding_window import SlidingWindowCounts
+from ws_monitor.metric_history import MAX_RANGE_SEC, MetricHistory, utilization_ratios
+from ws_monitor.ingest import CoalescingIngestQueue
+from ws_monitor.metrics import Histogram, MetricsRegistry
+from ws_monitor.wire_format import WireDecoder, WireFormatError, decode_header
 
 def strike(text):
     result = ''
@@ -25,30 +40,39 @@ light_gray   = np.array([240, 235, 245])
 dark_gray    = np.array([189, 172, 164])
 almost_white = np.array([230, 226, 225])
 
+# Palette of the week activity images (BGR), indexed by the values below
+WEEK_PALETTE = np.array([almost_white, pastel_green, punch_red, dark_gray], dtype=np.uint8)
+IDX_UNMONITORED = 0
+IDX_IDLE = 1
+IDX_ACTIVE = 2
+IDX_SEPARATOR = 3
+WEEK_IMAGE_ROW_HEIGHT = 40
+USER_IMAGE_ROW_HEIGHT = 20
+# windows of the daily/weekly load shown in the recap, kept as running counts
+HOST_LOAD_WINDOWS_MIN = (24*60, 7*24*60)
+
 class UsageStats:
-    def __init__(self, filepath : str, wsname : str):
+    def __init__(self, filepath : str, wsname : str, on_write = None):
         # self._weekly_minute_activity = np.zeros(60*24*7, dtype = np.bool8) # For each minute a flag for when the computer was active
         # self._weekly_minute_monitored    = np.zeros(60*24*7, dtype = np.bool8) # For each minute a flag for when the computer was being monitored
         self._wsname = wsname
-        self._yearly_minute_activity = np.zeros(60*24*366, dtype = bool) # For each minute a flag for when the computer was active
-        self._yearly_minute_monitored    = np.zeros(60*24*366, dtype = bool) # For each minute a flag for when the computer was being monitored
-        self._yearly_minute_active_users = np.zeros(60*24*366, dtype = np.uint16) # Active users for each minute (mask)
-
         self._users : dict[str,int] = {}
+        self._on_write = on_write # called with (minute, is_active, active_users) after each written minute
 
         filepath = filepath+".npz" if not filepath.endswith(".npz") else filepath
-        self._filepath = filepath
-        self._last_save = 0
+        self._filepath = filepath # legacy pickle file, only used for migration
+        self._history_folder = os.path.join(os.path.dirname(filepath), "history")
         self._last_save_minute = 0
-        self._save_freq_sec = 60
+        self.generation = 0 # incremented at each write, identifies the data images were rendered from
         self._load()
+        self._load_windows_lock = threading.RLock()
+        self._init_load_windows(epoch_minute(time.time()))
 
     def get_timestamp_idx(self, t : float):
-        dt = datetime.datetime.fromtimestamp(t)
-        return int((t-datetime.datetime.fromisoformat(f"{dt.year}-01-01").timestamp())/60)
+        return epoch_minute(t)
     
     def get_datetime_idx(self, t : datetime.datetime):        
-        return int((t.timestamp()-datetime.datetime.fromisoformat(f"{t.year}-01-01").timestamp())/60)
+        return epoch_minute(t.timestamp())
 
     def update(self, is_active : bool, active_users : list[str] = []):
         dt = datetime.datetime.now()
@@ -56,121 +80,138 @@ class UsageStats:
         # print(f"{self._wsname}: usage update")
         if idx_minute == self._last_save_minute:
             return
-        for u in active_users:
-            if u not in self._users:
-                self._users[u] = len(self._users)
+        new_users = [u for u in active_users if u not in self._users]
+        if len(new_users) > 0:
+            # replaced rather than extended, readers iterate it without locking
+            users = dict(self._users)
+            for u in new_users:
+                users[u] = len(users)
+            self._users = users
+            self._store.save_users(self._users)
         active_user_ids = [self._users[u] for u in active_users]
         self._last_save_minute = idx_minute
 
-        minute_from_year_start = idx_minute
-        self._yearly_minute_activity[minute_from_year_start] = is_active
-        self._yearly_minute_monitored[minute_from_year_start] = 1
-        self._yearly_minute_active_users[minute_from_year_start] = sum([1 << idx for idx in active_user_ids if idx < 16])
-        # print(f"{self._wsname}: usage update logging, is_active = {is_active}, at idx {minute_from_year_start}")
+        with self._load_windows_lock:
+            # a reader may have advanced the load windows past this minute at the rollover,
+            # before it was written: then it entered them as unmonitored and is added now
+            late = idx_minute < self._load_windows_end
+            # Writes go straight to the memory-mapped chunks, the kernel writes the dirty pages back
+            self._store.write(idx_minute,
+                              active_users = active_user_ids,
+                              activity = is_active,
+                              monitored = 1)
+            self._counts.on_write(idx_minute)
+            self.generation += 1
+            if late:
+                self._add_late_minute(idx_minute)
+            else:
+                self._advance_load_windows(idx_minute)
+        if self._on_write is not None:
+            self._on_write(idx_minute, is_active, active_users)
+        # print(f"{self._wsname}: usage update logging, is_active = {is_active}, at idx {idx_minute}")
 
         # minute_from_week_start = dt.weekday()*24*60 + dt.hour*60 + dt.minute
         # self._weekly_minute_activity[minute_from_week_start] = is_active
         # self._weekly_minute_monitored[minute_from_week_start] = 1
 
-        if time.monotonic() - self._last_save > 60:
-            self._save()
-
-
-    def _save(self):
-        os.makedirs(os.path.dirname(self._filepath), exist_ok=True)
-        tmpfile = self._filepath+".tmp.pkl"
-        # np.savez(tmpfile,
-        #          yearly_act = self._yearly_minute_activity,
-        #          yearly_mon = self._yearly_minute_monitored,
-        #          yearly_users = self._yearly_minute_active_users,
-        #          users = self._users
-        #          )
-        with open(tmpfile,"wb") as f:
-            pickle.dump(dict(yearly_act = self._yearly_minute_activity,
-                                yearly_mon = self._yearly_minute_monitored,
-                                yearly_users = self._yearly_minute_active_users,
-                                users = self._users),
-                        file=f)
-        os.replace(tmpfile, self._filepath)
-        self._last_save = time.monotonic()
-
     def _load(self):
+        # For each epoch minute: a flag for when the computer was active, a flag for when
+        # it was being monitored and a flag for each user that was active
+        self._store = ChunkedHistoryStore(self._history_folder)
+        self._migrate_pickle()
+        self._counts = CumulativeCounts(self._store, self._series_values)
+        self._users = self._store.load_users()
+        print(f"{self._wsname}: mapped activity history at {os.path.abspath(self._history_folder)}")
+
+    @staticmethod
+    def _series_values(chunk : HistoryChunk, series : str, start : int, end : int) -> np.ndarray:
+        """Series indexed by CumulativeCounts: "monitored", "active" (and monitored) or "user:<idx>"."""
+        if series == "monitored":
+            return chunk.columns["monitored"][start:end]
+        elif series == "active":
+            return np.logical_and(chunk.columns["activity"][start:end], chunk.columns["monitored"][start:end])
+        elif series.startswith("user:"):
+            return chunk.user_active(int(series[len("user:"):]), start, end)
+        raise KeyError(f"Unknown series {series}")
+
+    def _migrate_pickle(self):
+        """One-shot import of the pickle file written by older versions, renamed once imported."""
+        if not os.path.isfile(self._filepath):
+            return
         try:
-            # d = np.load(self._filepath, allow_pickle=True)
             with open(self._filepath,"rb") as f:
                 d = pickle.load(f)
-            # if "weekly_act" in d:
-            #     self._weekly_minute_activity = d["weekly_act"]
-            # if "weekly_mon" in d:
-            #     self._weekly_minute_monitored = d["weekly_mon"]
-            self._yearly_minute_activity = d["yearly_act"]
-            self._yearly_minute_monitored = d["yearly_mon"]
-            self._yearly_minute_active_users = d["yearly_users"]
-            self._users = d["users"]
-            print(f"{self._wsname}: loaded activity from file at {os.path.abspath(self._filepath)}")
-        except OSError as e:
-            print(f"could not open file {self._filepath}, will be created")
-            pass
+            self._store.import_minute_of_year({"activity" : d["yearly_act"],
+                                               "monitored" : d["yearly_mon"],
+                                               "users" : d["yearly_users"]},
+                                              reference_time = os.path.getmtime(self._filepath))
+            self._store.save_users(d["users"])
+            os.replace(self._filepath, self._filepath+".migrated")
+            print(f"{self._wsname}: migrated activity from {os.path.abspath(self._filepath)}")
+        except (OSError, pickle.UnpicklingError, KeyError, ValueError) as e:
+            print(f"{self._wsname}: could not migrate {self._filepath}: {type(e)}: {e}")
+
+    def get_week_start_idx(self, start_date : datetime.date) -> int:
+        return self.get_datetime_idx(datetime.datetime.combine(start_date, datetime.datetime.min.time()))
+
+    def get_week_image_indices(self, start_date : datetime.date) -> np.ndarray:
+        """7x1440 image of WEEK_PALETTE indices, one row per day starting at start_date."""
+        weekstart_idx = self.get_week_start_idx(start_date)
+        weekend_idx = weekstart_idx+7*24*60
+        week_activity   = self._store.read("activity", weekstart_idx, weekend_idx)
+        week_monitoring = self._store.read("monitored", weekstart_idx, weekend_idx)
+        indices = np.where(week_activity, IDX_ACTIVE, IDX_IDLE).astype(np.uint8)
+        indices[np.logical_not(week_monitoring)] = IDX_UNMONITORED
+        return indices.reshape(7,24*60)
 
     def get_week_image(self, start_date : datetime.date):
         # print(f"Generating week image for {self._wsname} starting at {start_date}")
-        weekstart_dt = datetime.datetime.combine(start_date, datetime.datetime.min.time())
-        weekstart_idx = self.get_datetime_idx(weekstart_dt)
-        weekend_idx = weekstart_idx+7*24*60
-        week_activity   = self._yearly_minute_activity[weekstart_idx:weekend_idx]
-        week_monitoring = self._yearly_minute_monitored[weekstart_idx:weekend_idx]
-        # print(f"weekstart_dt = {weekstart_dt}")
-        # print(f"isodate = {isodate}")
-        # print(f"_yearly_minute_activity.shape = {self._yearly_minute_activity.shape}")
-        # print(f"plotting from = {weekstart_idx} to {weekend_idx}")
-        # print(f"week_activity.shape = {week_activity.shape}")
-        # print(f"week active minutes = {np.count_nonzero(week_activity)}")
-        # print(f"week monitored minutes = {np.count_nonzero(week_activity)}")
-        img = np.ones(shape=week_activity.shape+(3,), dtype=np.uint8)
-        img *= 255
-        img[week_activity]     = punch_red
-        img[np.logical_not(week_activity)] = pastel_green
-        img[np.logical_not(week_monitoring)] = almost_white
-
-        img = img.reshape(7,24*60,3)
-        r  = 40
-        img = np.repeat(img, repeats=r, axis=0)
-        # img = np.tile(img, r).reshape(r*7,24*60,3)
-        for i in range(0,img.shape[0],r):
-            img[i] = dark_gray
-            img[i+r-1] = dark_gray
-        return img
+        indices = self.get_week_image_indices(start_date)
+        r = WEEK_IMAGE_ROW_HEIGHT
+        indices = np.repeat(indices, repeats=r, axis=0)
+        indices[0::r] = IDX_SEPARATOR
+        indices[r-1::r] = IDX_SEPARATOR
+        return WEEK_PALETTE[indices]
+
+    def get_week_png(self, start_date : datetime.date) -> bytes:
+        return render_day_rows_png(self.get_week_image_indices(start_date),
+                                   row_height = WEEK_IMAGE_ROW_HEIGHT,
+                                   separator_index = IDX_SEPARATOR,
+                                   palette_bgr = WEEK_PALETTE)
     
 
-    def get_week_users_images(self):
-        dt = datetime.datetime.now()
-        row_height = 20
-        
-        weekstart_dt = datetime.datetime.combine(dt.date()-datetime.timedelta(days=6), datetime.datetime.min.time())
-        weekstart_idx = self.get_datetime_idx(weekstart_dt)
-        weekend_idx = weekstart_idx+7*24*60
-        week_monitored = self._yearly_minute_monitored[weekstart_idx:weekend_idx]
-        week_users = self._yearly_minute_active_users[weekstart_idx:weekend_idx]
+    def get_users_week_start_idx(self) -> int:
+        """Start of the week shown in the per-user images: the last 7 days, today included."""
+        return self.get_week_start_idx(datetime.datetime.now().date()-datetime.timedelta(days=6))
 
-        img_mon = np.full(fill_value=255,shape=week_monitored.shape+(3,), dtype=np.uint8)
-        img_mon[np.logical_not(week_monitored)] = light_gray
+    def get_week_users_indices(self) -> dict[str,np.ndarray]:
+        """7x1440 images of WEEK_PALETTE indices for every user, decoded in a single pass."""
+        weekstart_idx = self.get_users_week_start_idx()
+        weekend_idx = weekstart_idx+7*24*60
+        users = list(self._users.items())
+        week_users = self._store.read_users([uid for _,uid in users], weekstart_idx, weekend_idx)
+        indices = np.where(week_users, IDX_ACTIVE, IDX_IDLE).astype(np.uint8).reshape(len(users),7,24*60)
+        return {uname : indices[row] for row,(uname,_) in enumerate(users)}
 
+    def get_week_users_images(self):
+        r = USER_IMAGE_ROW_HEIGHT
         user_images : dict[str,np.ndarray]= {}
-        for uname,uid in self._users.items():
-            print(f"{uname} : {uid}")
-            week_user_active = np.bitwise_and(week_users, 1<<uid) != 0
-            img_user = img_mon.copy()
-            img_user[week_user_active] = punch_red
-            img_user[np.logical_not(week_user_active)] = pastel_green
-            img_user = img_user.reshape(7,24*60,3)
-            img_user = np.repeat(img_user, repeats=row_height, axis=0)
-            for i in range(0,img_user.shape[0],row_height):
-                img_user[i] = dark_gray
-                img_user[i+row_height-1] = dark_gray
-            user_images[uname] = img_user
-
+        for uname, indices in self.get_week_users_indices().items():
+            indices = np.repeat(indices, repeats=r, axis=0)
+            indices[0::r] = IDX_SEPARATOR
+            indices[r-1::r] = IDX_SEPARATOR
+            user_images[uname] = WEEK_PALETTE[indices]
         return user_images
-    
+
+    def get_week_users_pngs(self) -> dict[str,bytes]:
+        return {uname : render_day_rows_png(indices,
+                                            row_height = USER_IMAGE_ROW_HEIGHT,
+                                            separator_index = IDX_SEPARATOR,
+                                            palette_bgr = WEEK_PALETTE)
+                for uname, indices in self.get_week_users_indices().items()}
+
+    def get_user_names(self) -> list[str]:
+        return list(self._users.keys())
     
     
     def get_week_recap(self):
@@ -181,21 +222,19 @@ class UsageStats:
         weekstart_dt = datetime.datetime.combine(dt.date()-datetime.timedelta(days=6), datetime.datetime.min.time())
         weekstart_idx = self.get_datetime_idx(weekstart_dt)
         weekend_idx = weekstart_idx+7*24*60
-        week_activity   = self._yearly_minute_activity[weekstart_idx:weekend_idx]
-        week_monitoring = self._yearly_minute_monitored[weekstart_idx:weekend_idx]
-        week_users = self._yearly_minute_active_users[weekstart_idx:weekend_idx]
+        day_minutes = 60*24
+        daily_monitored = self._counts.bucket_counts("monitored", weekstart_idx, weekend_idx, day_minutes)
+        daily_active = self._counts.bucket_counts("active", weekstart_idx, weekend_idx, day_minutes)
+        daily_by_user = {name : self._counts.bucket_counts(f"user:{idx}", weekstart_idx, weekend_idx, day_minutes)
+                         for name,idx in self._users.items()}
 
         ret_strs = []
         for day in range(7):
-            day_minutes = 60*24
-            monitored_minutes = np.count_nonzero(week_monitoring[day*60*24:(day+1)*60*24])
-            active_minutes =    np.count_nonzero(week_activity[day*60*24:(day+1)*60*24])
-            day_users = week_users[day*60*24:(day+1)*60*24]
+            monitored_minutes = int(daily_monitored[day])
+            active_minutes =    int(daily_active[day])
             monitored_ratio = monitored_minutes/day_minutes
             active_ratio = active_minutes/monitored_minutes if monitored_minutes>0 else float("nan")
-            minutes_by_user = {}
-            for name,idx in self._users.items():
-                minutes_by_user[name] = np.count_nonzero(np.bitwise_and(day_users, 1<<idx))
+            minutes_by_user = {name : int(counts[day]) for name, counts in daily_by_user.items()}
             minutes_by_user_ratio = {n:m/monitored_minutes if monitored_minutes>0 else float("nan") for n,m in minutes_by_user.items()}
             daystr =  f"{(weekstart_dt + datetime.timedelta(days=day)).date()}: active {active_ratio*100: 4.0f}% monitored {monitored_ratio*100: 4.0f}% \t"
             daystr += f"            "+(", ".join(f"{n}:{r*100: 4.0f}%" for n,r in minutes_by_user_ratio.items()))
@@ -206,34 +245,106 @@ class UsageStats:
     def get_usage_minutes_per_user(self, from_datetime: datetime.datetime, to_datetime: datetime.datetime) -> dict[str, int]:
         """Return the per-user active minute counts for the last 7 days (inclusive)."""
         # Align to midnight six days ago so we cover exactly seven 24h blocks ending today.
-        start_idx = max(self.get_datetime_idx(from_datetime), 0)
-        end_idx = min(self.get_datetime_idx(to_datetime), self._yearly_minute_active_users.shape[0])
+        start_idx = self.get_datetime_idx(from_datetime)
+        end_idx = self.get_datetime_idx(to_datetime)
         if start_idx >= end_idx:
             return {}
 
-        week_users = self._yearly_minute_active_users[start_idx:end_idx]
         minutes_by_user: dict[str, int] = {}
         for name, idx in self._users.items():
-            if idx >= 16:
-                # Minutes cannot be represented beyond the 16 tracked bit positions.
-                minutes_by_user[name] = 0
-                continue
-            mask = 1 << idx
-            active_minutes = int(np.count_nonzero(np.bitwise_and(week_users, mask)))
-            minutes_by_user[name] = active_minutes
+            minutes_by_user[name] = self._counts.count(f"user:{idx}", start_idx, end_idx)
         return minutes_by_user
 
+    def get_history(self, start_minute : int, end_minute : int, step_minutes : int,
+                          user_columns : list[list[str]] = []) -> np.ndarray:
+        """(buckets, 2+len(user_columns)) array of monitored, active and user minutes per bucket of step_minutes.
+
+        Each user column sums the active minutes of the given usernames.
+        """
+        n = len(range(start_minute, end_minute, step_minutes))
+        out = np.zeros((n, 2+len(user_columns)), dtype=np.int64)
+        if n == 0:
+            return out
+        out[:,0] = self._counts.bucket_counts("monitored", start_minute, end_minute, step_minutes)
+        out[:,1] = self._counts.bucket_counts("active", start_minute, end_minute, step_minutes)
+        users = self._users
+        for col, usernames in enumerate(user_columns):
+            for username in usernames:
+                if username in users:
+                    out[:,2+col] += self._counts.bucket_counts(f"user:{users[username]}", start_minute, end_minute, step_minutes)
+        return out
+
+    def minute_records(self, start_minute : int, end_minute : int) -> list[tuple[int, bool, list[str]]]:
+        """(minute, is_active, active users) of each monitored minute in [start_minute, end_minute)."""
+        monitored = self._store.read("monitored", start_minute, end_minute)
+        activity = self._store.read("activity", start_minute, end_minute)
+        users = list(self._users.items())
+        user_bits = self._store.read_users([uid for _,uid in users], start_minute, end_minute)
+        names = np.array([uname for uname,_ in users], dtype=object)
+        records = []
+        for i in np.flatnonzero(monitored):
+            records.append((start_minute+int(i), bool(activity[i]), list(names[user_bits[:,i]])))
+        return records
+
+    def _init_load_windows(self, end_minute : int):
+        # window length -> [monitored minutes, active minutes] in [end-length, end)
+        self._load_windows_end = end_minute
+        self._load_windows = {w : [self._counts.count("monitored", end_minute-w, end_minute),
+                                   self._counts.count("active", end_minute-w, end_minute)]
+                              for w in HOST_LOAD_WINDOWS_MIN}
+
+    def _minute_load(self, minute : int) -> tuple[int, int]:
+        chunk_id, pos = divmod(minute, self._store.chunk_minutes)
+        chunk = self._store.get_chunk(chunk_id)
+        if chunk is None:
+            return 0, 0
+        monitored = int(chunk.columns["monitored"][pos])
+        return monitored, int(monitored and chunk.columns["activity"][pos])
+
+    def _add_late_minute(self, minute : int):
+        # must be called holding self._load_windows_lock, minute just written for the first time
+        monitored, active = self._minute_load(minute)
+        for w, counts in self._load_windows.items():
+            if minute >= self._load_windows_end - w:
+                counts[0] += monitored
+                counts[1] += active
+
+    def _advance_load_windows(self, end_minute : int):
+        """Slide the load windows to end at end_minute, each minute in or out is one read of the store."""
+        with self._load_windows_lock:
+            if end_minute <= self._load_windows_end:
+                return
+            if end_minute - self._load_windows_end > HOST_LOAD_WINDOWS_MIN[-1]:
+                self._init_load_windows(end_minute)
+                return
+            for minute in range(self._load_windows_end, end_minute):
+                monitored_in, active_in = self._minute_load(minute)
+                for w, counts in self._load_windows.items():
+                    monitored_out, active_out = self._minute_load(minute-w)
+                    counts[0] += monitored_in - monitored_out
+                    counts[1] += active_in - active_out
+            self._load_windows_end = end_minute
+
+    def get_recent_usage_ratio(self, window_minutes : int) -> float:
+        """Active ratio of the monitored minutes among the last window_minutes, the current one excluded."""
+        end = epoch_minute(time.time())
+        if window_minutes not in HOST_LOAD_WINDOWS_MIN:
+            monitored_minutes = self._counts.count("monitored", end-window_minutes, end)
+            active_monitored_minutes = self._counts.count("active", end-window_minutes, end)
+        else:
+            with self._load_windows_lock: # advanced and read as one step
+                self._advance_load_windows(end)
+                monitored_minutes, active_monitored_minutes = self._load_windows[window_minutes]
+        return active_monitored_minutes/monitored_minutes if monitored_minutes>0 else float("nan")
+
     def get_usage_ratio(self, start_datetime : datetime.datetime, end_datetime : datetime.datetime):
-        start_idx = max(self.get_datetime_idx(start_datetime),0)
-        end_idx = min(self.get_datetime_idx(end_datetime), self._yearly_minute_activity.shape[0])
+        start_idx = self.get_datetime_idx(start_datetime)
+        end_idx = self.get_datetime_idx(end_datetime)
         if start_idx >= end_idx:
             return float("nan")
         # print(f"Calculating usage ratio from {start_datetime} (idx {start_idx}) to {end_datetime} (idx {end_idx})")
-        activity   = self._yearly_minute_activity[start_idx:end_idx]
-        monitored = self._yearly_minute_monitored[start_idx:end_idx]
-        active_monitored = np.logical_and(activity, monitored)
-        monitored_minutes = np.count_nonzero(monitored)
-        active_monitored_minutes = np.count_nonzero(active_monitored)
+        monitored_minutes = self._counts.count("monitored", start_idx, end_idx)
+        active_monitored_minutes = self._counts.count("active", start_idx, end_idx)
         active_ratio = active_monitored_minutes/monitored_minutes if monitored_minutes>0 else float("nan")
         return active_ratio
 
@@ -243,24 +354,50 @@ class UsageStats:
 
 
 
+MAX_ACCOUNTED_GAP_SEC = 10
+# windows of the dashboard usage cards, kept up to date at ingest
+FLEET_USAGE_WINDOWS_MIN = (24*60, 7*24*60)
+
+class HostSnapshot:
+    """State of a host as of its last message, never modified once built.
+
+    WorkstationStatus replaces its snapshot as a whole after each update, so readers
+    get a consistent view from a single attribute read and never need a lock.
+    """
+    def __init__(self, hostname : str, data : dict, last_contact : float,
+                       active_users : list[str], active_users_in_last_minute : list[str],
+                       seq_num : int | None = None):
+        self.hostname = hostname
+        self.seq_num = seq_num
+        self.data = data
+        self.last_contact = last_contact
+        self.active_users = active_users
+        self.active_users_in_last_minute = active_users_in_last_minute
+
 class WorkstationStatus:
     def __init__(self, hostname: str,
-                 data_folder : str):
+                 data_folder : str,
+                 persistence : WriteBehindStore | None = None,
+                 stage_timings : Histogram | None = None,
+                 on_usage_minute = None,
+                 on_history_loaded = None):
+        """The histories are opened by load_history(), on_history_loaded(hostname, usage_stats)
+        is called once they are, before anything is written to them."""
         self.hostname = hostname
-        self._last_hour_activities = [0]*3600
-        self._last_hour_activities_pos = 0
+        self._persistence = persistence
+        self._stage_timings = stage_timings
         self._last_activity_update = time.monotonic()
         self._last_active_time = 0
         self._last_inactive_time = time.monotonic()
-        self.activity_seconds = 0
-        self.activity_len = 0
         self._monitored_secs = 0
         self._active_secs = 0
         self._data_folder = data_folder
         self._stats_file = self._data_folder+"/stats.yaml"
+        self._last_state_file = self._data_folder+"/last_state.json"
 
         self._last_received_sessionid = float("-inf")
         self._last_received_seqnum = float("-inf")
+        self.ignored_messages = 0
 
         os.makedirs(self._data_folder, exist_ok=True)
         try:
@@ -271,13 +408,76 @@ class WorkstationStatus:
         except FileNotFoundError as e:
             print(f"could not open file {self._stats_file}, will be created")
             pass
-        self._usage_stats = UsageStats(data_folder+"/full_stats.npy", wsname=self.hostname)
+        self._on_usage_minute = on_usage_minute
+        self._on_history_loaded = on_history_loaded
+        self._history_lock = threading.Lock()
+        self._usage_stats : UsageStats | None = None
+        self._metric_history : MetricHistory | None = None
+
+    def load_history(self):
+        """Open the usage and metric histories if not done yet. The rest of the status works
+        without them, so hosts can be listed as soon as they are found."""
+        if self._usage_stats is not None:
+            return
+        with self._history_lock:
+            if self._usage_stats is not None:
+                return
+            on_write = None
+            if self._on_usage_minute is not None:
+                on_usage_minute, hostname = self._on_usage_minute, self.hostname
+                on_write = lambda minute, is_active, active_users: on_usage_minute(hostname, minute, is_active, active_users)
+            usage_stats = UsageStats(self._data_folder+"/full_stats.npy", wsname=self.hostname, on_write=on_write)
+            self._metric_history = MetricHistory(self._data_folder+"/metrics")
+            if self._on_history_loaded is not None:
+                self._on_history_loaded(self.hostname, usage_stats)
+            self._usage_stats = usage_stats
+
+    @property
+    def history_loaded(self) -> bool:
+        return self._usage_stats is not None
+
+    @property
+    def metric_history(self) -> MetricHistory:
+        self.load_history()
+        return self._metric_history
+
+    def restore_last_state(self) -> bool:
+        """Show the host as in the last state saved by a previous run, until it sends a message."""
+        try:
+            with open(self._last_state_file) as f:
+                state = json.load(f)
+            self.data = state["data"]
+            self.last_contact = state["last_contact"]
+            self.active_users = state["active_users"]
+            self.active_users_in_last_minute = state["active_users_in_last_minute"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"could not restore {self._last_state_file}: {type(e)}: {e}")
+            return False
+        self.active_users_in_last_minute_times = {}
+        self.snapshot = HostSnapshot(self.hostname, self.data, self.last_contact,
+                                     self.active_users, self.active_users_in_last_minute)
+        return True
+
+    def _serialize_stats(self) -> str:
+        return yaml.dump({"monitored_secs" : self._monitored_secs,
+                          "active_secs" : self._active_secs})
+
+    def _serialize_last_state(self) -> str:
+        snapshot = self.snapshot
+        return json.dumps({"data" : snapshot.data,
+                           "last_contact" : snapshot.last_contact,
+                           "active_users" : snapshot.active_users,
+                           "active_users_in_last_minute" : snapshot.active_users_in_last_minute}, default=str)
 
     def _save_stats(self):
-        with open(self._stats_file+".tmp", "w") as f:
-            yaml.dump({"monitored_secs" : self._monitored_secs,
-                       "active_secs" : self._active_secs}, f)
-        os.replace(self._stats_file+".tmp", self._stats_file)
+        for filepath, serializer in ((self._stats_file, self._serialize_stats),
+                                     (self._last_state_file, self._serialize_last_state)):
+            if self._persistence is not None:
+                self._persistence.mark_dirty(filepath, serializer)
+                continue
+            with open(filepath+".tmp", "w") as f:
+                f.write(serializer())
+            os.replace(filepath+".tmp", filepath)
 
     def update_data(self, data):
         new_data_sessionid = data.get("session_id", None)
@@ -288,12 +488,17 @@ class WorkstationStatus:
         is_old_session = new_data_sessionid is not None and self._last_received_sessionid is not None and new_data_sessionid < self._last_received_sessionid
         is_old_seqnum = new_data_seqnum is not None and self._last_received_seqnum is not None and new_data_seqnum <= self._last_received_seqnum
         if is_old_session or is_old_seqnum:
+            self.ignored_messages += 1
             print(f"Ignoring old data for {self.hostname}: session_id {new_data_sessionid} (last {self._last_received_sessionid}), seq_num {new_data_seqnum} (last {self._last_received_seqnum})")            
             return self
+        same_session = new_data_sessionid == self._last_received_sessionid
         self._last_received_sessionid = new_data_sessionid
         self._last_received_seqnum = new_data_seqnum
         # print(f"Updating data for {self.hostname}: session_id {new_data_sessionid}, seq_num {new_data_seqnum}")
 
+        if same_session and hasattr(self, "data"):
+            # publishers only resend slow-changing entries when they change, keep the last ones received
+            data = {**self.data, **data}
         self.data = data
         self.last_contact = time.time()
         self.active_users = self.get_active_users()
@@ -302,31 +507,41 @@ class WorkstationStatus:
         self.active_users_in_last_minute_times = {k:v for k,v in self.active_users_in_last_minute_times.items() if time.monotonic()-v < 60}
         self.active_users_in_last_minute_times.update({u:time.monotonic() for u in self.active_users})
         self.active_users_in_last_minute = list(self.active_users_in_last_minute_times.keys())
+        t0 = time.perf_counter()
         self._update_activity()
+        t1 = time.perf_counter()
+        self.metric_history.record(self.last_contact, utilization_ratios(self.data, active = len(self.active_users) > 0))
+        self.snapshot = HostSnapshot(self.hostname, self.data, self.last_contact,
+                                     self.active_users, self.active_users_in_last_minute,
+                                     seq_num = new_data_seqnum)
+        t2 = time.perf_counter()
         self._save_stats()
+        if self._stage_timings is not None:
+            self._stage_timings.observe(t1-t0, ("activity",))
+            self._stage_timings.observe(t2-t1, ("metric_history",))
+            self._stage_timings.observe(time.perf_counter()-t2, ("save_stats",))
         return self
 
     def _update_activity(self):
         active = 1 if len(self.active_users) > 0 else 0
         curr_time = time.monotonic()
-        time_since_update = curr_time - self._last_activity_update
+        # whole seconds since the last accounted one, messages may arrive at any period
+        # and a gap longer than MAX_ACCOUNTED_GAP_SEC is considered unmonitored
+        time_since_update = int(curr_time - self._last_activity_update)
         if active:
             self._last_active_time = curr_time
         else:
             self._last_inactive_time = curr_time
         active_in_last_minute = curr_time - self._last_active_time < 60 # less than 60 seconds since last activity
         if time_since_update >= 1:
-            self._monitored_secs += 1
+            self._last_activity_update += time_since_update
+            if time_since_update > MAX_ACCOUNTED_GAP_SEC:
+                self._last_activity_update = curr_time
+                time_since_update = MAX_ACCOUNTED_GAP_SEC
+            self._monitored_secs += time_since_update
             if active_in_last_minute:
-                self._active_secs += 1
-        while time_since_update >= 1:
-            prev = self._last_hour_activities[self._last_hour_activities_pos]
-            self._last_hour_activities[self._last_hour_activities_pos]=active
-            self._last_hour_activities_pos = (self._last_hour_activities_pos + 1) % len(self._last_hour_activities)
-            self.activity_seconds += active - prev
-            self.activity_len = min(self.activity_len+1,len(self._last_hour_activities))
-            time_since_update -= 1
-        self._usage_stats.update(active_in_last_minute, active_users=self.active_users)
+                self._active_secs += time_since_update
+        self.get_usage_stats().update(active_in_last_minute, active_users=self.active_users)
     
     def get_active_users(self):
         active_users = set()
@@ -342,225 +557,533 @@ class WorkstationStatus:
         return list(active_users)
     
     
+    # the recap does not wait for the history of restored hosts, the loads show up once loaded
     def daily_activity_ratio(self):
-        return self._usage_stats.get_usage_ratio(
-            start_datetime = datetime.datetime.now()-datetime.timedelta(days=1),
-            end_datetime = datetime.datetime.now()
-        )
+        if not self.history_loaded:
+            return float("nan")
+        return self._usage_stats.get_recent_usage_ratio(24*60)
     
     def weekly_activity_ratio(self):
-        return self._usage_stats.get_usage_ratio(
-            start_datetime = datetime.datetime.now()-datetime.timedelta(weeks=1),
-            end_datetime = datetime.datetime.now()
-        )
+        if not self.history_loaded:
+            return float("nan")
+        return self._usage_stats.get_recent_usage_ratio(7*24*60)
     
     def activity_ratio(self,  since_seconds_ago: int):
+        if since_seconds_ago % 60 == 0:
+            return self.get_usage_stats().get_recent_usage_ratio(since_seconds_ago//60)
         now = datetime.datetime.now()
-        return self._usage_stats.get_usage_ratio(
+        return self.get_usage_stats().get_usage_ratio(
             start_datetime = now - datetime.timedelta(seconds=since_seconds_ago),
             end_datetime = now
         )
 
     def usage_minutes_per_user(self, since_seconds_ago: int):
         now = datetime.datetime.now()
-        return self._usage_stats.get_usage_minutes_per_user(
+        return self.get_usage_stats().get_usage_minutes_per_user(
             from_datetime = now - datetime.timedelta(seconds=since_seconds_ago),
             to_datetime = now
         )
 
-    def get_usage_stats(self):
+    def get_usage_stats(self) -> UsageStats:
+        self.load_history()
         return self._usage_stats
     
 
+def format_recap_cells(all_stats : dict) -> list[str]:
+    """Unpadded text cells of one recap row, the age is always the second cell."""
+    try:
+        return [f"{all_stats['hostname']}",
+                f"[{all_stats['age']:.1f}s]",
+                f" {all_stats['status']}",
+                f" IP:{all_stats['ip']} ",
+                f" CPU:{all_stats['CPU']} ",
+                f" RAM:{all_stats['RAM']} ",
+                f" GPU:{all_stats['GPU']}",
+                f" VRAM:{all_stats['VRAM']}",
+                f" disk:{all_stats['DISK']}",
+                f" top_mem_user:{all_stats['top_mem_user']}",
+                f" top_vram_users:{all_stats['top_vram_users']}",
+                f" dl:{all_stats['daily_load']*100:.1f}%", 
+                f" wl:{all_stats['weekly_load']*100:.1f}%",
+                f" active_users:{all_stats['active_users']}", 
+                # f" hourly:{ws_status.activity_seconds/ws_status.activity_len*100:.1f}%"
+                ]
+    except KeyError as e:
+        return [f"{all_stats['hostname']}",
+                f"[{all_stats['age']:.1f}s]",
+                f" {all_stats['status']}"]
+
+
+def render_recap_text(stats_list : list[dict]) -> str:
+    s = ""
+    lines = [format_recap_cells(all_stats) for all_stats in stats_list]
+    if len(lines)>0:
+        cols = max(len(line) for line in lines)
+        widths = [1]*cols
+        for line in lines:
+            for i,col in enumerate(line):
+                widths[i] = max(widths[i], len(col)+1)
+        for line in lines:
+            for i in range(len(line)):
+                line[i] = line[i].ljust(widths[i])
+        for line in lines:
+            l0_length = len(line[0])
+            l0_strip = line[0].strip()
+            line[0] = f'<a href="/{l0_strip}/recap">{l0_strip}</a>'+" "*(l0_length-len(l0_strip))
+            line_str = ("".join(line)+"\n")
+            s+= line_str
+    
+    return s
+
+def recap_content_key(stats_list : list[dict]) -> str:
+    """What the recap shows apart from the ages, which change at every rebuild."""
+    # repr rather than the values themselves, nan never equals itself
+    return repr([[(k, v) for k, v in row.items() if k != "age"] for row in stats_list])
+
+def format_recap_table(stats_list : list[dict]) -> str:
+    import re
+    s = ""
+    s += "<table>\n"
+    for l in stats_list:
+        l["hostname"] = f'<a href="/{l["hostname"]}">{l["hostname"]}</a>'
+        l["age"] = f"{l['age']:.1f}s"
+        l["daily_load"] = f"{l['daily_load']*100:.1f}%"
+        l["weekly_load"] = f"{l['weekly_load']*100:.1f}%"
+    columns = [col for col in stats_list[0].keys() if col != "host"]
+    s+= "<tr>" + "".join([f"<th>{col}</th>" for col in columns]) + "</tr>\n"
+    for all_stats in stats_list:
+        cells = []
+        for col in columns:
+            val = all_stats.get(col, '???')
+            val_str = str(val)
+            # Find all percentages in the cell
+            numbers = re.findall(r'(\d+(?:\.\d+)?)%', val_str)
+            highlight = any(float(n) >= 90.0 for n in numbers)
+            if highlight:
+                val_str = f'<span class="pct-high">{val_str}</span>'
+            cells.append(f"<td>{val_str}</td>")
+        s += "<tr>\n" + "\n".join(cells) + "</tr>\n"
+    s += "</table>\n"
+    return s
+
+
+class RecapSnapshot:
+    """Ready-to-serve fleet recap, rebuilt at most once per snapshot period."""
+    def __init__(self, generation : int, built_at : float, text : str, rows : list[dict], wall_time : float = 0.0,
+                       content_key : str = ""):
+        self.generation = generation
+        self.built_at = built_at # monotonic
+        self.wall_time = wall_time # time.time() at which the row ages were computed
+        self.text = text
+        self.rows = rows
+        self.content_key = content_key # the generation advances when it changes
+
+
 class Subscriber():
     def __init__(self,  server : str = "tcp://*:9452",
                         data_folder : str = "./data",
-                        user_alias_lookup: dict[str, str] | None = None):
+                        user_alias_lookup: dict[str, str] | None = None,
+                        snapshot_period_sec : float = 1.0,
+                        flush_period_sec : float = 5.0,
+                        shard = None,
+                        connect : bool = False):
+        """shard (a sharding.HostShard) limits ingest to the hosts it owns. With connect the
+        socket connects to server, a forwarder shared by the shards, instead of binding it."""
         self.data_rlock = threading.RLock()
         self.stats : dict[str,WorkstationStatus] = {}
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_period_sec = snapshot_period_sec
+        self._snapshot = RecapSnapshot(generation=0, built_at=float("-inf"), text="", rows=[])
         self._server_url = server
+        self._shard = shard
+        self._connect = connect
+        self.foreign_messages = 0 # messages of hosts owned by other shards
         self.data_folder = data_folder
         self._user_alias_lookup: dict[str, str] = user_alias_lookup or {}
+        self._persistence = WriteBehindStore(flush_period_sec=flush_period_sec)
+        self._render_cache = RenderCache()
+        self._wire_decoders : dict[str, WireDecoder] = {}
+        self._resource_requests : list[dict] = []
+        self._resource_requests_lock = threading.Lock()
+        self._fleet_usage = SlidingWindowCounts(FLEET_USAGE_WINDOWS_MIN, end_minute=epoch_minute(time.time()))
+        self._history_generation = 0 # incremented when a host is added, the only event changing past minutes
+        self._usage_memo : dict[tuple, object] = {}
+        self.metrics = MetricsRegistry(const_labels=None if shard is None else {"shard": str(shard)})
+        self._update_timings = self.metrics.histogram("wsmon_update_seconds", "Processing time of one message, lock wait included")
+        self._stage_timings = self.metrics.histogram("wsmon_update_stage_seconds", "Processing time of the stages of a message", ("stage",))
+        self._lock_waits = self.metrics.histogram("wsmon_lock_wait_seconds", "Time spent waiting to acquire a lock", ("lock",))
+        self._render_timings = self.metrics.histogram("wsmon_render_seconds", "Time to build a recap or render and encode an image", ("kind",))
+        self.metrics.add_collector(self._collect_metrics)
         print(f"Using folder {os.path.abspath(data_folder)}")
         print(f"Listening on '{server}'")
-        worker = threading.Thread(  target = self.receiver_worker,
-                                    kwargs = { "bind_to" : self._server_url})
-        worker.start()
+        self.startup_timings = {"restored_hosts" : 0, "restore_sec" : 0.0, "history_load_sec" : None}
+        self._stop_event = threading.Event()
+        restored = self._restore_hosts()
+        self._history_loader = threading.Thread(target = self._load_histories_worker, args = (restored,), daemon = True)
+        self._history_loader.start()
+        self._ingest_queue = CoalescingIngestQueue()
+        self._processor = threading.Thread(target = self._ingest_queue.process_forever,
+                                           args = (self._process_message,),
+                                           daemon = True)
+        self._processor.start()
+        self._receiver = threading.Thread(  target = self.receiver_worker,
+                                            kwargs = { "bind_to" : self._server_url},
+                                            daemon = True)
+        self._receiver.start()
 
     def update_stats(self, data : dict):
+        # data_rlock only serialises writers, readers use self.stats and the host
+        # snapshots without locking: the dict is replaced, never modified in place
+        t0 = time.perf_counter()
         with self.data_rlock:
-            if data["hostname"] not in self.stats:
-                status = WorkstationStatus(data["hostname"],
-                                           data_folder=self.data_folder+"/"+data["hostname"])
-            else:
-                status = self.stats[data["hostname"]]
-            self.stats[data["hostname"]] = status.update_data(data)
+            self._lock_waits.observe(time.perf_counter()-t0, ("data",))
+            hostname = data["hostname"]
+            status = self.stats.get(hostname)
+            if status is None:
+                status = self._new_status(hostname)
+            status.update_data(data)
+            if hostname not in self.stats:
+                # published only once it has a snapshot
+                self.stats = {**self.stats, hostname : status}
+        self._update_timings.observe(time.perf_counter()-t0)
+
+    def _new_status(self, hostname : str) -> WorkstationStatus:
+        return WorkstationStatus(hostname,
+                                 data_folder=self.data_folder+"/"+hostname,
+                                 persistence=self._persistence,
+                                 stage_timings=self._stage_timings,
+                                 on_usage_minute=self._on_usage_minute,
+                                 on_history_loaded=self._seed_fleet_usage)
+
+    def _restore_hosts(self) -> list[WorkstationStatus]:
+        """List the hosts of the data folder with their last saved state, without their history."""
+        t0 = time.monotonic()
+        try:
+            hostnames = sorted(os.listdir(self.data_folder))
+        except FileNotFoundError:
+            hostnames = []
+        restored = {}
+        for hostname in hostnames:
+            if not os.path.isfile(os.path.join(self.data_folder, hostname, "last_state.json")):
+                continue # also folders of hosts not seen since before states were saved
+            if self._shard is not None and not self._shard.owns(hostname):
+                continue
+            status = self._new_status(hostname)
+            if status.restore_last_state():
+                restored[hostname] = status
+        with self.data_rlock:
+            self.stats = {**restored, **self.stats}
+        duration = time.monotonic()-t0
+        self.startup_timings.update(restored_hosts=len(restored), restore_sec=duration)
+        print(f"Restored {len(restored)} hosts in {duration*1000:.0f} ms")
+        return list(restored.values())
+
+    def _load_histories_worker(self, statuses : list[WorkstationStatus]):
+        # hosts needed earlier (a message, a page) are loaded on demand by whoever needs them
+        t0 = time.monotonic()
+        for status in statuses:
+            if self._stop_event.is_set():
+                return
+            try:
+                status.load_history()
+            except Exception as e:
+                print(f"Failed to load the history of {status.hostname}: {type(e)}: {e}")
+        duration = time.monotonic()-t0
+        self.startup_timings["history_load_sec"] = duration
+        print(f"Loaded the history of {len(statuses)} restored hosts in {duration:.1f} s")
+
+    def get_startup_timings(self) -> dict:
+        return dict(self.startup_timings)
+
+    def _process_message(self, hostname : str, data : dict):
+        self.update_stats(data)
+
+    def get_ingest_counters(self) -> dict:
+        counters = self._ingest_queue.get_counters()
+        for hostname, wire_counters in self.get_wire_counters().items():
+            counters["hosts"].setdefault(hostname, {}).update(wire_counters)
+        for hostname, status in self.stats.items():
+            counters["hosts"].setdefault(hostname, {})["ignored_old"] = status.ignored_messages
+        counters["foreign_messages"] = self.foreign_messages
+        return counters
+
+    def _collect_metrics(self) -> list[tuple]:
+        ingest = self.get_ingest_counters()
+        hosts = ingest["hosts"]
+        families = []
+        for key, help in (("received", "Messages received"),
+                          ("coalesced", "Messages replaced by a newer one of the same host before being processed"),
+                          ("dropped", "Messages dropped because the ingest queue was full"),
+                          ("processed", "Messages processed"),
+                          ("missed", "Messages that never arrived, from seq_num gaps"),
+                          ("ignored_old", "Messages ignored because older than the last processed one"),
+                          ("keyframes", "Binary keyframes decoded"),
+                          ("deltas", "Binary delta frames decoded"),
+                          ("dropped_deltas", "Binary delta frames dropped while waiting for a keyframe")):
+            families.append((f"wsmon_messages_{key}_total", "counter", help,
+                             [({"host" : h}, c[key]) for h, c in hosts.items() if key in c]))
+        now = time.time()
+        stats = self.stats
+        families.append(("wsmon_host_last_message_age_seconds", "gauge", "Time since the last processed message of each host",
+                         [({"host" : h}, now-status.snapshot.last_contact) for h, status in stats.items()]))
+        lag = []
+        for h, status in stats.items():
+            received = self._ingest_queue.last_seq_num(h)
+            processed = status.snapshot.seq_num
+            if received is not None and processed is not None:
+                lag.append(({"host" : h}, max(received-processed, 0)))
+        families.append(("wsmon_host_seq_lag", "gauge", "Messages received but not processed yet, from seq_num", lag))
+        families.append(("wsmon_messages_foreign_total", "counter", "Messages skipped because another shard owns their host", [({}, ingest["foreign_messages"])]))
+        startup = self.startup_timings
+        families.append(("wsmon_startup_restored_hosts", "gauge", "Hosts restored from the data folder at startup", [({}, startup["restored_hosts"])]))
+        families.append(("wsmon_startup_restore_seconds", "gauge", "Time to restore the hosts of the data folder at startup", [({}, startup["restore_sec"])]))
+        if startup["history_load_sec"] is not None:
+            families.append(("wsmon_startup_history_load_seconds", "gauge", "Time to load the history of the restored hosts, in the background",
+                             [({}, startup["history_load_sec"])]))
+        families.append(("wsmon_ingest_pending_hosts", "gauge", "Hosts with a message waiting to be processed", [({}, ingest["pending_hosts"])]))
+        families.append(("wsmon_ingest_batches_total", "counter", "Batches drained by the processing stage", [({}, ingest["batches"])]))
+        families.append(("wsmon_ingest_max_batch_seconds", "gauge", "Longest batch processing time", [({}, ingest["max_batch_sec"])]))
+        persistence = self.get_persistence_counters()
+        for key, name, kind, help in (("flush_count", "flushes_total", "counter", "Flushes of the write-behind store"),
+                                      ("files_written", "files_written_total", "counter", "State files written"),
+                                      ("bytes_written", "bytes_written_total", "counter", "Bytes of state files written"),
+                                      ("write_errors", "write_errors_total", "counter", "Failed state file writes"),
+                                      ("dirty_files", "dirty_files", "gauge", "State files waiting for the next flush"),
+                                      ("total_flush_sec", "flush_seconds_total", "counter", "Time spent flushing"),
+                                      ("max_flush_sec", "max_flush_seconds", "gauge", "Longest flush")):
+            families.append((f"wsmon_persistence_{name}", kind, help, [({}, persistence[key])]))
+        tick, collector_p95 = [], []
+        for h, status in stats.items():
+            timing = status.snapshot.data.get("timing")
+            if not isinstance(timing, dict):
+                continue
+            if "p95_us" in timing.get("tick", {}):
+                tick.append(({"host" : h}, timing["tick"]["p95_us"]/1e6))
+            for name, summary in timing.get("collectors", {}).items():
+                if "p95_us" in summary:
+                    collector_p95.append(({"host" : h, "collector" : name}, summary["p95_us"]/1e6))
+        families.append(("wsmon_publisher_tick_p95_seconds", "gauge", "95th percentile of the publisher tick duration, as reported by each host", tick))
+        families.append(("wsmon_publisher_collector_p95_seconds", "gauge", "95th percentile of each publisher collector duration, as reported by each host", collector_p95))
+        families.append(("wsmon_render_cache_hits_total", "counter", "Rendered image cache hits", [({}, self._render_cache.hits)]))
+        families.append(("wsmon_render_cache_misses_total", "counter", "Rendered image cache misses", [({}, self._render_cache.misses)]))
+        return families
+
+    def get_metrics_text(self) -> str:
+        return self.metrics.render()
+
+    def get_persistence_counters(self) -> dict:
+        return self._persistence.get_counters()
+
+    def close(self, timeout_sec : float = 5.0):
+        """Stop receiving, let the threads finish what they are doing and write the pending
+        state files, before the process exits or the data folder is removed."""
+        self._stop_event.set()
+        self._receiver.join(timeout_sec)
+        self._ingest_queue.close()
+        self._processor.join(timeout_sec)
+        self._history_loader.join(timeout_sec)
+        self._persistence.close()
 
     def get_ws_names(self):
         return [name for name in self.stats.keys()]
 
+    def get_recap_snapshot(self) -> RecapSnapshot:
+        """Return the cached recap, rebuilding it if it is older than the snapshot period.
+
+        However many clients poll, the recap is recomputed at most once per period,
+        and the generation only advances when what it shows changes, ages aside: clients
+        advance the ages themselves, bumping for them would defeat the etags.
+        """
+        snapshot = self._snapshot
+        if time.monotonic() - snapshot.built_at < self._snapshot_period_sec:
+            return snapshot
+        t0 = time.perf_counter()
+        with self._snapshot_lock:
+            self._lock_waits.observe(time.perf_counter()-t0, ("snapshot",))
+            snapshot = self._snapshot
+            if time.monotonic() - snapshot.built_at < self._snapshot_period_sec:
+                return snapshot # rebuilt by another thread while we were waiting
+            wall_time = time.time()
+            with self._render_timings.time(("recap",)):
+                rows = self.get_stats_recap_dictlist()
+                text = self._render_recap_text(rows)
+                content_key = recap_content_key(rows)
+            generation = snapshot.generation if content_key == snapshot.content_key else snapshot.generation+1
+            self._snapshot = RecapSnapshot(generation=generation, built_at=time.monotonic(), text=text, rows=rows,
+                                           wall_time=wall_time, content_key=content_key)
+            return self._snapshot
+
     def get_stats_recap(self):
-        stats_list = self.get_stats_recap_dictlist()
-        s = ""
-        lines = []
-        for all_stats in stats_list:
-            try:
-                lines.append(  [f"{all_stats['hostname']}",
-                                f"[{all_stats['age']:.1f}s]",
-                                f" {all_stats['status']}",
-                                f" IP:{all_stats['ip']} ",
-                                f" CPU:{all_stats['CPU']} ",
-                                f" RAM:{all_stats['RAM']} ",
-                                f" GPU:{all_stats['GPU']}",
-                                f" VRAM:{all_stats['VRAM']}",
-                                f" disk:{all_stats['DISK']}",
-                                f" top_mem_user:{all_stats['top_mem_user']}",
-                                f" top_vram_users:{all_stats['top_vram_users']}",
-                                f" dl:{all_stats['daily_load']*100:.1f}%", 
-                                f" wl:{all_stats['weekly_load']*100:.1f}%",
-                                f" active_users:{all_stats['active_users']}", 
-                                # f" hourly:{ws_status.activity_seconds/ws_status.activity_len*100:.1f}%"
-                                ])
-            except KeyError as e:
-                lines.append(  [f"{all_stats['hostname']}",
-                                f"[{all_stats['age']:.1f}s]",
-                                f" {all_stats['status']}"])
-        
-        if len(lines)>0:
-            cols = 0
-            for line in lines:
-                if isinstance(line, list):
-                    cols = len(line)
-            widths = [1]*cols
-            for line in lines:
-                for i,col in enumerate(line):
-                    widths[i] = max(widths[i], len(col)+1)
-            for line in lines:
-                for i in range(len(line)):
-                    line[i] = line[i].ljust(widths[i])
-            for line in lines:
-                l0_length = len(line[0])
-                l0_strip = line[0].strip()
-                line[0] = f'<a href="/{l0_strip}/recap">{l0_strip}</a>'+" "*(l0_length-len(l0_strip))
-                line_str = ("".join(line)+"\n")
-                s+= line_str
-        
-        return s
+        return self.get_recap_snapshot().text
+
+    def _render_recap_text(self, stats_list : list[dict]):
+        return render_recap_text(stats_list)
         
-    def _make_link(self, hostname: str):
-        return f'<a href="/{hostname}">{hostname}</a>'
-    
     def get_stats_recap_table(self):
-        stats_list = self.get_stats_recap_dictlist()
-        s = ""
-        s += "<table>\n"
-        for l in stats_list:
-            l["hostname"] = self._make_link(l["hostname"])
-            l["age"] = f"{l['age']:.1f}s"
-            l["daily_load"] = f"{l['daily_load']*100:.1f}%"
-            l["weekly_load"] = f"{l['weekly_load']*100:.1f}%"
-        columns = stats_list[0].keys()
-        s+= "<tr>" + "".join([f"<th>{col}</th>" for col in columns]) + "</tr>\n"
-        import re
-        for all_stats in stats_list:
-            cells = []
-            for col in columns:
-                val = all_stats.get(col, '???')
-                val_str = str(val)
-                # Find all percentages in the cell
-                numbers = re.findall(r'(\d+(?:\.\d+)?)%', val_str)
-                highlight = any(float(n) >= 90.0 for n in numbers)
-                if highlight:
-                    val_str = f'<span class="pct-high">{val_str}</span>'
-                cells.append(f"<td>{val_str}</td>")
-            s += "<tr>\n" + "\n".join(cells) + "</tr>\n"
-        s += "</table>\n"
-        return s
+        return format_recap_table(self.get_stats_recap_dictlist())
 
     def get_stats_recap_dictlist(self):
-        with self.data_rlock:
-            lines = []
-            for sys, ws_status in self.stats.items():
-                age = time.time()-ws_status.last_contact
-                try:
-                    data = ws_status.data
-                    gpus = data["gpu"]
-                    top_vram_users_str = ""
-                    for gpu in gpus.values():
-                        top_vram_user = max(gpu["memratio_by_user"].items(), key=lambda user_ratio: user_ratio[1]) if len(gpu["memratio_by_user"])>0 else ("None",0.0)
-                        top_vram_users_str += top_vram_user[0]+f" {top_vram_user[1]*100:.1f}%"
-                    cpu_stats = data["cpu"]
-                    disk = data.get("disk",None)
-                    if disk is not None:
-                        disk_str = str([f"{disk['stats']['disk_usage_ratio']*100:.2f}%" for gpu in gpus.values()])
-                    else:
-                        disk_str = "N/A"
-                    top_mem_user = max(cpu_stats["memratio_by_user"].items(), key=lambda user_ratio: user_ratio[1])
-                    top_mem_user_str = top_mem_user[0]+f" {top_mem_user[1]*100:.1f}%"
-
-                    active_users = ws_status.active_users_in_last_minute
-
-                    if age > 120:
-                        status = "🟨"
-                    elif len(active_users)>0:
-                        status = "🟥"
-                    else:
-                        status = "🟩"
-                    hostname = str(data['hostname'])
-                    gpus_usage = [f"{gpu['stats']['gpu_proc_utilization_ratio']:.0f}%" for gpu in gpus.values()]
-                    if len(gpus_usage) == 1:
-                        gpus_usage = gpus_usage[0]
-                    elif len(gpus_usage) == 0:
-                        gpus_usage = "N/A"
-                    vrams_usage = [f"{gpu['stats']['gpu_mem_fill_ratio']*100:.2f}%" for gpu in gpus.values()]
-                    if len(vrams_usage) == 1:
-                        vrams_usage = vrams_usage[0]
-                    elif len(vrams_usage) == 0:
-                        vrams_usage = "N/A"
-                    all_stats = {"hostname" : hostname,
-                                 "age" : age,
-                                 "status" : status,
-                                 "ip" : data.get('ip', 'N/A'),
-                                 "CPU" : f"{cpu_stats['cpu_utilization_ratio']*100:.0f}%",
-                                 "RAM" : f"{cpu_stats['cpu_mem_fill_ratio']*100:.2f}%",
-                                 "GPU" : str(gpus_usage),
-                                 "VRAM" : str(vrams_usage),
-                                 "DISK" : disk_str,
-                                 "top_mem_user" : top_mem_user_str,
-                                 "top_vram_users" : top_vram_users_str,
-                                 "daily_load" : ws_status.daily_activity_ratio(),
-                                 "weekly_load" : ws_status.weekly_activity_ratio(),
-                                 "active_users" : active_users
-                                 }
-                    if age > 300:
-                        all_stats = {k:float("nan") if isinstance(v, (int, float, str)) else "???" for k,v in all_stats.items()}
-                    lines.append(all_stats)
-                except Exception as e:
-                    print(f"Error interpreting data from {data['hostname']}: {e}")
-                    lines.append({"hostname": sys, "status": f"🟧 ", "age": age})
-            lines.sort(key=lambda x: str(x['hostname']))
-            return lines
+        lines = []
+        for sys, ws_status in self.stats.items():
+            host = ws_status.snapshot
+            age = time.time()-host.last_contact
+            try:
+                data = host.data
+                gpus = data["gpu"]
+                top_vram_users_str = ""
+                for gpu in gpus.values():
+                    top_vram_user = max(gpu["memratio_by_user"].items(), key=lambda user_ratio: user_ratio[1]) if len(gpu["memratio_by_user"])>0 else ("None",0.0)
+                    top_vram_users_str += top_vram_user[0]+f" {top_vram_user[1]*100:.1f}%"
+                cpu_stats = data["cpu"]
+                disk = data.get("disk",None)
+                if disk is not None:
+                    disk_str = str([f"{disk['stats']['disk_usage_ratio']*100:.2f}%" for gpu in gpus.values()])
+                else:
+                    disk_str = "N/A"
+                top_mem_user = max(cpu_stats["memratio_by_user"].items(), key=lambda user_ratio: user_ratio[1])
+                top_mem_user_str = top_mem_user[0]+f" {top_mem_user[1]*100:.1f}%"
+
+                active_users = host.active_users_in_last_minute
+
+                if age > 120:
+                    status = "🟨"
+                elif len(active_users)>0:
+                    status = "🟥"
+                else:
+                    status = "🟩"
+                hostname = str(data['hostname'])
+                gpus_usage = [f"{gpu['stats']['gpu_proc_utilization_ratio']:.0f}%" for gpu in gpus.values()]
+                if len(gpus_usage) == 1:
+                    gpus_usage = gpus_usage[0]
+                elif len(gpus_usage) == 0:
+                    gpus_usage = "N/A"
+                vrams_usage = [f"{gpu['stats']['gpu_mem_fill_ratio']*100:.2f}%" for gpu in gpus.values()]
+                if len(vrams_usage) == 1:
+                    vrams_usage = vrams_usage[0]
+                elif len(vrams_usage) == 0:
+                    vrams_usage = "N/A"
+                all_stats = {"hostname" : hostname,
+                             "age" : age,
+                             "status" : status,
+                             "ip" : data.get('ip', 'N/A'),
+                             "CPU" : f"{cpu_stats['cpu_utilization_ratio']*100:.0f}%",
+                             "RAM" : f"{cpu_stats['cpu_mem_fill_ratio']*100:.2f}%",
+                             "GPU" : str(gpus_usage),
+                             "VRAM" : str(vrams_usage),
+                             "DISK" : disk_str,
+                             "top_mem_user" : top_mem_user_str,
+                             "top_vram_users" : top_vram_users_str,
+                             "daily_load" : ws_status.daily_activity_ratio(),
+                             "weekly_load" : ws_status.weekly_activity_ratio(),
+                             "active_users" : active_users
+                             }
+                if age > 300:
+                    all_stats = {k:float("nan") if isinstance(v, (int, float, str)) else "???" for k,v in all_stats.items()}
+                    all_stats["age"] = age
+                # the key of the host in self.stats, unlike the cells it is never blanked
+                all_stats["host"] = sys
+                lines.append(all_stats)
+            except Exception as e:
+                print(f"Error interpreting data from {data['hostname']}: {e}")
+                lines.append({"hostname": sys, "status": f"🟧 ", "age": age, "host": sys})
+        lines.sort(key=lambda x: str(x['hostname']))
+        return lines
 
     def get_activity_img(self, ws_name, date : datetime.date | None = None):
-        if ws_name in self.stats:
+        status = self.stats.get(ws_name)
+        if status is not None:
             if date is None:
                 date = datetime.datetime.now().date()-datetime.timedelta(days=6) # default to last 7 days
-            return self.stats[ws_name].get_usage_stats().get_week_image(date)
+            return status.get_usage_stats().get_week_image(date)
         else:
             return None
         
+    def get_activity_png(self, ws_name, date : datetime.date | None = None) -> tuple[bytes, str] | None:
+        """PNG of the week starting at date and a tag identifying its content, for use as an etag.
+
+        Weeks that are over never change and are rendered once, the current one at most
+        once per recorded minute.
+        """
+        status = self.stats.get(ws_name)
+        if status is None:
+            return None
+        if date is None:
+            date = datetime.datetime.now().date()-datetime.timedelta(days=6) # default to last 7 days
+        usage_stats = status.get_usage_stats()
+        weekstart_idx = usage_stats.get_week_start_idx(date)
+        is_past = weekstart_idx+7*24*60 <= epoch_minute(time.time())
+        generation = 0 if is_past else usage_stats.generation
+        key = (ws_name, "week", weekstart_idx, generation)
+        png = self._render_cache.get(key)
+        if png is None:
+            with self._render_timings.time(("week",)):
+                png = usage_stats.get_week_png(date)
+            self._render_cache.put(key, png)
+        return png, f"{weekstart_idx}-{generation}"
+
     def get_activity_text(self, ws_name):
-        if ws_name in self.stats:
-            return self.stats[ws_name].get_usage_stats().get_week_recap()
+        status = self.stats.get(ws_name)
+        if status is not None:
+            return status.get_usage_stats().get_week_recap()
         else:
             return None
     
+    def get_host_timing(self, ws_name) -> dict | None:
+        """Collector timing summary last published by ws_name, None for older publishers."""
+        status = self.stats.get(ws_name)
+        if status is None:
+            return None
+        return status.snapshot.data.get("timing")
+
+    def get_metric_history(self, ws_name, range_sec : float, max_points : int = 600) -> dict | None:
+        """Utilisation series of ws_name over the last range_sec, NaNs replaced by None."""
+        status = self.stats.get(ws_name)
+        if status is None:
+            return None
+        now = time.time()
+        history = status.metric_history.read(now-min(range_sec, MAX_RANGE_SEC), now, max_points=max_points)
+        history["series"] = {m : [None if v != v else round(float(v), 3) for v in values]
+                             for m, values in history["series"].items()}
+        return history
+
     def get_user_activity_images(self, ws_name):
-        if ws_name in self.stats:
-            return self.stats[ws_name].get_usage_stats().get_week_users_images()
+        status = self.stats.get(ws_name)
+        if status is not None:
+            return status.get_usage_stats().get_week_users_images()
+        else:
+            return None
+
+    def get_user_names(self, ws_name) -> list[str] | None:
+        status = self.stats.get(ws_name)
+        if status is not None:
+            return status.get_usage_stats().get_user_names()
         else:
             return None
 
+    def get_user_activity_png(self, ws_name, username) -> tuple[bytes, str] | None:
+        """PNG of the last 7 days of username on ws_name and a tag identifying its content.
+
+        On a miss the images of all the users of the host are rendered and cached
+        together, as the page requesting one of them will ask for the others too.
+        """
+        status = self.stats.get(ws_name)
+        if status is None:
+            return None
+        usage_stats = status.get_usage_stats()
+        weekstart_idx = usage_stats.get_users_week_start_idx()
+        generation = usage_stats.generation
+        key = (ws_name, "user_week", username, weekstart_idx, generation)
+        png = self._render_cache.get(key)
+        if png is None:
+            with self._render_timings.time(("user_weeks",)):
+                pngs = usage_stats.get_week_users_pngs()
+            for uname, user_png in pngs.items():
+                self._render_cache.put((ws_name, "user_week", uname, weekstart_idx, generation), user_png)
+            png = pngs.get(username)
+            if png is None:
+                return None
+        return png, f"{weekstart_idx}-{generation}"
+
     def _merge_user_aliases(self, user_tot_usage: dict[str, int]) -> dict[str, int]:
         if not self._user_alias_lookup:
             return user_tot_usage
@@ -571,45 +1094,201 @@ class Subscriber():
             merged[canonical] = merged.get(canonical, 0) + minutes
         return merged
 
+    def _usage_contributions(self, hostname : str, is_active : bool, active_users : list[str]) -> dict:
+        contributions = {("monitored", hostname) : 1}
+        if is_active:
+            contributions[("active", hostname)] = 1
+        for username in active_users:
+            key = ("user", self._user_alias_lookup.get(username, username))
+            contributions[key] = contributions.get(key, 0) + 1
+        return contributions
+
+    def _on_usage_minute(self, hostname : str, minute : int, is_active : bool, active_users : list[str]):
+        self._fleet_usage.add(minute, self._usage_contributions(hostname, is_active, active_users))
+
+    def _seed_fleet_usage(self, hostname : str, usage_stats : UsageStats):
+        """Add the recorded history of a host to the fleet windows, as soon as it is loaded."""
+        end = epoch_minute(time.time())
+        for minute, is_active, active_users in usage_stats.minute_records(end-FLEET_USAGE_WINDOWS_MIN[-1], end):
+            self._fleet_usage.add(minute, self._usage_contributions(hostname, is_active, active_users))
+        self._history_generation += 1
+
+    def _memoised_usage(self, key : tuple, compute):
+        # key holds the window in minutes, its end minute and the history generation
+        value = self._usage_memo.get(key)
+        if value is None:
+            value = compute()
+            if len(self._usage_memo) >= 64:
+                self._usage_memo = {}
+            self._usage_memo[key] = value
+        return value
+
     def get_total_usage_minutes(self, since_seconds_ago) -> dict[str, int]:
+        """Active minutes of each user (aliases merged) over the last since_seconds_ago, rounded to minutes."""
+        window = int(round(since_seconds_ago/60))
+        end = epoch_minute(time.time())
+        if window in FLEET_USAGE_WINDOWS_MIN:
+            counts = self._fleet_usage.counts(window, end_minute=end)
+            return {key[1] : n for key, n in counts.items() if key[0] == "user"}
+        return self._memoised_usage(("minutes", window, end, self._history_generation),
+                                    lambda: self._scan_total_usage_minutes(window*60))
+
+    def get_total_usage_ratio(self, since_seconds_ago) -> float:
+        """Mean active ratio of the hosts monitored over the last since_seconds_ago, rounded to minutes."""
+        ratio_sum, ratio_count = self.get_total_usage_ratio_parts(since_seconds_ago)
+        return ratio_sum / ratio_count if ratio_count > 0 else float("nan")
+
+    def get_total_usage_ratio_parts(self, since_seconds_ago) -> tuple[float, int]:
+        """Sum and count of the host ratios averaged by get_total_usage_ratio, shards add them up."""
+        window = int(round(since_seconds_ago/60))
+        end = epoch_minute(time.time())
+        if window in FLEET_USAGE_WINDOWS_MIN:
+            counts = self._fleet_usage.counts(window, end_minute=end)
+            ratios = [counts.get(("active", key[1]), 0)/n for key, n in counts.items() if key[0] == "monitored"]
+            return sum(ratios), len(ratios)
+        return self._memoised_usage(("ratio", window, end, self._history_generation),
+                                    lambda: self._scan_total_usage_ratio(window*60))
+
+    def _scan_total_usage_minutes(self, since_seconds_ago) -> dict[str, int]:
         user_tot_usage: dict[str, int] = {}
-        with self.data_rlock:
-            for ws_name, ws_status in self.stats.items():
-                ws_user_usage = ws_status.usage_minutes_per_user(since_seconds_ago=since_seconds_ago)
-                for username, minutes in ws_user_usage.items():
-                    if username not in user_tot_usage:
-                        user_tot_usage[username] = 0
-                    user_tot_usage[username] += minutes
-            user_tot_usage = self._merge_user_aliases(user_tot_usage)
+        for ws_name, ws_status in self.stats.items():
+            ws_user_usage = ws_status.usage_minutes_per_user(since_seconds_ago=since_seconds_ago)
+            for username, minutes in ws_user_usage.items():
+                if username not in user_tot_usage:
+                    user_tot_usage[username] = 0
+                user_tot_usage[username] += minutes
+        user_tot_usage = self._merge_user_aliases(user_tot_usage)
         return user_tot_usage
     
-    def get_total_usage_ratio(self, since_seconds_ago) -> float:
+    def _scan_total_usage_ratio(self, since_seconds_ago) -> tuple[float, int]:
         ratio_sum = 0.0
         ratio_count = 0
-        with self.data_rlock:
-            for ws_name, ws_status in self.stats.items():
-                active_ratio = ws_status.activity_ratio(since_seconds_ago=since_seconds_ago)
-                if not np.isnan(active_ratio):
-                    ratio_sum += active_ratio
-                    ratio_count += 1
-        total_ratio = ratio_sum / ratio_count if ratio_count > 0 else float("nan")
-        return total_ratio
+        for ws_name, ws_status in self.stats.items():
+            active_ratio = ws_status.activity_ratio(since_seconds_ago=since_seconds_ago)
+            if not np.isnan(active_ratio):
+                ratio_sum += active_ratio
+                ratio_count += 1
+        return ratio_sum, ratio_count
+
+    def get_history_users(self, host : str | None = None) -> list[str] | None:
+        """Users recorded on host, or on any host if None, with aliases merged. None if host is unknown."""
+        if host is not None:
+            status = self.stats.get(host)
+            if status is None:
+                return None
+            statuses = [status]
+        else:
+            statuses = list(self.stats.values())
+        users = set()
+        for status in statuses:
+            users.update(self._user_alias_lookup.get(u, u) for u in status.get_usage_stats().get_user_names())
+        return sorted(users)
+
+    def get_history(self, start_minute : int, end_minute : int, step_minutes : int,
+                          host : str | None = None, users : list[str] = []) -> np.ndarray | None:
+        """Activity over consecutive buckets of step_minutes in [start_minute, end_minute).
+
+        Columns are monitored minutes, active minutes and the active minutes of each of
+        users (canonical names, counting their aliases too). With host None they are summed
+        over all hosts. Counts come from the prefix sums of each host and no lock is held,
+        callers wanting long ranges ask for them a slice at a time. None if host is unknown.
+        """
+        if host is not None:
+            status = self.stats.get(host)
+            if status is None:
+                return None
+            statuses = [status]
+        else:
+            statuses = list(self.stats.values())
+        out = np.zeros((len(range(start_minute, end_minute, step_minutes)), 2+len(users)), dtype=np.int64)
+        for status in statuses:
+            usage_stats = status.get_usage_stats()
+            aliases : dict[str, list[str]] = {}
+            for username in usage_stats.get_user_names():
+                aliases.setdefault(self._user_alias_lookup.get(username, username), []).append(username)
+            out += usage_stats.get_history(start_minute, end_minute, step_minutes,
+                                           user_columns=[aliases.get(u, []) for u in users])
+        return out
+
+    def add_resource_request(self, user : str) -> str:
+        """Record that user asked for resources, returns the displayed timestamp."""
+        now = datetime.datetime.now()
+        timestamp = now.strftime("%H:%M:%S")
+        with self._resource_requests_lock:
+            self._resource_requests.append({"user": user, "timestamp": timestamp, "datetime": now})
+            if len(self._resource_requests) > 10:
+                del self._resource_requests[:-10]
+        return timestamp
+
+    def get_resource_requests(self) -> list[dict]:
+        """Resource requests of the last hour, oldest first."""
+        now = datetime.datetime.now()
+        with self._resource_requests_lock:
+            self._resource_requests = [r for r in self._resource_requests if (now-r["datetime"]).total_seconds() <= 3600]
+            return [{"user": r["user"], "timestamp": r["timestamp"]} for r in self._resource_requests]
+
+    def _decode_message(self, parts : list[bytes]) -> dict | None:
+        """Decode a received message, JSON from older publishers or a binary key/delta frame."""
+        try:
+            if len(parts) == 2:
+                return json.loads(parts[1])
+            if len(parts) == 3:
+                header = decode_header(parts[1])
+                if not self._owns(header.hostname):
+                    return None # skip decoding the body of other shards' hosts
+                decoder = self._wire_decoders.get(header.hostname)
+                if decoder is None:
+                    decoder = WireDecoder()
+                    self._wire_decoders[header.hostname] = decoder
+                return decoder.decode(header, parts[2])
+            print(f"Ignoring message with {len(parts)} parts")
+        except (WireFormatError, ValueError) as e:
+            print(f"Ignoring malformed message: {e}")
+        return None
+
+    def _owns(self, hostname : str) -> bool:
+        if self._shard is None or self._shard.owns(hostname):
+            return True
+        self.foreign_messages += 1
+        return False
+
+    def get_wire_counters(self) -> dict[str, dict]:
+        return {hostname : {"keyframes" : d.keyframes,
+                            "deltas" : d.deltas,
+                            "dropped_deltas" : d.dropped_deltas}
+                for hostname, d in list(self._wire_decoders.items())}
 
     def receiver_worker(self, bind_to : str):
         system_state_topic = b'system_stats'
         ctx = zmq.Context()
         s = ctx.socket(zmq.SUB)
-        s.bind(bind_to)
-        print(f"Listening on {bind_to}")
+        if self._connect:
+            s.connect(bind_to)
+            print(f"Receiving from {bind_to}" + ("" if self._shard is None else f" as shard {self._shard}"))
+        else:
+            s.bind(bind_to)
+            print(f"Listening on {bind_to}")
 
         s.setsockopt(zmq.SUBSCRIBE, system_state_topic)
         try:
-            while True:
-                topic, msg = s.recv_multipart()
-                data = json.loads(msg)
-                self.update_stats(data)
+            while not self._stop_event.is_set():
+                if s.poll(500) == 0:
+                    continue # check for close() now and then
+                # receive stage: only decode here, the rest happens in the processing stage
+                parts = s.recv_multipart()
+                data = self._decode_message(parts)
+                if data is None:
+                    continue
+                hostname = data.get("hostname")
+                if not isinstance(hostname, str):
+                    print(f"Ignoring message without hostname")
+                    continue
+                if len(parts) == 2 and not self._owns(hostname):
+                    continue
+                self._ingest_queue.put(hostname, data, data.get("session_id"), data.get("seq_num"))
         except KeyboardInterrupt:
             pass
+        s.close(linger=0)
 
 def main() -> None:
     ap = argparse.ArgumentParser()
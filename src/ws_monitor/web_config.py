@@ -0,0 +1,44 @@
+import os
+import yaml
+
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+CONFIG_ENV_VAR = "WSMONITOR_WEB_CONFIG"
+DEFAULT_WEB_CONFIG_PATH = os.path.join(BASE_DIR, "config", "web_config.yaml")
+
+
+def get_web_config_path() -> str:
+  return os.environ.get(CONFIG_ENV_VAR, DEFAULT_WEB_CONFIG_PATH)
+
+
+def load_web_config(config_path: str) -> dict:
+  if not os.path.isfile(config_path):
+    print(f"web_config: no config file found at {config_path}, using defaults")
+    return {}
+  try:
+    with open(config_path, "r", encoding="utf-8") as config_file:
+      return yaml.safe_load(config_file) or {}
+  except (OSError, yaml.YAMLError) as exc:
+    print(f"web_config: failed to load {config_path}: {exc}")
+    return {}
+
+
+def build_user_alias_lookup(alias_section) -> dict[str, str]:
+  lookup: dict[str, str] = {}
+  if not isinstance(alias_section, dict):
+    return lookup
+  for canonical, aliases in alias_section.items():
+    if not isinstance(canonical, str):
+      continue
+    if aliases is None:
+      normalized_aliases: list[str] = []
+    elif isinstance(aliases, str):
+      normalized_aliases = [aliases]
+    elif isinstance(aliases, (list, tuple, set)):
+      normalized_aliases = [alias for alias in aliases if isinstance(alias, str)]
+    else:
+      continue
+    for alias in normalized_aliases:
+      lookup[alias] = canonical
+    lookup.setdefault(canonical, canonical)
+  return lookup
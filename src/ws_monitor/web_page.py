@@ -1,62 +1,32 @@
 import os
 import threading
+import time
+import json
 import secrets
 import math
 import flask
 from flask import Flask, render_template, redirect, request, url_for, Response, jsonify
 # import flask_login
-import cv2
 import numpy as np
-import base64
 from datetime import datetime
 import pprint
 import yaml
-from ws_monitor.subscriber import Subscriber
+from ws_monitor.subscriber import Subscriber, format_recap_cells
+from ws_monitor.live_stream import LiveHub
+from ws_monitor.collector import COLLECTOR_ENV_VAR, CollectorClient
+from ws_monitor.metrics import MetricsRegistry
+from ws_monitor.metric_history import MAX_RANGE_SEC as MAX_METRIC_RANGE_SEC
+from ws_monitor.persistence import close_on_sigterm
+from ws_monitor.web_config import get_web_config_path, load_web_config, build_user_alias_lookup
 
 # a nice reference can be found at : https://blog.miguelgrinberg.com/post/flask-video-streaming-revisited
 
 # start with: gunicorn --bind 0.0.0.0:9422 adarl.utils.dbg.web_video_streamer_app:app
 
 
-BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
-CONFIG_ENV_VAR = "WSMONITOR_WEB_CONFIG"
-DEFAULT_WEB_CONFIG_PATH = os.path.join(BASE_DIR, "config", "web_config.yaml")
 SECRET_KEY_ENV_VAR = "WSMONITOR_FLASK_SECRET_KEY"
 
 
-def load_web_config(config_path: str) -> dict:
-  if not os.path.isfile(config_path):
-    print(f"web_config: no config file found at {config_path}, using defaults")
-    return {}
-  try:
-    with open(config_path, "r", encoding="utf-8") as config_file:
-      return yaml.safe_load(config_file) or {}
-  except (OSError, yaml.YAMLError) as exc:
-    print(f"web_config: failed to load {config_path}: {exc}")
-    return {}
-
-
-def build_user_alias_lookup(alias_section) -> dict[str, str]:
-  lookup: dict[str, str] = {}
-  if not isinstance(alias_section, dict):
-    return lookup
-  for canonical, aliases in alias_section.items():
-    if not isinstance(canonical, str):
-      continue
-    if aliases is None:
-      normalized_aliases: list[str] = []
-    elif isinstance(aliases, str):
-      normalized_aliases = [aliases]
-    elif isinstance(aliases, (list, tuple, set)):
-      normalized_aliases = [alias for alias in aliases if isinstance(alias, str)]
-    else:
-      continue
-    for alias in normalized_aliases:
-      lookup[alias] = canonical
-    lookup.setdefault(canonical, canonical)
-  return lookup
-
-
 def get_flask_secret_key() -> str:
   secret = os.environ.get(SECRET_KEY_ENV_VAR)
   if secret:
@@ -66,14 +36,40 @@ def get_flask_secret_key() -> str:
   return secret
 
 
-WEB_CONFIG_PATH = os.environ.get(CONFIG_ENV_VAR, DEFAULT_WEB_CONFIG_PATH)
+WEB_CONFIG_PATH = get_web_config_path()
 WEB_CONFIG = load_web_config(WEB_CONFIG_PATH)
 USER_ALIAS_LOOKUP = build_user_alias_lookup(WEB_CONFIG.get("user_aliases", {}))
 SERVER_BOOT_ID = secrets.token_hex(8)
+USAGE_CARD_DURATIONS_SEC = (604800, 86400)
+USAGE_REFRESH_SEC = 60
+HISTORY_RESOLUTIONS_MIN = {"minute": 1, "hour": 60, "day": 24*60}
+HISTORY_SLICE_BUCKETS = 1440 # buckets asked to the subscriber at a time
+HISTORY_MAX_BUCKETS = 366*24*60 # a year of minutes per request
+LIVE_AGE_RESOLUTION_SEC = 5
+STALE_HOST_AGE_SEC = 300 # the recap blanks hosts silent for longer
 
 app = Flask(__name__)
 app.secret_key = get_flask_secret_key()
-_resource_requests : list[dict] = []
+live_hub = LiveHub()
+# several gunicorn workers may serve /metrics, the label tells their series apart
+web_metrics = MetricsRegistry(const_labels={"worker": os.getpid()})
+http_request_timings = web_metrics.histogram("wsmon_http_request_seconds",
+                                             "Time to produce a response, streamed bodies excluded",
+                                             ("endpoint", "method", "status"))
+web_metrics.add_collector(lambda: [("wsmon_live_clients", "gauge", "Open /live event streams",
+                                    [({}, live_hub.clients_count)])])
+
+@app.before_request
+def start_request_timer():
+  flask.g.request_t0 = time.perf_counter()
+
+@app.after_request
+def observe_request_time(response):
+  t0 = flask.g.get("request_t0")
+  if t0 is not None:
+    http_request_timings.observe(time.perf_counter()-t0,
+                                 (request.endpoint or "none", request.method, str(response.status_code)))
+  return response
 
 @app.route('/index_old')
 def index():
@@ -93,6 +89,11 @@ def index():
 </body>
 </html>'''
 
+def current_boot_id() -> str:
+  # With a collector, its boot id as of the last reply: its generations start over when
+  # it restarts, so etags and open pages must not outlive it
+  return getattr(subscriber, "boot_id", None) or SERVER_BOOT_ID
+
 @app.errorhandler(404)
 def page_not_found(e):
     return "Page not found", 404
@@ -101,16 +102,18 @@ def page_not_found(e):
 def index2():
     # This will render templates/index.html
     notice = WEB_CONFIG.get("notice_html", "")
-    return render_template("index.html", notice=notice)
+    return render_template("index.html", notice=notice, boot_id=current_boot_id())
 
 @app.route("/global_stats")
 def global_stats():
-    # Replace with your subscriber.get_stats_recap(wsname)
-    stats = subscriber.get_stats_recap()
-    return Response(stats, mimetype="text/plain")
-
-@app.route("/user_usage_percent_<int:duration_sec>")
-def user_usage_percent(duration_sec):
+    snapshot = subscriber.get_recap_snapshot()
+    response = Response(snapshot.text, mimetype="text/plain")
+    # The boot id makes etags from a previous server instance never match
+    response.set_etag(f"{current_boot_id()}-{snapshot.generation}")
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+def format_user_usage_text(duration_sec : int) -> str:
   duration = duration_sec  # duration in seconds
   usage_minutes = subscriber.get_total_usage_minutes(since_seconds_ago=duration)
   total_minutes = duration // 60
@@ -138,67 +141,223 @@ def user_usage_percent(duration_sec):
           color = "⬜" #"🙃"
       rows.append(f"{color} {user.ljust(max_name_len)}  {percent:6.2f}%")
     usage_percent_text = "\n".join(rows)
-  return Response(usage_percent_text, mimetype="text/plain")
+  return usage_percent_text
 
 
-@app.route("/total_usage_ratio_<int:duration_sec>")
-def total_usage_ratio(duration_sec):
+def get_usage_ratio_payload(duration_sec : int) -> dict:
   ratio = subscriber.get_total_usage_ratio(since_seconds_ago=duration_sec)
   if math.isnan(ratio):
     ratio_payload = None
   else:
     ratio_payload = ratio
-  return jsonify({"ratio": ratio_payload, "duration_sec": duration_sec})
+  return {"ratio": ratio_payload, "duration_sec": duration_sec}
+
+
+@app.route("/user_usage_percent_<int:duration_sec>")
+def user_usage_percent(duration_sec):
+  return Response(format_user_usage_text(duration_sec), mimetype="text/plain")
+
+
+@app.route("/total_usage_ratio_<int:duration_sec>")
+def total_usage_ratio(duration_sec):
+  return jsonify(get_usage_ratio_payload(duration_sec))
 
 
 @app.route("/request_resources", methods=["POST"])
 def request_resources():
   payload = request.get_json(silent=True) or {}
   user = (payload.get("user") or "anonymous").strip() or "anonymous"
-  now = datetime.now()
-  timestamp = datetime.strftime(now, "%H:%M:%S")
-  entry = {"user": user, "timestamp": timestamp, "datetime": now}
-  _resource_requests.append(entry)
-  if len(_resource_requests) > 10:
-    del _resource_requests[:-10]
+  timestamp = subscriber.add_resource_request(user)
   print(f"Resource request received from {user} at {timestamp}")
+  live_hub.publish("resource_requests", "resource_requests", get_resource_requests())
   return jsonify({"status": "ok"})
 
+def get_resource_requests() -> list[dict]:
+  return subscriber.get_resource_requests()
+
 @app.route("/request_resources", methods=["GET"])
 def list_resource_requests():
-  reqs_no_old = []
-  now = datetime.now()
-  for r in _resource_requests:
-    delta = now - r["datetime"]
-    if delta.total_seconds() <= 3600:
-      reqs_no_old.append(r)
-  _resource_requests.clear()
-  _resource_requests.extend(reqs_no_old)
-  reqs = [{"user": r["user"], "timestamp": r["timestamp"]} for r in reversed(_resource_requests)]
-  return jsonify(list(reversed(reqs)))
+  return jsonify(get_resource_requests())
 
 
 @app.route("/server_boot_id")
 def server_boot_id():
-  return jsonify({"boot_id": SERVER_BOOT_ID})
+  return jsonify({"boot_id": current_boot_id()})
+
+@app.route("/metrics")
+def metrics():
+  try:
+    text = subscriber.get_metrics_text()
+  except Exception as e:
+    print(f"metrics: could not get the subscriber metrics: {type(e)}: {e}")
+    text = ""
+  return Response(text+web_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/ingest_stats")
+def ingest_stats():
+  return jsonify({"ingest": subscriber.get_ingest_counters(),
+                  "persistence": subscriber.get_persistence_counters(),
+                  "startup": subscriber.get_startup_timings()})
+
+def parse_time_arg(value : str) -> float:
+  """Epoch seconds or an ISO date/datetime in server local time."""
+  try:
+    return float(value)
+  except ValueError:
+    return datetime.fromisoformat(value).timestamp()
+
+def align_history_start(t : float, step_minutes : int) -> int:
+  """Epoch minute starting the bucket that contains t, days start at local midnight."""
+  if step_minutes >= 24*60:
+    return int(datetime.fromtimestamp(t).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()//60)
+  minute = int(t//60)
+  return minute - minute % step_minutes
+
+def iter_history_rows(start_minute : int, end_minute : int, step_minutes : int, host, users):
+  slice_minutes = HISTORY_SLICE_BUCKETS*step_minutes
+  for slice_start in range(start_minute, end_minute, slice_minutes):
+    slice_end = min(slice_start+slice_minutes, end_minute)
+    values = subscriber.get_history(slice_start, slice_end, step_minutes, host=host, users=users)
+    times = np.arange(slice_start, slice_end, step_minutes, dtype=np.int64)*60
+    yield np.column_stack((times, values))
+
+@app.route("/api/history")
+def history_api():
+  """Activity minutes per bucket, for a host (host=) or summed over the fleet.
+
+  user= adds the minutes of one user, by_user=1 one column per user. The body is
+  streamed a slice at a time, as JSON or, with format=binary, as a JSON header line
+  followed by little endian int64 rows.
+  """
+  host = request.args.get("host") or None
+  resolution = request.args.get("resolution", "hour")
+  fmt = request.args.get("format", "json")
+  if resolution not in HISTORY_RESOLUTIONS_MIN:
+    return f"resolution must be one of {', '.join(HISTORY_RESOLUTIONS_MIN)}", 400
+  if fmt not in ("json", "binary"):
+    return "format must be json or binary", 400
+  step = HISTORY_RESOLUTIONS_MIN[resolution]
+  now = time.time()
+  try:
+    end_t = min(parse_time_arg(request.args["end"]), now) if "end" in request.args else now
+    start_t = parse_time_arg(request.args["start"]) if "start" in request.args else end_t-7*24*3600
+  except ValueError as e:
+    return f"invalid start or end: {e}", 400
+  if not (math.isfinite(start_t) and math.isfinite(end_t)):
+    return "start and end must be finite", 400
+  # nothing was recorded before the epoch, nor after now
+  end_t = max(end_t, 0.0)
+  start_t = min(max(start_t, 0.0), end_t)
+  if (end_t-start_t)/60/step > HISTORY_MAX_BUCKETS:
+    return f"at most {HISTORY_MAX_BUCKETS} buckets per request, use a coarser resolution or a shorter range", 400
+  known_users = subscriber.get_history_users(host)
+  if known_users is None:
+    return f"{host} not found", 404
+  if request.args.get("user"):
+    users = [request.args["user"]]
+  elif request.args.get("by_user") in ("1", "true", "yes"):
+    users = known_users
+  else:
+    users = []
+  start_minute = align_history_start(start_t, step)
+  end_minute = max(int(end_t//60), start_minute)
+  meta = {"host": host,
+          "resolution": resolution,
+          "step_minutes": step,
+          "start": start_minute*60,
+          "end": end_minute*60,
+          "columns": ["time", "monitored", "active"]+[f"user:{u}" for u in users]}
+  rows = iter_history_rows(start_minute, end_minute, step, host, users)
+
+  def json_body():
+    yield json.dumps(meta)[:-1]+', "rows": ['
+    separator = "\n"
+    for block in rows:
+      if len(block) > 0:
+        yield separator+",\n".join(json.dumps(row) for row in block.tolist())
+        separator = ",\n"
+    yield "\n]}\n"
+
+  def binary_body():
+    yield (json.dumps({**meta, "dtype": "<i8"})+"\n").encode("utf8")
+    for block in rows:
+      yield block.astype("<i8").tobytes()
+
+  if fmt == "binary":
+    return Response(binary_body(), mimetype="application/octet-stream")
+  return Response(json_body(), mimetype="application/json")
+
+live_recap_hosts : set[str] = set()
+
+def publish_recap_rows():
+  global live_recap_hosts
+  snapshot = subscriber.get_recap_snapshot()
+  hosts = set()
+  for row in snapshot.rows:
+    host = row["host"] # the cells of a stale host are all nan, the hostname included
+    hosts.add(host)
+    age = None if math.isnan(row["age"]) else row["age"]
+    if age is not None and age > STALE_HOST_AGE_SEC:
+      cells = [host, " ⬛", " no data"]
+      last_contact = None # the client advances the age, nothing else changes until the host is back
+    else:
+      cells = format_recap_cells(row)
+      cells = cells[:1]+cells[2:]
+      # The age is advanced client side, so a new contact only counts as a change
+      # once the client's estimate would be off by more than LIVE_AGE_RESOLUTION_SEC
+      last_contact = None if age is None else int((snapshot.wall_time-age)/LIVE_AGE_RESOLUTION_SEC)
+    live_hub.publish(f"recap:{host}", "recap",
+                     payload = {"host": host,
+                                "cells": cells,
+                                "age": age,
+                                "server_time": snapshot.wall_time},
+                     compare_value = (cells, last_contact))
+  for host in live_recap_hosts-hosts:
+    live_hub.retract(f"recap:{host}", "recap_remove", {"host": host})
+  live_recap_hosts = hosts
+
+def live_producer_worker(period_sec : float = 1.0):
+  last_usage_refresh = float("-inf")
+  while True:
+    try:
+      publish_recap_rows()
+      # pages opened before a collector restart reload on this
+      live_hub.publish("boot", "boot", {"boot_id": current_boot_id()})
+      live_hub.publish("resource_requests", "resource_requests", get_resource_requests())
+      if time.monotonic() - last_usage_refresh >= USAGE_REFRESH_SEC:
+        last_usage_refresh = time.monotonic()
+        for duration_sec in USAGE_CARD_DURATIONS_SEC:
+          payload = get_usage_ratio_payload(duration_sec)
+          payload["text"] = format_user_usage_text(duration_sec)
+          live_hub.publish(f"usage:{duration_sec}", "usage", payload)
+    except Exception as e:
+      print(f"live_producer: error publishing updates: {type(e)}: {e}")
+    time.sleep(period_sec)
+
+@app.route("/live")
+def live_stream():
+  hello = {"boot_id": current_boot_id(), "server_time": time.time()}
+  return Response(live_hub.stream(hello),
+                  mimetype="text/event-stream",
+                  headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def week_png_response(wsname, date = None):
+  rendered = subscriber.get_activity_png(wsname, date = date)
+  if rendered is None:
+    return f"{wsname} not found"
+  png, tag = rendered
+  response = Response(png, mimetype='image/png')
+  response.set_etag(f"{current_boot_id()}-{wsname}-{tag}")
+  response.headers["Cache-Control"] = "no-cache"
+  return response.make_conditional(request)
 
 @app.route("/<wsname>/weekimage_history_<date_yyyymmdd>")
 def ws_weekimage_history_page(wsname, date_yyyymmdd):
-  img = subscriber.get_activity_img(wsname, date = datetime.strptime(date_yyyymmdd, "%Y%m%d").date())
-  if img is None:
-    return f"{wsname} not found"
-  data = np.array(cv2.imencode('.png', img)[1]).tobytes()
-  return Response(data,
-                  mimetype='image/png')
+  return week_png_response(wsname, date = datetime.strptime(date_yyyymmdd, "%Y%m%d").date())
 
 @app.route("/<wsname>/weekimage")
 def ws_weekimage_page(wsname):
-  img = subscriber.get_activity_img(wsname)
-  if img is None:
-    return f"{wsname} not found"
-  data = np.array(cv2.imencode('.png', img)[1]).tobytes()
-  return Response(data,
-                  mimetype='image/png')
+  return week_png_response(wsname)
 
 def get_page_foot():
   links = [f'<a href="/{wsname}">{wsname}</a>' for wsname in subscriber.get_ws_names()]
@@ -211,24 +370,38 @@ def get_page_foot():
 
 @app.route("/<wsname>/users")
 def ws_weekuserimage_page(wsname):
-  imgs : dict[str,np.ndarray] | None = subscriber.get_user_activity_images(wsname)
-  if imgs is None:
+  usernames = subscriber.get_user_names(wsname)
+  if usernames is None:
     return f"{wsname} not found"
-  
-  user_images = {}
-  for username, img in imgs.items():
-      success, encoded = cv2.imencode('.png', img)
-      if success:
-          b64_data = base64.b64encode(encoded.tobytes()).decode('utf-8')
-          user_images[username] = b64_data
-      else:
-          user_images[username] = None
-
   return render_template("ws_users.html",
                         wsname=wsname,
-                        user_images=user_images,
+                        usernames=usernames,
                         ws_names=subscriber.get_ws_names())
 
+@app.route("/<wsname>/users/<username>.png")
+def ws_userimage(wsname, username):
+  rendered = subscriber.get_user_activity_png(wsname, username)
+  if rendered is None:
+    return f"{wsname}/{username} not found", 404
+  png, tag = rendered
+  response = Response(png, mimetype='image/png')
+  response.set_etag(f"{current_boot_id()}-{wsname}-{username}-{tag}")
+  response.headers["Cache-Control"] = "no-cache"
+  return response.make_conditional(request)
+
+
+@app.route("/<wsname>/metric_history")
+def ws_metric_history(wsname):
+  range_sec = request.args.get("range_sec", 3600, type=float)
+  if not math.isfinite(range_sec):
+    return "range_sec must be a number of seconds", 400
+  range_sec = min(max(range_sec, 1.0), MAX_METRIC_RANGE_SEC) # longer than what is kept is useless
+  max_points = min(request.args.get("max_points", 600, type=int), 5000)
+  history = subscriber.get_metric_history(wsname, range_sec, max_points=max_points)
+  if history is None:
+    return f"{wsname} not found", 404
+  return jsonify(history)
+
 
 @app.route("/<wsname>/recap")
 def ws_details_page(wsname):
@@ -239,11 +412,28 @@ def ws_details_page(wsname):
   return render_template("ws_details.html", 
                         wsname=wsname, 
                         weekly_recap=weekly_recap,
+                        timing=subscriber.get_host_timing(wsname),
                         ws_names=subscriber.get_ws_names())
 
 
 with app.app_context():
-  subscriber = Subscriber(user_alias_lookup=USER_ALIAS_LOOKUP)
+  collector_address = os.environ.get(COLLECTOR_ENV_VAR)
+  if collector_address:
+    # The collector daemon owns the ZMQ port and the state, so any number of workers
+    # can serve pages. Etags derive from its generations, hence from its boot id,
+    # which current_boot_id() follows.
+    if "," in collector_address:
+      # sharded collectors, see wsmon_run_sharded_collectors.sh
+      from ws_monitor.sharding import ShardedCollectorClient
+      subscriber = ShardedCollectorClient([a.strip() for a in collector_address.split(",") if a.strip()])
+    else:
+      subscriber = CollectorClient(collector_address)
+    SERVER_BOOT_ID = subscriber.wait_boot_id()
+    print(f"Reading state from collector at {collector_address}")
+  else:
+    subscriber = Subscriber(user_alias_lookup=USER_ALIAS_LOOKUP)
+    close_on_sigterm(subscriber.close)
+  threading.Thread(target=live_producer_worker, daemon=True).start()
 
 if __name__ == '__main__':
   app.run(debug=False, host="0.0.0.0")
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+import json
+import struct
+
+WIRE_FORMAT_VERSION = 2
+FRAME_KEY = 1
+FRAME_DELTA = 2
+
+# version, frame kind, session_id, seq_num, seq_num the delta applies to, hostname length
+_HEADER = struct.Struct(">BBQQQH")
+_COUNT = struct.Struct(">H")
+_FIELD_DEF = struct.Struct(">HH") # field id, path length
+_VALUE = struct.Struct(">HB") # field id, type tag
+_INT = struct.Struct(">q")
+_FLOAT = struct.Struct(">f")
+_STR_LEN = struct.Struct(">I")
+# length prefix of strings and JSON values in each supported version, version 1 only
+# allowed values up to 64 KiB and is still decoded for publishers not yet updated
+_STR_LENS = {1 : struct.Struct(">H"), WIRE_FORMAT_VERSION : _STR_LEN}
+
+_TAG_NONE = 0
+_TAG_FALSE = 1
+_TAG_TRUE = 2
+_TAG_INT = 3
+_TAG_FLOAT = 4
+_TAG_STR = 5
+_TAG_EMPTY_DICT = 6
+_TAG_JSON = 7 # anything else, e.g. lists
+
+_PATH_SEPARATOR = "\x1f"
+_EMPTY_DICT = object()
+
+_MAX_FIELDS = 0xFFFF
+
+
+class WireFormatError(Exception):
+    pass
+
+
+def _flatten(value : dict, prefix : str, out : dict):
+    for k, v in value.items():
+        path = prefix+str(k)
+        if isinstance(v, dict):
+            if len(v) == 0:
+                out[path] = _EMPTY_DICT
+            else:
+                _flatten(v, path+_PATH_SEPARATOR, out)
+        elif isinstance(v, float):
+            out[path] = _FLOAT.unpack(_FLOAT.pack(v))[0] # compare at the precision that is sent
+        else:
+            out[path] = v
+    return out
+
+def _encode_value(field_id : int, v, out : list):
+    if v is None:
+        out.append(_VALUE.pack(field_id, _TAG_NONE))
+    elif v is _EMPTY_DICT:
+        out.append(_VALUE.pack(field_id, _TAG_EMPTY_DICT))
+    elif v is True or v is False:
+        out.append(_VALUE.pack(field_id, _TAG_TRUE if v else _TAG_FALSE))
+    elif isinstance(v, int) and -2**63 <= v < 2**63:
+        out.append(_VALUE.pack(field_id, _TAG_INT) + _INT.pack(v))
+    elif isinstance(v, float):
+        out.append(_VALUE.pack(field_id, _TAG_FLOAT) + _FLOAT.pack(v))
+    else:
+        tag = _TAG_STR
+        if not isinstance(v, str):
+            tag = _TAG_JSON
+            v = json.dumps(v)
+        b = v.encode("utf8")
+        out.append(_VALUE.pack(field_id, tag) + _STR_LEN.pack(len(b)) + b)
+
+
+class FrameHeader:
+    def __init__(self, kind : int, session_id : int, seq_num : int, base_seq_num : int, hostname : str,
+                       version : int = WIRE_FORMAT_VERSION):
+        self.version = version
+        self.kind = kind
+        self.session_id = session_id
+        self.seq_num = seq_num
+        self.base_seq_num = base_seq_num
+        self.hostname = hostname
+
+def decode_header(header : bytes) -> FrameHeader:
+    if len(header) < _HEADER.size:
+        raise WireFormatError(f"header too short ({len(header)} bytes)")
+    version, kind, session_id, seq_num, base_seq_num, hostname_len = _HEADER.unpack_from(header)
+    if version not in _STR_LENS:
+        raise WireFormatError(f"unsupported wire format version {version}")
+    if kind not in (FRAME_KEY, FRAME_DELTA):
+        raise WireFormatError(f"unknown frame kind {kind}")
+    hostname = header[_HEADER.size:_HEADER.size+hostname_len].decode("utf8")
+    return FrameHeader(kind, session_id, seq_num, base_seq_num, hostname, version)
+
+
+class WireEncoder:
+    """Encodes the successive states of one publisher session as keyframes and deltas.
+
+    A message is the nested dict the publisher used to send as JSON. It is flattened into
+    fields, each identified by a small integer whose path is only sent once per keyframe.
+    Delta frames carry just the fields whose value changed since the previous frame,
+    plus the ids of the ones that disappeared. Floats are sent as float32.
+    A keyframe is sent every keyframe_interval frames so that subscribers that
+    (re)connect or miss a frame resynchronise.
+    """
+    def __init__(self, session_id : int, keyframe_interval : int = 30):
+        self._session_id = session_id
+        self._keyframe_interval = keyframe_interval
+        self._field_ids : dict[str, int] = {}
+        self._values : dict[str, object] = {}
+        self._frames_since_key = keyframe_interval
+        self._last_seq_num = 0
+        self.keyframes = 0
+        self.deltas = 0
+
+    def encode(self, seq_num : int, state : dict) -> list[bytes]:
+        """Encode state, returns the header and body parts of the multipart message."""
+        fields = _flatten({k:v for k,v in state.items() if k not in ("session_id", "seq_num")}, "", {})
+        is_key = self._frames_since_key >= self._keyframe_interval or len(self._field_ids)+len(fields) > _MAX_FIELDS
+        if is_key:
+            self._field_ids = {}
+            self._values = {}
+            self._frames_since_key = 0
+            self.keyframes += 1
+        else:
+            self._frames_since_key += 1
+            self.deltas += 1
+
+        defs = []
+        values = []
+        for path, v in fields.items():
+            field_id = self._field_ids.get(path)
+            if field_id is None:
+                field_id = len(self._field_ids)
+                self._field_ids[path] = field_id
+                p = path.encode("utf8")
+                defs.append(_FIELD_DEF.pack(field_id, len(p)) + p)
+            elif path in self._values and self._values[path] == v and type(self._values[path]) is type(v):
+                continue
+            _encode_value(field_id, v, values)
+        removed = [_COUNT.pack(self._field_ids[path]) for path in self._values if path not in fields]
+        self._values = fields
+
+        hostname = str(state.get("hostname", "")).encode("utf8")
+        header = _HEADER.pack(WIRE_FORMAT_VERSION, FRAME_KEY if is_key else FRAME_DELTA,
+                              self._session_id, seq_num, self._last_seq_num, len(hostname)) + hostname
+        self._last_seq_num = seq_num
+        body = b"".join([_COUNT.pack(len(defs))] + defs
+                        + [_COUNT.pack(len(values))] + values
+                        + [_COUNT.pack(len(removed))] + removed)
+        return [header, body]
+
+
+class WireDecoder:
+    """Rebuilds the states of one host from its keyframes and deltas.
+
+    Deltas that do not directly follow the last applied frame are dropped until the next
+    keyframe. Each frame copies only the dicts on the path of the changed fields, the rest
+    is shared with the previous state, so states returned by decode must not be modified.
+    """
+    def __init__(self):
+        self._session_id = None
+        self._seq_num = None
+        self._paths : dict[int, list[str]] = {}
+        self._state : dict = {}
+        self.keyframes = 0
+        self.deltas = 0
+        self.dropped_deltas = 0
+
+    def decode(self, header : FrameHeader, body : bytes) -> dict | None:
+        if header.kind == FRAME_KEY:
+            self._paths = {}
+            self._state = {}
+            self.keyframes += 1
+        elif header.session_id != self._session_id or header.base_seq_num != self._seq_num:
+            self.dropped_deltas += 1
+            return None
+        else:
+            self.deltas += 1
+        self._session_id = header.session_id
+        self._seq_num = header.seq_num
+
+        try:
+            self._state = self._apply(body, _STR_LENS[header.version])
+        except (struct.error, KeyError, UnicodeDecodeError, ValueError) as e:
+            # wait for the next keyframe
+            self._session_id = None
+            raise WireFormatError(f"malformed frame from {header.hostname}: {type(e).__name__}: {e}")
+        data = dict(self._state)
+        data["session_id"] = header.session_id
+        data["seq_num"] = header.seq_num
+        return data
+
+    @staticmethod
+    def _parent(root : dict, keys : list[str], copied : set[int], create : bool) -> list[dict] | None:
+        """Dicts from root to the parent of keys, copied on first access in the current frame."""
+        nodes = [root]
+        node = root
+        for k in keys[:-1]:
+            child = node.get(k)
+            if not isinstance(child, dict):
+                if not create:
+                    return None
+                child = {}
+            elif id(child) not in copied:
+                child = dict(child)
+            else:
+                nodes.append(child)
+                node = child
+                continue
+            copied.add(id(child))
+            node[k] = child
+            nodes.append(child)
+            node = child
+        return nodes
+
+    def _apply(self, body : bytes, str_len : struct.Struct) -> dict:
+        root = dict(self._state)
+        copied = {id(root)}
+        pos = 0
+        n, = _COUNT.unpack_from(body, pos)
+        pos += _COUNT.size
+        for _ in range(n):
+            field_id, path_len = _FIELD_DEF.unpack_from(body, pos)
+            pos += _FIELD_DEF.size
+            self._paths[field_id] = body[pos:pos+path_len].decode("utf8").split(_PATH_SEPARATOR)
+            pos += path_len
+
+        # removals are listed last but applied first, a path may turn from a leaf into a dict
+        n_values, = _COUNT.unpack_from(body, pos)
+        values_pos = pos+_COUNT.size
+        pos = values_pos
+        for _ in range(n_values):
+            _, tag = _VALUE.unpack_from(body, pos)
+            pos += _VALUE.size
+            if tag == _TAG_INT:
+                pos += _INT.size
+            elif tag == _TAG_FLOAT:
+                pos += _FLOAT.size
+            elif tag == _TAG_STR or tag == _TAG_JSON:
+                pos += str_len.size + str_len.unpack_from(body, pos)[0]
+        n, = _COUNT.unpack_from(body, pos)
+        pos += _COUNT.size
+        for field_id, in _COUNT.iter_unpack(body[pos:pos+n*_COUNT.size]):
+            keys = self._paths[field_id]
+            nodes = self._parent(root, keys, copied, create=False)
+            if nodes is None:
+                continue
+            nodes[-1].pop(keys[-1], None)
+            # drop the dicts left empty, empty dicts that are part of the state have their own field
+            for depth in range(len(nodes)-1, 0, -1):
+                if len(nodes[depth]) > 0:
+                    break
+                del nodes[depth-1][keys[depth-1]]
+
+        pos = values_pos
+        for _ in range(n_values):
+            field_id, tag = _VALUE.unpack_from(body, pos)
+            pos += _VALUE.size
+            if tag == _TAG_INT:
+                v, = _INT.unpack_from(body, pos)
+                pos += _INT.size
+            elif tag == _TAG_FLOAT:
+                v, = _FLOAT.unpack_from(body, pos)
+                pos += _FLOAT.size
+            elif tag == _TAG_STR or tag == _TAG_JSON:
+                length, = str_len.unpack_from(body, pos)
+                pos += str_len.size
+                v = body[pos:pos+length].decode("utf8")
+                pos += length
+                if tag == _TAG_JSON:
+                    v = json.loads(v)
+            elif tag == _TAG_NONE:
+                v = None
+            elif tag == _TAG_FALSE or tag == _TAG_TRUE:
+                v = tag == _TAG_TRUE
+            elif tag == _TAG_EMPTY_DICT:
+                v = {}
+            else:
+                raise ValueError(f"unknown value tag {tag}")
+            keys = self._paths[field_id]
+            if len(keys) == 1:
+                root[keys[0]] = v
+            else:
+                self._parent(root, keys, copied, create=True)[-1][keys[-1]] = v
+        return root
@@ -0,0 +1,7 @@
+#!/bin/bash
+
+cd $(dirname $0)
+
+# Receives the publishers' messages and serves the state to the web workers,
+# see wsmon_run_gunicorn.sh. Run from the same folder so the data folder is the same.
+python -m ws_monitor.collector "$@"
@@ -2,8 +2,22 @@
 
 cd $(dirname $0)
 
-# Keep a single worker: the Subscriber binds the ZMQ port, and multiple
-# gunicorn workers would all try to bind the same endpoint causing EADDRINUSE.
-# Threads are fine—they share the single subscriber instance.
-gunicorn -w 1 --threads 4 'ws_monitor.web_page:app' -b 0.0.0.0:9423
+# The gevent worker lets the /live event streams of all open dashboards wait
+# as greenlets instead of each holding a thread. The workers only read the state
+# from the collector daemon, which owns the ZMQ port and the Subscriber threads.
+if [[ -z "$WSMONITOR_COLLECTOR" ]]; then
+    # No collector given: run one alongside the workers, stopped with them.
+    # Extra arguments go to the collector (see wsmon_run_collector.sh).
+    export WSMONITOR_COLLECTOR=ipc:///tmp/wsmonitor_collector.sock
+    python -m ws_monitor.collector --listen $WSMONITOR_COLLECTOR "$@" &
+    collector_pid=$!
+fi
+gunicorn -w ${WSMONITOR_WEB_WORKERS:-4} -k gevent --worker-connections 1000 'ws_monitor.web_page:app' -b 0.0.0.0:9423 &
+gunicorn_pid=$!
+# Stopping the script stops both, the collector flushing its state on SIGTERM
+trap 'kill -TERM $gunicorn_pid $collector_pid 2>/dev/null' TERM INT
+wait $gunicorn_pid
+kill -TERM $gunicorn_pid $collector_pid 2>/dev/null
+wait
+# gunicorn -w 1 --threads 4 'ws_monitor.web_page:app' -b 0.0.0.0:9423
 # flask --app ws_monitor.web_page run -p 9423 --host=0.0.0.0
@@ -0,0 +1,18 @@
+#!/bin/bash
+
+cd $(dirname $0)
+
+# Runs a forwarder on the publishers' port and WSMONITOR_SHARDS collectors (4 by default),
+# each ingesting its own hosts. They share the data folder, so changing the number of
+# shards moves hosts without losing their history. Extra arguments go to every shard.
+SHARDS=${WSMONITOR_SHARDS:-4}
+FANOUT=ipc:///tmp/wsmonitor_fanout.sock
+python -m ws_monitor.collector --forwarder --fanout $FANOUT &
+addresses=""
+for i in $(seq 0 $((SHARDS-1))); do
+    address=ipc:///tmp/wsmonitor_collector_$i.sock
+    python -m ws_monitor.collector --server $FANOUT --connect --shard $i/$SHARDS --listen $address "$@" &
+    addresses="$addresses${addresses:+,}$address"
+done
+echo "Start the web workers with WSMONITOR_COLLECTOR=$addresses"
+wait
@@ -0,0 +1,37 @@
+import struct
+from ws_monitor.wire_format import WireDecoder, WireEncoder, decode_header
+
+
+def roundtrip(encoder : WireEncoder, decoder : WireDecoder, seq_num : int, state : dict) -> dict | None:
+    header, body = encoder.encode(seq_num, state)
+    return decoder.decode(decode_header(header), body)
+
+def test_oversized_values():
+    # well over the 64 KiB the string length prefix used to allow
+    processes = [{"pid" : i, "cmdline" : f"/usr/bin/python train.py --run {i} " + "x"*200} for i in range(2000)]
+    users = "u"*100000
+    state = {"hostname" : "ws1", "cpu" : 0.5, "processes" : processes, "users" : users}
+    encoder = WireEncoder(session_id=1, keyframe_interval=30)
+    decoder = WireDecoder()
+    data = roundtrip(encoder, decoder, 1, state)
+    assert data["processes"] == processes
+    assert data["users"] == users
+
+    # and in a delta following it
+    state = {**state, "users" : users+"v", "cpu" : 0.25}
+    data = roundtrip(encoder, decoder, 2, state)
+    assert decoder.deltas == 1
+    assert data["users"] == users+"v"
+    assert data["processes"] == processes
+    assert data["cpu"] == 0.25
+
+def test_decodes_version_1_frames():
+    # header and body of a version 1 keyframe, with a 16 bit string length
+    hostname = b"ws1"
+    header = struct.pack(">BBQQQH", 1, 1, 7, 1, 0, len(hostname)) + hostname
+    path, value = b"hostname", b"ws1"
+    body = (struct.pack(">H", 1) + struct.pack(">HH", 0, len(path)) + path
+            + struct.pack(">H", 1) + struct.pack(">HB", 0, 5) + struct.pack(">H", len(value)) + value
+            + struct.pack(">H", 0))
+    data = WireDecoder().decode(decode_header(header), body)
+    assert data == {"hostname" : "ws1", "session_id" : 7, "seq_num" : 1}